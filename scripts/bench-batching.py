@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+連續批次排程效能測試
+比較不同並行數下排程器與逐一 generate 的總吞吐量（可在 CPU 上以小模型執行）
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from services.batch_scheduler import ContinuousBatchScheduler
+
+PROMPTS = [
+    "### 用戶\n請創建一根 HEA300 樑\n### 助手\n",
+    "### 用戶\n如何使用 Model.CommitChanges？\n### 助手\n",
+    "### 用戶\nCreate a column with profile HEB300 and material S355\n### 助手\n",
+    "### 用戶\n列出目錄中的所有截面\n### 助手\n",
+]
+
+
+def run_sequential(model, tokenizer, prompts, max_new_tokens) -> int:
+    """逐一呼叫 generate，回傳生成 token 數"""
+    total = 0
+    for prompt in prompts:
+        inputs = tokenizer.encode(prompt, return_tensors="pt").to(model.device)
+        with torch.no_grad():
+            outputs = model.generate(
+                inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id
+            )
+        total += outputs.shape[1] - inputs.shape[1]
+    return total
+
+
+async def run_batched(scheduler, tokenizer, prompts, max_new_tokens) -> int:
+    """並行提交至排程器，回傳生成 token 數"""
+    results = await asyncio.gather(*(
+        scheduler.submit(
+            tokenizer.encode(prompt),
+            max_new_tokens=max_new_tokens,
+            temperature=0,
+            do_sample=False
+        )
+        for prompt in prompts
+    ))
+    return sum(len(tokens) for tokens in results)
+
+
+async def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="連續批次排程效能測試")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--concurrency", default="1,2,4,8,16")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, padding_side="left")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(args.model).to(args.device).eval()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_batch_size=max(levels))
+
+    # 預熱
+    run_sequential(model, tokenizer, PROMPTS[:1], 4)
+    await run_batched(scheduler, tokenizer, PROMPTS[:1], 4)
+
+    print(f"{'並行數':>6} {'逐一 tok/s':>12} {'批次 tok/s':>12} {'倍數':>6}")
+    for level in levels:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(level)]
+
+        start = time.perf_counter()
+        sequential_tokens = run_sequential(model, tokenizer, prompts, args.max_new_tokens)
+        sequential_rate = sequential_tokens / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        batched_tokens = await run_batched(scheduler, tokenizer, prompts, args.max_new_tokens)
+        batched_rate = batched_tokens / (time.perf_counter() - start)
+
+        print(f"{level:>6} {sequential_rate:>12.1f} {batched_rate:>12.1f} {batched_rate / sequential_rate:>6.2f}")
+
+    print(f"排程統計: {scheduler.get_stats()}")
+    await scheduler.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
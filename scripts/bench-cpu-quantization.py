@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+CPU int8 動態量化效能測試
+比較 fp32 與 int8 動態量化模型在 CPU 上的生成速度、權重大小與常駐記憶體
+每種模式在獨立子程序中執行，避免記憶體量測互相干擾
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+PROMPTS = [
+    "請創建一根 HEA300 樑",
+    "如何使用 Model.CommitChanges？",
+    "Create a column with profile HEB300 and material S355",
+]
+
+
+def run_mode(model: str, cpu_int8: bool, threads: int, max_new_tokens: int, repeat: int) -> dict:
+    """在子程序中載入模型並量測"""
+    import psutil
+    import torch
+
+    from services.ai_service import AIService
+    from services.cpu_backend import model_size_mb
+
+    async def measure():
+        service = AIService(
+            model_name=model,
+            device_map="cpu",
+            torch_dtype=torch.float32,
+            enable_prefix_cache=False,
+            cpu_int8=cpu_int8,
+            cpu_threads=threads
+        )
+        await service.initialize()
+
+        tokens = 0
+        outputs = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for prompt in PROMPTS:
+                input_ids, prefix_length = service._encode_prompt(prompt)
+                output_ids = await service._generate_ids(
+                    input_ids, prefix_length, 0.7, max_new_tokens, do_sample=False
+                )
+                tokens += len(output_ids)
+                outputs.append(output_ids)
+        elapsed = time.perf_counter() - start
+
+        result = {
+            "tokens_per_second": tokens / elapsed,
+            "weights_mb": model_size_mb(service.model),
+            "rss_mb": psutil.Process().memory_info().rss / 1024 / 1024,
+            "outputs": outputs
+        }
+        await service.cleanup()
+        return result
+
+    return asyncio.run(measure())
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="CPU int8 動態量化效能測試")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, cpu_int8 in (("fp32", False), ("int8", True)):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(
+                run_mode, args.model, cpu_int8, args.threads, args.max_new_tokens, args.repeat
+            ).result()
+
+    fp32, int8 = results["fp32"], results["int8"]
+    print(f"{'模式':>6} {'tok/s':>10} {'權重 MB':>10} {'RSS MB':>10}")
+    for name, result in results.items():
+        print(f"{name:>6} {result['tokens_per_second']:>10.1f} {result['weights_mb']:>10.1f} {result['rss_mb']:>10.1f}")
+
+    matches = sum(a == b for a, b in zip(fp32["outputs"], int8["outputs"]))
+    print(f"速度倍數: {int8['tokens_per_second'] / fp32['tokens_per_second']:.2f}，"
+          f"權重縮減: {fp32['weights_mb'] / int8['weights_mb']:.2f}x，"
+          f"貪婪輸出一致: {matches}/{len(fp32['outputs'])}")
+
+
+if __name__ == "__main__":
+    main()
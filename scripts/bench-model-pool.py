@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+多副本模型池效能測試
+以多個 CPU 工作程序（小模型）比較不同副本數下的總吞吐量，並可模擬副本崩潰
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+import torch
+
+from services.ai_service import AIService
+
+MESSAGES = [
+    "請創建一根 HEA300 樑",
+    "如何使用 Model.CommitChanges？",
+    "Create a column with profile HEB300 and material S355",
+    "列出目錄中的所有截面",
+]
+
+
+async def run_load(service: AIService, requests: int, max_new_tokens: int) -> float:
+    """並行送出請求，回傳每秒完成請求數"""
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        service.generate_response(
+            MESSAGES[i % len(MESSAGES)],
+            max_tokens=max_new_tokens,
+            do_sample=False
+        )
+        for i in range(requests)
+    ), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if failures:
+        print(f"  {len(failures)} 個請求失敗: {failures[0]}")
+    return (requests - len(failures)) / elapsed
+
+
+async def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="多副本模型池效能測試")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--replicas", default="1,2,4")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads-per-replica", type=int, default=1)
+    parser.add_argument("--kill-one", action="store_true", help="負載進行中終止一個副本，確認其被移除")
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'副本數':>6} {'req/s':>10} {'倍數':>6}")
+    for count in [int(level) for level in args.replicas.split(",")]:
+        service = AIService(
+            model_name=args.model,
+            device_map=args.device,
+            torch_dtype=torch.float32,
+            enable_prefix_cache=False,
+            replica_devices=[args.device] * count,
+            replica_threads=args.threads_per_replica
+        )
+        await service.initialize()
+
+        await run_load(service, count, 4)  # 預熱
+        load = asyncio.ensure_future(run_load(service, args.requests, args.max_new_tokens))
+        if args.kill_one and count > 1:
+            await asyncio.sleep(0.5)
+            os.kill(service.worker.replicas[0].worker.get_stats()["pid"], signal.SIGKILL)
+        rate = await load
+
+        baseline = baseline or rate
+        print(f"{count:>6} {rate:>10.2f} {rate / baseline:>6.2f}")
+        stats = service.worker.get_stats()
+        print(f"  健康副本 {stats['healthy_replicas']}/{count}，重試 {stats['retries']}，"
+              f"各副本完成數 {[r['completed'] for r in stats['replicas']]}")
+        await service.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+共用前綴 KV 快取效能測試
+比較完整預填與沿用系統提示詞快取時的首個 token 延遲（TTFT）
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from services.ai_service import DEFAULT_SYSTEM_PROMPT
+from services.kv_cache_utils import clone_layers, layers_to_cache
+from services.prefix_cache import PrefixKVCache
+
+MESSAGES = [
+    "請創建一根 HEA300 樑",
+    "如何使用 Model.CommitChanges？",
+    "Create a column with profile HEB300 and material S355",
+    "列出目錄中的所有截面",
+]
+
+
+def first_token_latency(model, input_ids, past_key_values=None) -> float:
+    """生成一個 token 所需時間（秒）"""
+    start = time.perf_counter()
+    with torch.no_grad():
+        model.generate(
+            input_ids,
+            max_new_tokens=1,
+            do_sample=False,
+            past_key_values=past_key_values
+        )
+    return time.perf_counter() - start
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="共用前綴 KV 快取效能測試")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model).to(args.device).eval()
+    model.generation_config.pad_token_id = tokenizer.pad_token_id or tokenizer.eos_token_id
+    cache = PrefixKVCache(model)
+
+    prefix_ids = tokenizer.encode(f"### 系統\n{DEFAULT_SYSTEM_PROMPT}\n\n")
+    prompts = [
+        prefix_ids + tokenizer.encode(f"### 用戶\n{message}\n\n### 助手\n", add_special_tokens=False)
+        for message in MESSAGES
+    ]
+
+    # 預熱並建立前綴快取
+    first_token_latency(model, torch.tensor([prompts[0]], device=model.device))
+    cache.get(prefix_ids)
+
+    full, cached = [], []
+    for _ in range(args.repeat):
+        for ids in prompts:
+            input_ids = torch.tensor([ids], device=model.device)
+            full.append(first_token_latency(model, input_ids))
+            past = layers_to_cache(clone_layers(cache.get(prefix_ids)))
+            cached.append(first_token_latency(model, input_ids, past))
+
+    full_ms = statistics.median(full) * 1000
+    cached_ms = statistics.median(cached) * 1000
+    print(f"前綴 token 數: {len(prefix_ids)}，平均提示詞 token 數: {sum(map(len, prompts)) / len(prompts):.0f}")
+    print(f"TTFT 中位數 完整預填: {full_ms:.2f} ms，沿用前綴快取: {cached_ms:.2f} ms，倍數: {full_ms / cached_ms:.2f}")
+    print(f"快取統計: {cache.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+文本分割器一致性檢查與效能測試
+比較內建 RecursiveTextSplitter 與 langchain RecursiveCharacterTextSplitter
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from services.text_splitter import DEFAULT_SEPARATORS, RecursiveTextSplitter
+
+SAMPLE_PARAGRAPHS = [
+    "Tekla Structures 2025 Open API 提供模型、圖紙與目錄操作。",
+    "Beam beam = new Beam();\nbeam.StartPoint = new Point(0, 0, 0);\nbeam.Insert();",
+    "The Model class represents the current model. Call CommitChanges to apply changes!",
+    "Does the profile exist in the catalog? Use CatalogHandler, then check the name.",
+    "ContourPlate plate = new ContourPlate(); plate.Profile.ProfileString = \"PL20\";",
+]
+
+
+def load_langchain_splitter():
+    """載入 langchain 分割器（未安裝時回傳 None）"""
+    try:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    except ImportError:
+        try:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+        except ImportError:
+            return None
+    return RecursiveCharacterTextSplitter
+
+
+def build_corpus(size_chars: int, seed: int) -> str:
+    """產生混合中英文與代碼的測試語料"""
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size_chars:
+        paragraph = " ".join(
+            rng.choice(SAMPLE_PARAGRAPHS) for _ in range(rng.randint(1, 12))
+        )
+        # 偶爾插入無分隔符的長字串以觸發最細層級分割
+        if rng.random() < 0.05:
+            paragraph += " " + "x" * rng.randint(500, 2500)
+        parts.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(parts)
+
+
+def check_parity(langchain_cls, texts, chunk_size: int, chunk_overlap: int) -> bool:
+    """檢查兩個分割器輸出是否一致"""
+    native = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    reference = langchain_cls(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=DEFAULT_SEPARATORS
+    )
+
+    for i, text in enumerate(texts):
+        expected = reference.split_text(text)
+        actual = native.split_text(text)
+        if expected != actual:
+            print(f"❌ 第 {i} 份語料輸出不一致 (chunk_size={chunk_size}, overlap={chunk_overlap})")
+            print(f"   langchain: {len(expected)} 區塊, 內建: {len(actual)} 區塊")
+            return False
+    return True
+
+
+def measure(split_text, text: str, repeat: int) -> float:
+    """回傳每秒處理的 MB 數"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        split_text(text)
+    elapsed = time.perf_counter() - start
+    return len(text.encode("utf-8")) * repeat / elapsed / 1024 / 1024
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="文本分割器一致性與效能測試")
+    parser.add_argument("--size", type=int, default=2_000_000, help="語料字元數")
+    parser.add_argument("--repeat", type=int, default=3, help="重複次數")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    langchain_cls = load_langchain_splitter()
+    corpus = build_corpus(args.size, args.seed)
+
+    if langchain_cls is None:
+        print("⚠️  未安裝 langchain，略過一致性檢查與對照測試")
+    else:
+        samples = [build_corpus(20_000, seed) for seed in range(20)]
+        samples += ["", "   ", "a" * 5000, "短文本", "\n\n".join(["段落"] * 300)]
+        for chunk_size, chunk_overlap in [(1000, 200), (200, 50), (50, 0), (10, 5)]:
+            if not check_parity(langchain_cls, samples, chunk_size, chunk_overlap):
+                sys.exit(1)
+        print("✅ 一致性檢查通過")
+
+    native = RecursiveTextSplitter(chunk_size=1000, chunk_overlap=200)
+    native_mbps = measure(native.split_text, corpus, args.repeat)
+    print(f"內建 RecursiveTextSplitter: {native_mbps:.2f} MB/s")
+
+    if langchain_cls is not None:
+        reference = langchain_cls(
+            chunk_size=1000,
+            chunk_overlap=200,
+            separators=DEFAULT_SEPARATORS
+        )
+        reference_mbps = measure(reference.split_text, corpus, args.repeat)
+        print(f"langchain RecursiveCharacterTextSplitter: {reference_mbps:.2f} MB/s")
+        print(f"加速倍數: {native_mbps / reference_mbps:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+HTTP API 負載測試與延遲 SLO 基準
+開放迴路（依目標 RPS 排定送出時間，不等待前一個請求完成）對 /api/chat、/api/rag/query、
+/api/tekla/command 送出混合請求，以 HDR 直方圖統計延遲百分位數、錯誤率與吞吐量。
+延遲自排定送出時間起算，客戶端排隊（超過並行上限）也計入，避免協同遺漏（coordinated omission）。
+
+對簡化伺服器可先以 --backend 切換模擬後端的延遲分布，例如 --backend zero 量測框架本身的開銷；
+簡化伺服器在 X-Mock-Delay 標頭回報每個請求的模擬延遲，扣除後即為框架開銷。
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+PERCENTILES = (50.0, 90.0, 95.0, 99.0, 99.9, 100.0)
+
+ENDPOINTS = {
+    "chat": "/api/chat",
+    "rag": "/api/rag/query",
+    "tekla": "/api/tekla/command",
+}
+
+PROFILES = {
+    "chat": "chat=1",
+    "rag": "rag=1",
+    "tekla": "tekla=1",
+    "mixed": "chat=5,rag=3,tekla=2",
+}
+
+MESSAGES = [
+    "請創建一根 HEA300 樑",
+    "如何使用 Model.CommitChanges？",
+    "Create a column with profile HEB300 and material S355",
+    "列出目錄中的所有截面",
+    "如何在兩根樑之間建立螺栓連接？",
+]
+
+
+def build_payload(endpoint: str, rng: random.Random) -> Dict[str, Any]:
+    """各端點的請求內容"""
+    message = rng.choice(MESSAGES)
+    if endpoint == "chat":
+        return {"message": message, "use_rag": True}
+    if endpoint == "rag":
+        return {"query": message, "top_k": 3}
+    return {"command": message}
+
+
+class HdrHistogram:
+    """HDR 直方圖（整數微秒）
+
+    小於 sub_bucket_count 的值精確記錄，更大的值以 2 的冪分桶、每桶再等分，
+    相對誤差不超過 10^-significant_figures。
+    """
+
+    def __init__(self, significant_figures: int = 3):
+        self.sub_bucket_bits = (2 * 10 ** significant_figures - 1).bit_length()
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self.sum = 0
+        self.min: Optional[int] = None
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half + (value >> shift) - self.sub_bucket_half
+
+    def _highest_equivalent(self, index: int) -> int:
+        if index < self.sub_bucket_count:
+            return index
+        shift, offset = divmod(index - self.sub_bucket_count, self.sub_bucket_half)
+        shift += 1
+        return ((offset + self.sub_bucket_half + 1) << shift) - 1
+
+    def record(self, value: int):
+        """記錄一個值"""
+        value = max(int(value), 0)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "HdrHistogram"):
+        """合併另一個直方圖"""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> int:
+        """百分位數（所在桶的上限，不超過最大值）"""
+        if not self.total:
+            return 0
+        target = max(int(percentile / 100 * self.total + 0.5), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest_equivalent(index), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+
+
+class HttpClient:
+    """最小的 HTTP/1.1 keep-alive 客戶端（避免客戶端本身的開銷影響量測）"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError(f"只支援 http: {url}")
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 80
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        """送出請求，回傳 (狀態碼, 標頭, 回應內容)
+
+        閒置連線可能已被伺服器依 keep-alive 逾時關閉，此時改用新連線重送一次。
+        """
+        body = json.dumps(payload, ensure_ascii=False).encode() if payload is not None else b""
+        while self._idle:
+            reader, writer = self._idle.pop()
+            try:
+                return await self._exchange(reader, writer, method, path, body)
+            except ConnectionError:
+                continue
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return await self._exchange(reader, writer, method, path, body)
+
+    async def _exchange(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        body: bytes
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """在一條連線上完成一次請求與回應"""
+        try:
+            writer.write(
+                f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("伺服器關閉連線")
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if "content-length" in headers:
+                content = await reader.readexactly(int(headers["content-length"]))
+            elif headers.get("transfer-encoding") == "chunked":
+                content = b""
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    content += await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+            else:
+                content = await reader.read()
+                headers["connection"] = "close"
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+        return status, headers, content
+
+    async def close(self):
+        """關閉閒置連線"""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+class EndpointStats:
+    """單一端點的統計"""
+
+    def __init__(self):
+        self.latency = HdrHistogram()  # 自排定送出時間起算
+        self.service = HdrHistogram()  # 自實際送出時間起算
+        self.overhead = HdrHistogram()  # 服務時間扣除模擬後端延遲
+        self.ok = 0
+        self.errors: Dict[str, int] = {}
+
+    @property
+    def requests(self) -> int:
+        return self.ok + sum(self.errors.values())
+
+    def record_error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """解析「端點=權重」設定"""
+    weights = []
+    for item in filter(None, (part.strip() for part in PROFILES.get(mix, mix).split(","))):
+        endpoint, _, weight = item.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"未知的端點: {endpoint}（可用: {', '.join(ENDPOINTS)}）")
+        weights.append((endpoint, float(weight or 1)))
+    if not weights:
+        raise ValueError(f"空的端點組合: {mix}")
+    return weights
+
+
+def parse_slo(slo: str) -> List[Tuple[Optional[str], float, float]]:
+    """解析 SLO：[端點:]pXX=毫秒，以逗號分隔"""
+    targets = []
+    for item in filter(None, (part.strip() for part in slo.split(","))):
+        scope, _, target = item.rpartition(":")
+        name, _, limit = target.partition("=")
+        if not name.startswith("p") or not limit or (scope and scope not in ENDPOINTS):
+            raise ValueError(f"無效的 SLO: {item}（例如 p99=1500 或 chat:p50=600）")
+        targets.append((scope or None, float(name[1:]), float(limit)))
+    return targets
+
+
+class LoadTest:
+    """開放迴路負載產生器"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.client = HttpClient(args.url)
+        self.mix = parse_mix(args.mix)
+        self.rng = random.Random(args.seed)
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.stats = {endpoint: EndpointStats() for endpoint, _ in self.mix}
+        self.max_lag = 0.0
+        self.sent = 0
+
+    def arrivals(self) -> List[float]:
+        """各請求相對於開始時間的排定送出時間"""
+        total_seconds = self.args.warmup + self.args.duration
+        offsets = []
+        offset = 0.0
+        while True:
+            if self.args.arrival == "poisson":
+                offset += self.rng.expovariate(self.args.rps)
+            else:
+                offset = len(offsets) / self.args.rps
+            if offset >= total_seconds:
+                return offsets
+            offsets.append(offset)
+
+    async def fire(self, endpoint: str, scheduled: float, measured: bool):
+        """送出一個請求並記錄結果"""
+        loop = asyncio.get_running_loop()
+        payload = build_payload(endpoint, self.rng)
+        async with self.semaphore:
+            sent = loop.time()
+            try:
+                status, headers, _ = await asyncio.wait_for(
+                    self.client.request("POST", ENDPOINTS[endpoint], payload),
+                    self.args.timeout
+                )
+                error = None if status < 400 else f"http_{status}"
+                mock_delay = float(headers["x-mock-delay"]) if "x-mock-delay" in headers else None
+            except asyncio.TimeoutError:
+                error = "timeout"
+            except Exception as e:
+                error = type(e).__name__
+            finished = loop.time()
+
+        if not measured:
+            return
+        stats = self.stats[endpoint]
+        if error is None:
+            stats.ok += 1
+            stats.latency.record((finished - scheduled) * 1e6)
+            stats.service.record((finished - sent) * 1e6)
+            if mock_delay is not None:
+                stats.overhead.record((finished - sent - mock_delay) * 1e6)
+        else:
+            stats.record_error(error)
+
+    async def run(self) -> float:
+        """執行負載，回傳量測期間的秒數"""
+        loop = asyncio.get_running_loop()
+        endpoints = [endpoint for endpoint, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        tasks = []
+
+        start = loop.time() + 0.1
+        for offset in self.arrivals():
+            scheduled = start + offset
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # 送出時間落後表示客戶端本身已飽和，結果不可信
+                self.max_lag = max(self.max_lag, -delay)
+            endpoint = self.rng.choices(endpoints, weights)[0]
+            tasks.append(asyncio.ensure_future(self.fire(endpoint, scheduled, offset >= self.args.warmup)))
+            self.sent += 1
+
+        await asyncio.gather(*tasks)
+        await self.client.close()
+        return max(loop.time() - (start + self.args.warmup), 1e-9)
+
+
+async def set_backend(client: HttpClient, payload: Dict[str, Any]) -> Optional[Dict]:
+    """切換簡化伺服器的模擬後端（實際伺服器沒有此端點時回傳 None）"""
+    try:
+        status, _, content = await client.request("PUT", "/api/mock/backend", payload)
+    except (ConnectionError, OSError) as e:
+        print(f"❌ 無法連接到伺服器: {e}")
+        sys.exit(2)
+    if status == 400:
+        print(f"❌ 模擬後端設定錯誤: {json.loads(content)['detail']}")
+        sys.exit(2)
+    return json.loads(content) if status == 200 else None
+
+
+def summarize(name: str, stats: EndpointStats, elapsed: float) -> Dict[str, Any]:
+    """端點的統計摘要（延遲為毫秒）"""
+    return {
+        "endpoint": name,
+        "requests": stats.requests,
+        "ok": stats.ok,
+        "errors": stats.errors,
+        "error_rate": sum(stats.errors.values()) / stats.requests if stats.requests else 0.0,
+        "throughput_rps": stats.ok / elapsed,
+        "latency_ms": {f"p{p:g}": stats.latency.percentile(p) / 1000 for p in PERCENTILES},
+        "latency_mean_ms": stats.latency.mean / 1000,
+        "service_ms": {f"p{p:g}": stats.service.percentile(p) / 1000 for p in PERCENTILES},
+        "overhead_ms": (
+            {f"p{p:g}": stats.overhead.percentile(p) / 1000 for p in PERCENTILES} if stats.overhead.total else None
+        ),
+    }
+
+
+def print_report(rows: List[Dict[str, Any]]):
+    """輸出統計表"""
+    columns = "".join(f"{f'p{p:g}':>10}" for p in PERCENTILES)
+    print(f"\n{'端點':<8}{'請求數':>8}{'錯誤率':>9}{'req/s':>9}{columns}   (延遲 ms)")
+    for row in rows:
+        values = "".join(f"{value:>10.1f}" for value in row["latency_ms"].values())
+        print(f"{row['endpoint']:<8}{row['requests']:>8}{row['error_rate']:>9.2%}{row['throughput_rps']:>9.1f}{values}")
+        if row["errors"]:
+            print(f"{'':<8}錯誤: {', '.join(f'{kind} x{count}' for kind, count in row['errors'].items())}")
+
+    print(f"\n{'端點':<8}{'服務時間 p50':>14}{'p99':>10}{'框架開銷 p50':>14}{'p99':>10}{'p99.9':>10}   (ms)")
+    for row in rows:
+        overhead = row["overhead_ms"]
+        overhead_columns = (
+            f"{overhead['p50']:>14.2f}{overhead['p99']:>10.2f}{overhead['p99.9']:>10.2f}"
+            if overhead else f"{'-':>14}{'-':>10}{'-':>10}"
+        )
+        print(f"{row['endpoint']:<8}{row['service_ms']['p50']:>14.1f}{row['service_ms']['p99']:>10.1f}{overhead_columns}")
+
+
+def check_slo(rows: List[Dict[str, Any]], targets, max_error_rate: Optional[float]) -> List[str]:
+    """檢查 SLO，回傳未達成的項目"""
+    violations = []
+    for row in rows:
+        for scope, percentile, limit in targets:
+            if scope not in (None, row["endpoint"]) or row["endpoint"] == "total":
+                continue
+            hdr = row["_latency"]
+            value = hdr.percentile(percentile) / 1000
+            if value > limit:
+                violations.append(f"{row['endpoint']} p{percentile:g} = {value:.1f} ms > {limit:g} ms")
+        if max_error_rate is not None and row["error_rate"] > max_error_rate:
+            violations.append(f"{row['endpoint']} 錯誤率 {row['error_rate']:.2%} > {max_error_rate:.2%}")
+    return violations
+
+
+async def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="HTTP API 負載測試與延遲 SLO 基準")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--rps", type=float, default=20.0, help="目標每秒請求數（開放迴路）")
+    parser.add_argument("--duration", type=float, default=30.0, help="量測秒數")
+    parser.add_argument("--warmup", type=float, default=5.0, help="預熱秒數（不計入統計）")
+    parser.add_argument("--concurrency", type=int, default=64, help="同時進行中的請求上限")
+    parser.add_argument("--mix", default="mixed", help=f"端點組合：{', '.join(PROFILES)} 或 chat=5,rag=3,tekla=2")
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--backend", help="模擬後端（default / zero / gpu 或 chat=lognormal:0.5:0.4,...），只適用簡化伺服器")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模擬後端的錯誤比例")
+    parser.add_argument("--slo", default="", help="延遲 SLO（毫秒），例如 p99=1500,chat:p50=600")
+    parser.add_argument("--max-error-rate", type=float, help="可接受的錯誤率，例如 0.01")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", help="將結果寫入 JSON 檔案")
+    args = parser.parse_args()
+
+    try:
+        targets = parse_slo(args.slo)
+        test = LoadTest(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.backend:
+        control = HttpClient(args.url)
+        config = await set_backend(control, {"backend": args.backend, "error_rate": args.error_rate})
+        await control.close()
+        if config is None:
+            print("⚠️ 伺服器不支援模擬後端設定，使用目前的後端")
+        else:
+            latency = ", ".join(f"{name}={item['spec']}" for name, item in config["latency"].items())
+            print(f"🔧 模擬後端: {config['backend']} ({latency})")
+
+    print(
+        f"🚀 {args.url} 開放迴路 {args.rps:g} req/s（{args.arrival}），並行上限 {args.concurrency}，"
+        f"組合 {args.mix}，預熱 {args.warmup:g}s + 量測 {args.duration:g}s"
+    )
+    started = time.perf_counter()
+    elapsed = await test.run()
+    print(f"   共送出 {test.sent} 個請求，耗時 {time.perf_counter() - started:.1f}s")
+    if test.max_lag > 0.01:
+        print(f"⚠️ 客戶端送出時間最多落後 {test.max_lag * 1000:.0f} ms，負載產生器可能已飽和")
+
+    total = EndpointStats()
+    rows = []
+    for endpoint, stats in test.stats.items():
+        total.ok += stats.ok
+        for kind, count in stats.errors.items():
+            total.errors[kind] = total.errors.get(kind, 0) + count
+        total.latency.merge(stats.latency)
+        total.service.merge(stats.service)
+        total.overhead.merge(stats.overhead)
+        rows.append({**summarize(endpoint, stats, elapsed), "_latency": stats.latency})
+    if len(rows) > 1:
+        rows.append({**summarize("total", total, elapsed), "_latency": total.latency})
+
+    print_report(rows)
+
+    violations = check_slo(rows, targets, args.max_error_rate)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "config": vars(args),
+                "elapsed_seconds": elapsed,
+                "client_max_lag_seconds": test.max_lag,
+                "results": [{k: v for k, v in row.items() if not k.startswith("_")} for row in rows],
+                "slo_violations": violations
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 結果已寫入 {args.json}")
+
+    if targets or args.max_error_rate is not None:
+        if violations:
+            print("\n❌ 未達成 SLO:")
+            for violation in violations:
+                print(f"   {violation}")
+            sys.exit(1)
+        print("\n✅ 所有 SLO 均達成")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,313 @@
+"""
+准入控制
+每個端點（與共用的生成資源）有各自的並行上限與有界的優先順序佇列：
+互動請求排在批次/自動化請求之前，排隊超過期限、佇列已滿或預估等待超過期限時立即拒絕，
+由伺服器回傳 429 與 Retry-After，避免批次工作拖慢互動聊天或耗盡 GPU 記憶體。
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from services.telemetry import LATENCY_BUCKETS
+
+# 數字越小越優先
+PRIORITIES = {"interactive": 0, "normal": 1, "batch": 2}
+
+# 名稱=並行上限:佇列長度:排隊期限（秒）
+DEFAULT_LIMITS = (
+    "generation=8:64:30,"  # 共用的生成資源（GPU），對應批次排程器的批次大小
+    "chat=8:64:30,"
+    "tekla=6:64:60,"  # 保留生成名額給聊天
+    "rag=32:256:5"
+)
+
+# 端點依序經過的限制（先端點本身，再共用資源）
+DEFAULT_ROUTES = {
+    "chat": ("chat", "generation"),
+    "tekla": ("tekla", "generation"),
+    "rag": ("rag",)
+}
+
+QUEUE_DEPTH = Gauge(
+    "ai_admission_queue_depth", "准入佇列中等待的請求數", ["limiter"]
+)
+IN_FLIGHT = Gauge(
+    "ai_admission_in_flight", "已准入、處理中的請求數", ["limiter"]
+)
+WAIT_SECONDS = Histogram(
+    "ai_admission_wait_seconds", "准入前的排隊時間", ["limiter", "priority"], buckets=LATENCY_BUCKETS
+)
+REJECTED = Counter(
+    "ai_admission_rejected", "被拒絕的請求數", ["limiter", "reason"]
+)
+
+
+def parse_priority(value: Optional[str], default: str = "normal") -> str:
+    """驗證優先順序名稱（None 表示使用預設值）"""
+    priority = (value or default).strip().lower()
+    if priority not in PRIORITIES:
+        raise ValueError(f"未知的優先順序: {value}（可用: {', '.join(PRIORITIES)}）")
+    return priority
+
+
+class AdmissionRejected(RuntimeError):
+    """請求未被准入（佇列已滿、被較高優先順序取代或排隊逾時）"""
+
+    def __init__(self, message: str, limiter: str, reason: str, retry_after: int):
+        super().__init__(message)
+        self.limiter = limiter
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """佇列中的請求"""
+
+    def __init__(self, priority: str, sequence: int):
+        self.priority = priority
+        self.sequence = sequence
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (PRIORITIES[self.priority], self.sequence) < (PRIORITIES[other.priority], other.sequence)
+
+
+class AdmissionLimiter:
+    """單一資源的並行上限與有界優先順序佇列
+
+    名額釋放時直接交給佇列中最優先的請求；佇列已滿時，較高優先順序的新請求取代最低優先順序的等待者。
+    以處理時間的指數移動平均估計等待時間，用於提前拒絕與 Retry-After。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        if max_concurrency < 1 or max_queue < 0 or queue_timeout <= 0:
+            raise ValueError(f"無效的准入限制 {name}: {max_concurrency}:{max_queue}:{queue_timeout}")
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.service_seconds: Optional[float] = None  # 處理時間的指數移動平均
+        self._queue: List[_Waiter] = []
+        self._sequence = itertools.count()
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_full": 0,
+            "rejected_estimate": 0,
+            "shed": 0,
+            "timeouts": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0
+        }
+        QUEUE_DEPTH.labels(name).set_function(lambda: len(self._queue))
+        IN_FLIGHT.labels(name).set_function(lambda: self.active)
+
+    def estimated_wait(self, position: int) -> Optional[float]:
+        """排在第 position 位（0 起算）的請求預估等待時間；尚無處理時間資料時回傳 None"""
+        if self.service_seconds is None:
+            return None
+        return (position // self.max_concurrency + 1) * self.service_seconds
+
+    def retry_after(self) -> int:
+        """建議的重試間隔（秒）：目前佇列預估排空的時間"""
+        estimate = self.estimated_wait(len(self._queue))
+        if estimate is None:
+            return 1
+        return max(math.ceil(min(estimate, self.queue_timeout)), 1)
+
+    def _reject(self, reason: str, message: str) -> AdmissionRejected:
+        """建立拒絕錯誤並記錄"""
+        REJECTED.labels(self.name, reason).inc()
+        return AdmissionRejected(f"{self.name}: {message}", self.name, reason, self.retry_after())
+
+    async def acquire(self, priority: str = "normal"):
+        """取得名額，無法准入時拋出 AdmissionRejected"""
+        if self.active < self.max_concurrency and not self._queue:
+            self.active += 1
+            self._admitted(priority, 0.0)
+            return
+
+        worst = None
+        if len(self._queue) >= self.max_queue:
+            worst = max(self._queue) if self._queue else None
+            if worst is None or PRIORITIES[worst.priority] <= PRIORITIES[priority]:
+                self.stats["rejected_full"] += 1
+                raise self._reject("queue_full", "佇列已滿")
+
+        # 先確認新請求能在期限內准入，才取代其他等待者（被取代者的優先順序較低，不影響排序位置）
+        waiter = _Waiter(priority, next(self._sequence))
+        position = sum(1 for other in self._queue if other < waiter)
+        estimate = self.estimated_wait(position)
+        if estimate is not None and estimate > self.queue_timeout:
+            self.stats["rejected_estimate"] += 1
+            raise self._reject("estimated_wait", f"預估等待 {estimate:.1f} 秒，超過期限 {self.queue_timeout} 秒")
+
+        if worst is not None:
+            # 取代最低優先順序（同級中最晚加入）的等待者
+            self._remove(worst)
+            self.stats["shed"] += 1
+            worst.future.set_exception(self._reject("shed", "被較高優先順序的請求取代"))
+
+        heapq.heappush(self._queue, waiter)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # 逾時的同時剛好取得名額時視為准入
+            if not self._granted(waiter):
+                self._remove(waiter)
+                self.stats["timeouts"] += 1
+                raise self._reject("timeout", f"排隊超過 {self.queue_timeout} 秒") from None
+        except asyncio.CancelledError:
+            # 呼叫端取消（例如客戶端斷線）；名額若已交付則歸還
+            if self._granted(waiter):
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+        self._admitted(priority, time.perf_counter() - waiter.enqueued_at)
+
+    @staticmethod
+    def _granted(waiter: _Waiter) -> bool:
+        """等待者是否已取得名額"""
+        return waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None
+
+    def _remove(self, waiter: _Waiter):
+        """從佇列移除等待者"""
+        if waiter in self._queue:
+            self._queue.remove(waiter)
+            heapq.heapify(self._queue)
+
+    def _admitted(self, priority: str, waited: float):
+        """記錄准入與排隊時間"""
+        self.stats["admitted"] += 1
+        self.stats["wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+        WAIT_SECONDS.labels(self.name, priority).observe(waited)
+
+    def release(self, service_seconds: Optional[float] = None):
+        """歸還名額（直接交給佇列中最優先的請求）並更新處理時間估計"""
+        if service_seconds is not None:
+            if self.service_seconds is None:
+                self.service_seconds = service_seconds
+            else:
+                self.service_seconds = 0.8 * self.service_seconds + 0.2 * service_seconds
+        while self._queue:
+            waiter = heapq.heappop(self._queue)
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+                return
+        self.active -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取限制與佇列統計"""
+        admitted = self.stats["admitted"]
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.active,
+            "queue_depth": len(self._queue),
+            "queue_by_priority": {
+                priority: sum(1 for waiter in self._queue if waiter.priority == priority) for priority in PRIORITIES
+            },
+            "service_seconds": round(self.service_seconds, 4) if self.service_seconds is not None else None,
+            **self.stats,
+            "wait_seconds": round(self.stats["wait_seconds"], 4),
+            "max_wait_seconds": round(self.stats["max_wait_seconds"], 4),
+            "mean_wait_seconds": round(self.stats["wait_seconds"] / admitted, 4) if admitted else 0.0
+        }
+
+
+class Admission:
+    """已准入的請求，處理完成後呼叫 release（可重複呼叫）"""
+
+    def __init__(self, limiters: Sequence[AdmissionLimiter]):
+        self.limiters = limiters
+        self.started = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        """歸還所有名額"""
+        if self.released:
+            return
+        self.released = True
+        elapsed = time.perf_counter() - self.started
+        for limiter in reversed(self.limiters):
+            limiter.release(elapsed)
+
+    async def __aenter__(self) -> "Admission":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """依端點套用准入限制
+
+    limits 格式與 DEFAULT_LIMITS 相同（只需列出要變更的項目）；routes 指定每個端點依序經過的限制，
+    未列出的端點不受限制。多工作程序部署時 limits 為整個伺服器的總量，每個工作程序分得 1/workers（至少 1）。
+    """
+
+    def __init__(self, limits: str = "", routes: Optional[Dict[str, Sequence[str]]] = None, workers: int = 1):
+        self.workers = max(workers, 1)
+        self.limiters: Dict[str, AdmissionLimiter] = {}
+        for spec in (DEFAULT_LIMITS, limits):
+            self.limiters.update(self._parse(spec, self.workers))
+        self.routes = dict(DEFAULT_ROUTES if routes is None else routes)
+        for endpoint, names in self.routes.items():
+            for name in names:
+                if name not in self.limiters:
+                    raise ValueError(f"端點 {endpoint} 使用未定義的限制: {name}")
+
+    @staticmethod
+    def _parse(spec: str, workers: int = 1) -> Dict[str, AdmissionLimiter]:
+        """解析「名稱=並行上限:佇列長度:排隊期限」設定（並行上限與佇列長度依工作程序數平分）"""
+        limiters = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, separator, values = item.partition("=")
+            parts = values.split(":")
+            if not separator or len(parts) != 3:
+                raise ValueError(f"無效的准入設定: {item}（格式: 名稱=並行上限:佇列長度:排隊期限）")
+            try:
+                limiters[name.strip()] = AdmissionLimiter(
+                    name.strip(),
+                    math.ceil(int(parts[0]) / workers),
+                    math.ceil(int(parts[1]) / workers),
+                    float(parts[2])
+                )
+            except ValueError as e:
+                raise ValueError(f"無效的准入設定: {item}（{e}）") from None
+        return limiters
+
+    async def acquire(self, endpoint: str, priority: str = "normal") -> Admission:
+        """依序取得端點路徑上的名額，任一限制拒絕時歸還已取得的名額並拋出 AdmissionRejected"""
+        acquired: List[AdmissionLimiter] = []
+        try:
+            for name in self.routes.get(endpoint, ()):
+                limiter = self.limiters[name]
+                await limiter.acquire(priority)
+                acquired.append(limiter)
+        except BaseException:
+            for limiter in reversed(acquired):
+                limiter.release()
+            raise
+        return Admission(acquired)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各限制的統計"""
+        return {
+            "workers": self.workers,
+            "priorities": list(PRIORITIES),
+            "routes": {endpoint: list(names) for endpoint, names in self.routes.items()},
+            "limiters": {name: limiter.get_stats() for name, limiter in self.limiters.items()}
+        }
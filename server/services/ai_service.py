@@ -4,19 +4,81 @@ AI 服務模組
 """
 
 import asyncio
+import functools
 import logging
-import torch
-from typing import Optional, Dict, Any, List
-from transformers import (
-    AutoTokenizer, 
-    AutoModelForCausalLM, 
-    GenerationConfig,
-    BitsAndBytesConfig
-)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Optional, Dict, Any, List, Set, Tuple, Union
 import gc
+import json
+
+from services.batch_scheduler import ContinuousBatchScheduler
+from services.code_stopping import CodeStopScanner, CodeStoppingCriteria, default_stop_options, trim_code_output
+from services.cpu_backend import configure_cpu_threads, model_size_mb, quantize_dynamic_int8
+from services.inference_server import RemoteInferenceWorker
+from services.inference_worker import InferenceWorker
+from services.model_pool import ModelPool
+from services.kv_cache_utils import cache_to_layers, clone_layers, layers_seq_length, layers_to_cache
+from services.prefix_cache import PrefixKVCache
+from services.prompt_assembler import ContextInput, PromptAssembler, context_text
+from services.response_cache import ResponseCache, response_key
+from services.session_cache import SessionHistory, SessionKVCache
+from services.single_flight import SingleFlight, flight_key
+from services.speculative import ForwardCounter, SpeculativeDecodingStats
+from services.streaming import CancellationCriteria, IncrementalDecoder, TokenStreamer
+from services.telemetry import GenerationTelemetry, peak_memory_bytes, record_failure, reset_peak_memory
+from utils.startup_timer import startup_timer
+
+# torch / transformers 匯入耗時，延後到初始化時才載入
+if TYPE_CHECKING:
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
 
 logger = logging.getLogger(__name__)
 
+# 預設系統提示詞
+DEFAULT_SYSTEM_PROMPT = """你是一個專業的 Tekla Structures 建模助手，具備以下能力：
+1. 理解建築和結構工程概念
+2. 熟悉 Tekla Structures 2025 Open API
+3. 能夠生成準確的 C# 代碼
+4. 提供詳細的技術說明
+
+請用繁體中文回答，並確保代碼的正確性和實用性。"""
+
+# 代碼生成預設的停止字串（模型自行續寫下一輪對話時停止）
+DEFAULT_STOP_SEQUENCES = ["\n### 用戶", "\n### 系統"]
+
+# 只輸出代碼模式附加的指示
+CODE_ONLY_INSTRUCTION = "只輸出一個 C# 代碼區塊，不需要說明。"
+
+# Tekla 代碼生成專用系統提示詞
+TEKLA_CODE_SYSTEM_PROMPT = """你是一個 Tekla Structures 2025 Open API 專家。請根據用戶需求生成準確的 C# 代碼。
+
+要求：
+1. 使用正確的 Tekla API 命名空間
+2. 包含必要的 using 語句
+3. 添加適當的錯誤處理
+4. 提供清晰的註解
+5. 確保代碼可以直接在 Tekla 中執行
+
+可用的主要命名空間：
+- Tekla.Structures.Model
+- Tekla.Structures.Geometry3d
+- Tekla.Structures.Catalogs
+- Tekla.Structures.Dialog
+- Tekla.Structures.Drawing"""
+
+def _routed(method: Callable) -> Callable:
+    """模型熱切換後，將請求轉交給目前提供服務的實例"""
+    @functools.wraps(method)
+    def wrapper(self: "AIService", *args, **kwargs):
+        if self._active is not None:
+            return getattr(self._active, method.__name__)(*args, **kwargs)
+        return method(self, *args, **kwargs)
+    return wrapper
+
 class AIService:
     """AI 服務類別，管理 DeepSeek-Coder 模型"""
     
@@ -24,66 +86,209 @@ class AIService:
         self, 
         model_name: str = "deepseek-ai/deepseek-coder-6.7b-instruct",
         device_map: str = "auto",
-        torch_dtype: torch.dtype = torch.float16,
+        torch_dtype: Optional["torch.dtype"] = None,
         load_in_8bit: bool = False,
-        load_in_4bit: bool = False
+        load_in_4bit: bool = False,
+        warmup: bool = True,
+        enable_batching: bool = False,
+        max_batch_size: int = 8,
+        enable_prefix_cache: bool = True,
+        prefix_cache_max_mb: int = 512,
+        enable_response_cache: bool = False,
+        response_cache_path: str = "data/cache/response_cache.db",
+        response_cache_ttl: float = 24 * 3600,
+        response_cache_max_entries: int = 1000,
+        draft_model_name: Optional[str] = None,
+        speculative_by_default: bool = True,
+        num_assistant_tokens: int = 5,
+        use_worker_process: bool = False,
+        max_queue_size: int = 64,
+        request_timeout: Optional[float] = None,
+        replica_devices: Optional[List[str]] = None,
+        replica_threads: Optional[int] = None,
+        max_prompt_tokens: Optional[int] = 4096,
+        cpu_int8: bool = False,
+        cpu_threads: Optional[int] = None,
+        code_stopping: bool = True,
+        stop_sequences: Optional[List[str]] = None,
+        enable_session_cache: bool = True,
+        session_cache_max_mb: int = 1024,
+        max_sessions: int = 1000,
+        enable_coalescing: bool = True,
+        coalesce_max_temperature: float = 0.3,
+        inference_address: Optional[str] = None,
+        inference_authkey: Optional[str] = None
     ):
+        # 模型熱切換時以相同參數（加上變更）建立新實例
+        self._init_kwargs = {key: value for key, value in locals().items() if key != "self"}
         self.model_name = model_name
         self.device_map = device_map
-        self.torch_dtype = torch_dtype
+        self.torch_dtype = torch_dtype  # None 表示 GPU 用 torch.float16、CPU 用 torch.float32
         self.load_in_8bit = load_in_8bit
         self.load_in_4bit = load_in_4bit
+        self.warmup = warmup
+        self.enable_batching = enable_batching
+        self.max_batch_size = max_batch_size
+        self.enable_prefix_cache = enable_prefix_cache
+        self.prefix_cache_max_mb = prefix_cache_max_mb
+        self.enable_response_cache = enable_response_cache
+        self.response_cache_path = response_cache_path
+        self.response_cache_ttl = response_cache_ttl
+        self.response_cache_max_entries = response_cache_max_entries
+        self.draft_model_name = draft_model_name  # 同一 tokenizer 家族的小模型，例如 deepseek-coder-1.3b
+        self.speculative_by_default = speculative_by_default
+        self.num_assistant_tokens = num_assistant_tokens
+        self.use_worker_process = use_worker_process  # 在子程序中載入模型，隔離崩潰
+        self.max_queue_size = max_queue_size
+        self.request_timeout = request_timeout  # 預設每個請求的生成期限（秒）
+        self.replica_devices = replica_devices  # 例如 ["cuda:0", "cuda:1"]，設定後以多副本工作程序池推論
+        self.replica_threads = replica_threads
+        self.max_prompt_tokens = max_prompt_tokens  # 提示詞 token 預算，None 表示不限制
+        self.cpu_int8 = cpu_int8  # CPU 後端：以 int8 動態量化載入模型
+        self.cpu_threads = cpu_threads
+        self.code_stopping = code_stopping  # 代碼生成在代碼完整後提前停止
+        self.stop_sequences = DEFAULT_STOP_SEQUENCES if stop_sequences is None else stop_sequences
+        self.enable_session_cache = enable_session_cache  # 多輪對話逐輪延續 KV 快取
+        self.session_cache_max_mb = session_cache_max_mb
+        self.enable_coalescing = enable_coalescing  # 合併進行中的相同請求（見 _coalesce_key）
+        self.coalesce_max_temperature = coalesce_max_temperature
+        # 多工作程序部署：連線到中央推論伺服器（見 services.inference_server），本程序只載入 tokenizer
+        self.inference_address = inference_address
+        self.inference_authkey = inference_authkey
         
-        self.tokenizer: Optional[AutoTokenizer] = None
-        self.model: Optional[AutoModelForCausalLM] = None
-        self.generation_config: Optional[GenerationConfig] = None
+        self.tokenizer: Optional["AutoTokenizer"] = None
+        self.model: Optional["AutoModelForCausalLM"] = None
+        self.generation_config: Optional["GenerationConfig"] = None
+        self.scheduler: Optional[ContinuousBatchScheduler] = None
+        self.prefix_cache: Optional[PrefixKVCache] = None
+        self.prompt_assembler: Optional[PromptAssembler] = None
+        self.response_cache: Optional[ResponseCache] = None
+        self.session_history = SessionHistory(max_sessions)
+        self.session_cache: Optional[SessionKVCache] = None
+        self.single_flight = SingleFlight("generation")
+        self.draft_model: Optional["AutoModelForCausalLM"] = None
+        self.speculative_stats = SpeculativeDecodingStats()
+        self._forward_counters: Dict[str, ForwardCounter] = {}
+        self.worker: Optional[Union[InferenceWorker, ModelPool]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending_requests = 0
         self.is_initialized = False
         
-        # 設定量化配置
+        # 模型熱切換：切換後的請求轉交 _active，本實例在進行中的請求完成後釋放
+        self._active: Optional["AIService"] = None
+        self._inflight = 0
+        self._generations: Set["asyncio.Future"] = set()  # 進行中的生成，排空逾時時中止
+        self._record_startup = True
+        self._swap_status: Dict[str, Any] = {"state": "idle", "swaps": 0}
+        self._draining: Optional["AIService"] = None
+        
+        # 量化配置在初始化時建立（需要 transformers）
         self.quantization_config = None
-        if load_in_4bit:
-            self.quantization_config = BitsAndBytesConfig(
+    
+    def _build_quantization_config(self):
+        """建立量化配置"""
+        from transformers import BitsAndBytesConfig
+        
+        if self.load_in_4bit:
+            return BitsAndBytesConfig(
                 load_in_4bit=True,
-                bnb_4bit_compute_dtype=torch_dtype,
+                bnb_4bit_compute_dtype=self.torch_dtype,
                 bnb_4bit_use_double_quant=True,
                 bnb_4bit_quant_type="nf4"
             )
-        elif load_in_8bit:
-            self.quantization_config = BitsAndBytesConfig(
+        if self.load_in_8bit:
+            return BitsAndBytesConfig(
                 load_in_8bit=True
             )
+        return None
     
     async def initialize(self):
         """初始化 AI 模型"""
         try:
-            logger.info(f"開始載入 AI 模型: {self.model_name}")
+            with self._startup_phase("import"):
+                import torch
+                from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
             
-            # 載入 tokenizer
-            logger.info("載入 tokenizer...")
-            self.tokenizer = AutoTokenizer.from_pretrained(
-                self.model_name,
-                trust_remote_code=True,
-                padding_side="left"
-            )
+            # bitsandbytes 需要 CUDA，純 CPU 節點改用 int8 動態量化
+            if not torch.cuda.is_available() and (self.load_in_8bit or self.load_in_4bit):
+                logger.warning("bitsandbytes 量化需要 CUDA，改用 CPU int8 動態量化")
+                self.load_in_8bit = self.load_in_4bit = False
+                self.cpu_int8 = True
             
-            # 設定 pad_token
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
-            
-            # 載入模型
-            logger.info("載入模型...")
-            model_kwargs = {
-                "pretrained_model_name_or_path": self.model_name,
-                "torch_dtype": self.torch_dtype,
-                "device_map": self.device_map,
-                "trust_remote_code": True,
-                "low_cpu_mem_usage": True
-            }
+            if self.cpu_int8:
+                self.device_map = "cpu"
+                self.torch_dtype = torch.float32
+            elif self.torch_dtype is None:
+                self.torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+            
+            if self.cpu_threads:
+                configure_cpu_threads(self.cpu_threads)
+            self.quantization_config = self._build_quantization_config()
             
-            if self.quantization_config:
-                model_kwargs["quantization_config"] = self.quantization_config
+            logger.info(f"開始載入 AI 模型: {self.model_name}")
             
-            self.model = AutoModelForCausalLM.from_pretrained(**model_kwargs)
+            with self._startup_phase("model_load"):
+                # 載入 tokenizer
+                logger.info("載入 tokenizer...")
+                self.tokenizer = AutoTokenizer.from_pretrained(
+                    self.model_name,
+                    trust_remote_code=True,
+                    padding_side="left"
+                )
+                
+                # 設定 pad_token
+                if self.tokenizer.pad_token is None:
+                    self.tokenizer.pad_token = self.tokenizer.eos_token
+                self.prompt_assembler = PromptAssembler(self.tokenizer)
+                
+                if self.inference_address:
+                    logger.info(f"連線到中央推論伺服器: {self.inference_address}")
+                    self.worker = RemoteInferenceWorker(
+                        self.inference_address,
+                        self.inference_authkey,
+                        max_queue_size=self.max_queue_size
+                    )
+                    await self.worker.start()
+                elif self.replica_devices:
+                    # 每個裝置一個獨立的推論工作程序
+                    logger.info(f"啟動模型副本池: {', '.join(self.replica_devices)}")
+                    self.worker = ModelPool(
+                        self._worker_service_kwargs(),
+                        self.replica_devices,
+                        max_queue_size=self.max_queue_size,
+                        torch_threads=self.replica_threads
+                    )
+                    await self.worker.start()
+                elif self.use_worker_process:
+                    # 模型（含前綴快取、草稿模型與預熱）在獨立子程序中載入
+                    logger.info("啟動推論工作程序...")
+                    self.worker = InferenceWorker(
+                        self._worker_service_kwargs(),
+                        max_queue_size=self.max_queue_size
+                    )
+                    await self.worker.start()
+                else:
+                    # 載入模型
+                    logger.info("載入模型...")
+                    model_kwargs = {
+                        "pretrained_model_name_or_path": self.model_name,
+                        "torch_dtype": self.torch_dtype,
+                        "device_map": self.device_map,
+                        "trust_remote_code": True,
+                        "low_cpu_mem_usage": True
+                    }
+                
+                    if self.quantization_config:
+                        model_kwargs["quantization_config"] = self.quantization_config
+                
+                    self.model = AutoModelForCausalLM.from_pretrained(**model_kwargs)
+                    
+                    if self.cpu_int8:
+                        self.model = quantize_dynamic_int8(self.model)
+                        logger.info(f"已套用 int8 動態量化 (權重 {model_size_mb(self.model):.1f} MB)")
+                
+                    if self.draft_model_name:
+                        self._load_draft_model()
             
             # 設定生成配置
             self.generation_config = GenerationConfig(
@@ -97,11 +302,51 @@ class AIService:
                 eos_token_id=self.tokenizer.eos_token_id
             )
             
+            # 固定系統提示詞的 KV 快取
+            if self.enable_prefix_cache and self.worker is None:
+                self.prefix_cache = PrefixKVCache(
+                    self.model,
+                    max_bytes=self.prefix_cache_max_mb * 1024 * 1024
+                )
+            
+            # 多輪對話的工作階段 KV 快取（工作程序模式下由子程序保存）
+            if self.enable_session_cache and self.worker is None:
+                self.session_cache = SessionKVCache(max_bytes=self.session_cache_max_mb * 1024 * 1024)
+            
+            # Tekla 代碼生成的確定性回應快取
+            if self.enable_response_cache:
+                self.response_cache = ResponseCache(
+                    self.response_cache_path,
+                    ttl_seconds=self.response_cache_ttl,
+                    max_entries=self.response_cache_max_entries
+                )
+            
+            # 連續批次排程器：並行請求共用解碼步驟
+            if self.enable_batching and self.worker is not None:
+                logger.warning("推論工作程序模式不支援連續批次排程，已停用")
+            elif self.enable_batching:
+                self.scheduler = ContinuousBatchScheduler(
+                    self.model,
+                    self.tokenizer,
+                    max_batch_size=self.max_batch_size,
+                    prefix_cache=self.prefix_cache
+                )
+                logger.info(f"已啟用連續批次排程 (最大批次 {self.max_batch_size})")
+            
+            # 專用推論執行緒：生成不阻塞事件迴圈，並依序使用模型
+            if self.worker is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ai-inference")
+            
+            # 預熱：執行一次極短生成以完成 CUDA kernel 初始化
+            if self.warmup and self.worker is None:
+                with self._startup_phase("warmup"):
+                    self._warmup()
+            
             self.is_initialized = True
             logger.info("✅ AI 模型載入完成")
             
             # 記錄模型資訊
-            if hasattr(self.model, 'get_memory_footprint'):
+            if self.model is not None and hasattr(self.model, 'get_memory_footprint'):
                 memory_mb = self.model.get_memory_footprint() / 1024 / 1024
                 logger.info(f"模型記憶體使用: {memory_mb:.2f} MB")
             
@@ -109,80 +354,831 @@ class AIService:
             logger.error(f"❌ AI 模型載入失敗: {e}")
             raise
     
+    def _startup_phase(self, phase: str):
+        """啟動階段計時（熱切換時的載入不計入啟動報告）"""
+        if self._record_startup:
+            return startup_timer.phase(phase, "ai_service")
+        return nullcontext()
+    
+    async def hot_swap(self, drain_timeout: float = 300.0, **overrides) -> Dict[str, Any]:
+        """不中斷服務地切換模型或量化設定
+
+        以目前的參數加上 overrides（例如 model_name、load_in_4bit、cpu_int8）在背景載入並預熱新模型，
+        完成後新請求立即改由新模型處理；舊模型等進行中的請求完成（最多 drain_timeout 秒）後才釋放。
+        逾時仍未完成的請求會被中止並收到明確的錯誤，待全部結束後才釋放舊模型（期間狀態為 draining_overdue）。
+        載入失敗時繼續使用舊模型並拋出例外。進度可由 get_model_info()["hot_swap"] 查詢。
+        """
+        if self._swap_status["state"] in ("loading", "draining", "draining_overdue"):
+            raise RuntimeError("已有模型切換正在進行")
+        
+        current = self._active or self
+        replacement = AIService(**{**current._init_kwargs, "warmup": True, **overrides})
+        replacement._record_startup = False
+        
+        self._swap_status = {
+            "state": "loading",
+            "swaps": self._swap_status["swaps"],
+            "from_model": current.model_name,
+            "to_model": replacement.model_name,
+            "overrides": {key: str(value) for key, value in overrides.items()},
+            "started_at": time.time(),
+            "load_seconds": None,
+            "drain_seconds": None,
+            "error": None
+        }
+        logger.info(f"開始模型熱切換: {current.model_name} -> {replacement.model_name}")
+        
+        start = time.perf_counter()
+        try:
+            if replacement.inference_address or replacement.replica_devices or replacement.use_worker_process:
+                # 模型在子程序中載入，不會阻塞事件迴圈
+                await replacement.initialize()
+            else:
+                # 同程序載入在背景執行緒中進行，期間舊模型照常服務
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, lambda: asyncio.run(replacement.initialize()))
+        except Exception as e:
+            logger.error(f"模型熱切換失敗，繼續使用 {current.model_name}: {e}")
+            self._swap_status.update(state="failed", error=str(e))
+            await replacement.cleanup()
+            raise
+        self._swap_status["load_seconds"] = round(time.perf_counter() - start, 3)
+        
+        # 相同詞彙表時延續多輪對話
+        if current.tokenizer is not None and replacement.tokenizer.get_vocab() == current.tokenizer.get_vocab():
+            replacement.session_history = current.session_history
+        
+        # 切換：之後的請求都轉交新實例
+        self._active = replacement
+        self._swap_status.update(state="draining", switched_at=time.time())
+        self._draining = current
+        logger.info(f"已切換至 {replacement.model_name}，等待 {current._inflight} 個進行中的請求完成")
+        
+        start = time.perf_counter()
+        deadline = time.monotonic() + drain_timeout
+        while current._inflight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if current._inflight > 0:
+            # 不可在生成進行中釋放模型：先中止剩餘的生成，等呼叫端都結束後再釋放
+            aborted = current._abort_generations()
+            logger.warning(
+                f"舊模型仍有 {current._inflight} 個請求未在 {drain_timeout} 秒內完成，已中止 {aborted} 個生成"
+            )
+            self._swap_status.update(state="draining_overdue", aborted_requests=aborted)
+            while current._inflight > 0:
+                await asyncio.sleep(0.05)
+        
+        if replacement.session_history is current.session_history:
+            current.session_history = SessionHistory(current.session_history.max_sessions)
+        await current._release()
+        self._draining = None
+        
+        self._swap_status.update(
+            state="completed",
+            swaps=self._swap_status["swaps"] + 1,
+            drain_seconds=round(time.perf_counter() - start, 3),
+            completed_at=time.time()
+        )
+        logger.info(f"✅ 模型熱切換完成: {replacement.model_name}")
+        return self.get_swap_status()
+    
+    def _track_generation(self, coroutine) -> "asyncio.Task":
+        """以 task 執行生成並登記為進行中"""
+        generation = asyncio.ensure_future(coroutine)
+        self._generations.add(generation)
+        generation.add_done_callback(self._generations.discard)
+        return generation
+    
+    async def _await_generation(self, generation: "asyncio.Task") -> List[int]:
+        """等待生成結果；呼叫端取消時一併取消生成，生成被熱切換中止時拋出明確的錯誤"""
+        try:
+            return await asyncio.shield(generation)
+        except asyncio.CancelledError:
+            if generation.cancelled():
+                raise RuntimeError("模型已切換，此請求未在排空期限內完成而被中止") from None
+            generation.cancel()
+            raise
+    
+    def _abort_generations(self) -> int:
+        """中止所有進行中的生成，回傳中止的數量"""
+        generations = [generation for generation in self._generations if not generation.done()]
+        for generation in generations:
+            generation.cancel()
+        return len(generations)
+    
+    def get_swap_status(self) -> Dict[str, Any]:
+        """模型熱切換進度"""
+        status = dict(self._swap_status)
+        if status["state"] == "loading":
+            status["elapsed_seconds"] = round(time.time() - status["started_at"], 3)
+        elif status["state"] in ("draining", "draining_overdue") and self._draining is not None:
+            status["draining_requests"] = self._draining._inflight
+        return status
+    
+    def _inference_mode(self) -> str:
+        """目前的推論執行模式"""
+        if isinstance(self.worker, ModelPool):
+            return "pool"
+        if isinstance(self.worker, RemoteInferenceWorker):
+            return "remote"
+        if self.worker is not None:
+            return "process"
+        return "thread"
+    
+    def _worker_service_kwargs(self) -> Dict[str, Any]:
+        """推論工作程序中建立 AIService 的參數"""
+        return {
+            "model_name": self.model_name,
+            "device_map": self.device_map,
+            "torch_dtype": self.torch_dtype,
+            "load_in_8bit": self.load_in_8bit,
+            "load_in_4bit": self.load_in_4bit,
+            "warmup": self.warmup,
+            "enable_prefix_cache": self.enable_prefix_cache,
+            "prefix_cache_max_mb": self.prefix_cache_max_mb,
+            "enable_session_cache": self.enable_session_cache,
+            "session_cache_max_mb": self.session_cache_max_mb,
+            "draft_model_name": self.draft_model_name,
+            "speculative_by_default": self.speculative_by_default,
+            "num_assistant_tokens": self.num_assistant_tokens,
+            "cpu_int8": self.cpu_int8,
+            "cpu_threads": self.cpu_threads
+        }
+    
+    def _load_draft_model(self):
+        """載入推測解碼用的草稿模型（詞表須與主模型一致）"""
+        from transformers import AutoModelForCausalLM
+        
+        logger.info(f"載入草稿模型: {self.draft_model_name}")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            self.draft_model_name,
+            torch_dtype=self.torch_dtype,
+            device_map=self.device_map,
+            trust_remote_code=True,
+            low_cpu_mem_usage=True
+        )
+        if self.cpu_int8:
+            draft_model = quantize_dynamic_int8(draft_model)
+        
+        if draft_model.config.vocab_size != self.model.config.vocab_size:
+            logger.warning(
+                f"草稿模型詞表大小 {draft_model.config.vocab_size} 與主模型 "
+                f"{self.model.config.vocab_size} 不同，停用推測解碼"
+            )
+            return
+        
+        draft_model.generation_config.num_assistant_tokens = self.num_assistant_tokens
+        draft_model.generation_config.num_assistant_tokens_schedule = "heuristic"
+        self.draft_model = draft_model
+        self._forward_counters = {
+            "target": ForwardCounter(self.model),
+            "draft": ForwardCounter(self.draft_model)
+        }
+    
+    def _use_speculative(self, speculative: Optional[bool]) -> bool:
+        """決定請求是否使用推測解碼
+
+        未指定時依 speculative_by_default；啟用連續批次時預設走排程器。
+        """
+        if self.draft_model is None:
+            return False
+        if speculative is None:
+            return self.speculative_by_default and self.scheduler is None
+        return speculative
+    
+    def _warmup(self):
+        """預熱模型"""
+        import torch
+        
+        inputs = self.tokenizer.encode("### 用戶\nhello\n", return_tensors="pt")
+        inputs = inputs.to(self.model.device)
+        with torch.no_grad():
+            self.model.generate(
+                inputs,
+                max_new_tokens=1,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id
+            )
+    
+    @_routed
     async def generate_response(
         self,
         message: str,
-        context: Optional[str] = None,
+        context: ContextInput = None,
         temperature: float = 0.7,
         max_tokens: int = 2048,
-        system_prompt: Optional[str] = None
+        system_prompt: Optional[str] = None,
+        do_sample: bool = True,
+        speculative: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None
     ) -> str:
-        """生成 AI 回應"""
+        """生成 AI 回應
+
+        do_sample=False 時為貪婪解碼，結果可重現；speculative 指定是否以草稿模型做推測解碼
+        （None 表示依服務預設）；timeout 為生成期限（秒），超過時拋出 TimeoutError；
+        傳入 telemetry 時會填入本次請求的 token 數與各階段耗時（context 經 RAGService.compress_results
+        壓縮時另含壓縮比例與估計省下的預填時間）；
+        stop 為代碼停止選項（見 code_stopping.default_stop_options），達到時提前結束並裁切輸出；
+        session_id 讓多輪對話延續同一工作階段，只需預填新一輪的內容。
+        貪婪解碼或低溫度的請求與進行中的相同請求合併，共用一次生成（遙測為共用生成的資料）。
+        """
         if not self.is_ready():
             raise RuntimeError("AI 服務未就緒")
         
+        if telemetry is None:
+            telemetry = GenerationTelemetry()
+        options = {
+            "message": message,
+            "context": context,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "system_prompt": system_prompt,
+            "do_sample": do_sample,
+            "speculative": speculative,
+            "timeout": timeout,
+            "stop": stop,
+            "session_id": session_id
+        }
+        key = self._coalesce_key(options)
+        if key is None:
+            return await self._generate_response(**options, telemetry=telemetry)
+        
+        async def shared() -> Tuple[str, GenerationTelemetry]:
+            shared_telemetry = GenerationTelemetry(submitted_at=telemetry.submitted_at)
+            return await self._generate_response(**options, telemetry=shared_telemetry), shared_telemetry
+        
+        text, shared_telemetry = await self.single_flight.do(key, shared)
+        telemetry.copy_from(shared_telemetry)
+        return text
+    
+    async def _generate_response(
+        self,
+        message: str,
+        context: ContextInput,
+        temperature: float,
+        max_tokens: int,
+        system_prompt: Optional[str],
+        do_sample: bool,
+        speculative: Optional[bool],
+        timeout: Optional[float],
+        telemetry: GenerationTelemetry,
+        stop: Optional[Dict[str, Any]],
+        session_id: Optional[str]
+    ) -> str:
+        """生成一次回應（generate_response 的實作）"""
+        self._inflight += 1
         try:
-            # 構建提示詞
-            prompt = self._build_prompt(message, context, system_prompt)
+            # 構建並編碼提示詞
+            input_ids, prefix_length = self._encode_request(message, context, system_prompt, session_id)
+            self._record_compression(context, telemetry)
             
-            # 編碼輸入
-            inputs = self.tokenizer.encode(prompt, return_tensors="pt")
-            
-            # 移動到正確的設備
-            if torch.cuda.is_available():
-                inputs = inputs.to(self.model.device)
-            
-            # 更新生成配置
-            generation_config = GenerationConfig(
-                **self.generation_config.to_dict(),
-                temperature=temperature,
-                max_new_tokens=min(max_tokens, 2048)
-            )
-            
-            # 生成回應
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs,
-                    generation_config=generation_config,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    do_sample=True
-                )
+            generation = self._track_generation(self._generate_ids(
+                input_ids,
+                prefix_length,
+                temperature,
+                max_tokens,
+                do_sample=do_sample,
+                speculative=speculative,
+                timeout=timeout,
+                telemetry=telemetry,
+                stop=stop,
+                session_id=session_id
+            ))
+            output_ids = await self._await_generation(generation)
+            self._record_turn(session_id, input_ids, output_ids, prefix_length, system_prompt)
             
             # 解碼回應
-            response = self.tokenizer.decode(
-                outputs[0][inputs.shape[1]:], 
-                skip_special_tokens=True
-            )
-            
-            # 清理記憶體
-            del inputs, outputs
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            return response.strip()
+            text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            if stop:
+                text = trim_code_output(text, **stop)
+            return text.strip()
             
         except Exception as e:
             logger.error(f"生成回應時發生錯誤: {e}")
             raise
+        finally:
+            self._inflight -= 1
+    
+    @_routed
+    async def stream_response(
+        self,
+        message: str,
+        context: ContextInput = None,
+        temperature: float = 0.7,
+        max_tokens: int = 2048,
+        system_prompt: Optional[str] = None,
+        do_sample: bool = True,
+        timeout: Optional[float] = None,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """串流生成 AI 回應，逐步輸出新增的文字
+
+        呼叫端停止迭代（例如客戶端斷線）時會立即取消生成；telemetry 在串流結束後填妥。
+        設定 stop 時只輸出已確定保留的文字，輸出內容與 generate_response 裁切後相同。
+        可合併的請求（見 _coalesce_key）共用進行中的相同串流，較晚加入的請求先收到已產生的文字。
+        """
+        if not self.is_ready():
+            raise RuntimeError("AI 服務未就緒")
+        
+        if telemetry is None:
+            telemetry = GenerationTelemetry()
+        options = {
+            "message": message,
+            "context": context,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "system_prompt": system_prompt,
+            "do_sample": do_sample,
+            "timeout": timeout,
+            "stop": stop,
+            "session_id": session_id
+        }
+        key = self._coalesce_key(options)
+        if key is None:
+            async for text in self._stream_response(**options, telemetry=telemetry):
+                yield text
+            return
+        
+        async def shared() -> AsyncIterator[Tuple[str, GenerationTelemetry]]:
+            shared_telemetry = GenerationTelemetry(submitted_at=telemetry.submitted_at)
+            async for text in self._stream_response(**options, telemetry=shared_telemetry):
+                yield text, shared_telemetry
+            # 串流結束時遙測已填妥（沒有輸出任何文字時也能取得）
+            yield "", shared_telemetry
+        
+        async for text, shared_telemetry in self.single_flight.stream(key, shared):
+            if text:
+                yield text
+        telemetry.copy_from(shared_telemetry)
+    
+    async def _stream_response(
+        self,
+        message: str,
+        context: ContextInput,
+        temperature: float,
+        max_tokens: int,
+        system_prompt: Optional[str],
+        do_sample: bool,
+        timeout: Optional[float],
+        telemetry: GenerationTelemetry,
+        stop: Optional[Dict[str, Any]],
+        session_id: Optional[str]
+    ) -> AsyncIterator[str]:
+        """串流生成一次回應（stream_response 的實作）"""
+        input_ids, prefix_length = self._encode_request(message, context, system_prompt, session_id)
+        self._record_compression(context, telemetry)
+        queue: asyncio.Queue = asyncio.Queue()
+        decoder = IncrementalDecoder(self.tokenizer)
+        scanner = CodeStopScanner(**stop) if stop else None
+        emitted = ""
+        
+        task = self._track_generation(self._generate_ids(
+            input_ids,
+            prefix_length,
+            temperature,
+            max_tokens,
+            do_sample=do_sample,
+            on_tokens=queue.put_nowait,
+            timeout=timeout,
+            telemetry=telemetry,
+            stop=stop,
+            session_id=session_id
+        ))
+        
+        # 生成結束或失敗時喚醒讀取端
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        
+        self._inflight += 1
+        try:
+            while True:
+                token_ids = await queue.get()
+                if token_ids is None:
+                    break
+                text = decoder.push(token_ids)
+                if scanner is not None:
+                    scanner.feed(text)
+                    text = scanner.output()[len(emitted):]
+                    emitted += text
+                if text:
+                    yield text
+            
+            # 傳遞生成過程中的錯誤
+            output_ids = await self._await_generation(task)
+            self._record_turn(session_id, input_ids, output_ids, prefix_length, system_prompt)
+            
+            if scanner is not None:
+                scanner.finish()
+                final = scanner.output(final=True)
+                if final.startswith(emitted) and len(final) > len(emitted):
+                    yield final[len(emitted):]
+        finally:
+            self._inflight -= 1
+            if not task.done():
+                logger.info("串流已中斷，取消生成")
+                task.cancel()
+    
+    async def _generate_ids(
+        self,
+        input_ids: List[int],
+        prefix_length: int,
+        temperature: float,
+        max_tokens: int,
+        do_sample: bool = True,
+        speculative: Optional[bool] = None,
+        on_tokens: Optional[Callable[[List[int]], None]] = None,
+        timeout: Optional[float] = None,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None
+    ) -> List[int]:
+        """依執行模式（工作程序 / 批次排程器 / 推論執行緒）生成，回傳新 token id
+
+        on_tokens 在事件迴圈中接收串流 token；取消呼叫端的 task 會停止生成。
+        每個請求的遙測都會寫入 Prometheus 直方圖（標籤為執行模式）。
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+        if telemetry is None:
+            telemetry = GenerationTelemetry()
+        telemetry.prompt_tokens = len(input_ids)
+        
+        # 工作階段的 KV 快取無法併入批次，與推測解碼一樣直接在推論執行緒中生成
+        batched = (
+            self.worker is None
+            and self.scheduler is not None
+            and not self._use_speculative(speculative)
+            and session_id is None
+        )
+        mode = "batch" if batched else self._inference_mode()
+        try:
+            output_ids = await self._dispatch_generation(
+                input_ids,
+                prefix_length,
+                temperature,
+                max_tokens,
+                do_sample,
+                speculative,
+                on_tokens,
+                timeout,
+                telemetry,
+                batched,
+                stop,
+                session_id
+            )
+        except (Exception, asyncio.CancelledError) as e:
+            record_failure(mode, e)
+            raise
+        
+        telemetry.observe(mode)
+        return output_ids
     
+    async def _dispatch_generation(
+        self,
+        input_ids: List[int],
+        prefix_length: int,
+        temperature: float,
+        max_tokens: int,
+        do_sample: bool,
+        speculative: Optional[bool],
+        on_tokens: Optional[Callable[[List[int]], None]],
+        timeout: Optional[float],
+        telemetry: GenerationTelemetry,
+        batched: bool,
+        stop: Optional[Dict[str, Any]],
+        session_id: Optional[str]
+    ) -> List[int]:
+        """將請求交給工作程序、批次排程器或推論執行緒"""
+        if self.worker is not None:
+            return await self.worker.generate(
+                {
+                    "input_ids": input_ids,
+                    "prefix_length": prefix_length,
+                    "temperature": temperature,
+                    "max_tokens": max_tokens,
+                    "do_sample": do_sample,
+                    "speculative": speculative,
+                    "stop": stop,
+                    "session_id": session_id
+                },
+                on_tokens=on_tokens,
+                timeout=timeout,
+                telemetry=telemetry
+            )
+        
+        if batched:
+            try:
+                return await asyncio.wait_for(
+                    self._submit_to_scheduler(
+                        input_ids,
+                        prefix_length,
+                        temperature,
+                        max_tokens,
+                        do_sample,
+                        on_token=(lambda token: on_tokens([token])) if on_tokens else None,
+                        telemetry=telemetry,
+                        stop=stop
+                    ),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"生成超過期限 ({timeout} 秒)")
+        
+        if self._pending_requests >= self.max_queue_size:
+            raise RuntimeError(f"推論佇列已滿 ({self.max_queue_size})")
+        
+        loop = asyncio.get_running_loop()
+        stop_event = threading.Event()
+        thread_on_tokens = None
+        if on_tokens is not None:
+            thread_on_tokens = lambda ids: loop.call_soon_threadsafe(on_tokens, ids)
+        
+        self._pending_requests += 1
+        try:
+            return await loop.run_in_executor(
+                self._executor,
+                lambda: self._generate_sync(
+                    input_ids,
+                    prefix_length,
+                    temperature,
+                    max_tokens,
+                    do_sample=do_sample,
+                    speculative=speculative,
+                    on_tokens=thread_on_tokens,
+                    stop_event=stop_event,
+                    deadline=time.time() + timeout if timeout else None,
+                    telemetry=telemetry,
+                    stop=stop,
+                    session_id=session_id
+                )
+            )
+        except asyncio.CancelledError:
+            # 推論執行緒在下一個解碼步驟停止
+            stop_event.set()
+            raise
+        finally:
+            self._pending_requests -= 1
+    
+    def _generate_sync(
+        self,
+        input_ids: List[int],
+        prefix_length: int,
+        temperature: float,
+        max_tokens: int,
+        do_sample: bool = True,
+        speculative: Optional[bool] = None,
+        on_tokens: Optional[Callable[[List[int]], None]] = None,
+        stop_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None
+    ) -> List[int]:
+        """同步生成（於推論執行緒或工作程序中執行），回傳新 token id
+
+        stop_event 被設定時提前結束；超過 deadline（time.time() 絕對時間）時拋出 TimeoutError；
+        stop 為代碼停止選項，回傳的 token 可能包含少量停止點之後的內容，由呼叫端裁切文字；
+        session_id 的 KV 快取若涵蓋提示詞開頭則只預填其後的部分，生成完成後延續保存。
+        """
+        import torch
+        from transformers import StoppingCriteriaList
+        
+        if telemetry is None:
+            telemetry = GenerationTelemetry(len(input_ids))
+        telemetry.start()
+        reset_peak_memory(self.model.device)
+        
+        def stream(ids: List[int]):
+            telemetry.first_token()
+            if on_tokens is not None:
+                on_tokens(ids)
+        
+        assisted = self._use_speculative(speculative)
+        inputs = torch.tensor([input_ids], dtype=torch.long, device=self.model.device)
+        criteria = CancellationCriteria(stop_event or threading.Event(), deadline)
+        stopping = [criteria]
+        if stop:
+            stopping.append(CodeStoppingCriteria(self.tokenizer, prompt_length=len(input_ids), **stop))
+        
+        # 延續工作階段或系統提示詞的 KV 快取；草稿模型沒有這些快取，推測解碼時完整預填
+        use_session = session_id is not None and self.session_cache is not None and not assisted
+        if assisted:
+            generate_kwargs = {"assistant_model": self.draft_model}
+            target_start = self._forward_counters["target"].count
+            draft_start = self._forward_counters["draft"].count
+        else:
+            session_layers = self.session_cache.take(session_id, input_ids) if use_session else None
+            if session_layers is not None:
+                past = layers_to_cache(session_layers)
+            else:
+                past = self._prefix_past(input_ids, prefix_length)
+            generate_kwargs = {"past_key_values": past}
+        
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = self.model.generate(
+                inputs,
+                generation_config=self._request_generation_config(temperature, max_tokens, do_sample),
+                streamer=TokenStreamer(stream),
+                stopping_criteria=StoppingCriteriaList(stopping),
+                return_dict_in_generate=True,
+                **generate_kwargs
+            )
+        elapsed = time.perf_counter() - start
+        output_ids = outputs.sequences[0][inputs.shape[1]:].tolist()
+        
+        # 快取涵蓋到最後一個 token 之前，下一輪從這裡延續；中斷的生成不保存
+        if use_session and criteria.reason is None:
+            layers = cache_to_layers(outputs.past_key_values)
+            self.session_cache.put(session_id, (input_ids + output_ids)[:layers_seq_length(layers)], layers)
+        telemetry.finish(len(output_ids), peak_memory_bytes(self.model.device))
+        
+        if assisted:
+            self.speculative_stats.record_assisted(
+                len(output_ids),
+                elapsed,
+                self._forward_counters["target"].count - target_start,
+                self._forward_counters["draft"].count - draft_start
+            )
+        else:
+            self.speculative_stats.record_plain(len(output_ids), elapsed)
+        
+        # 清理記憶體
+        del inputs, outputs
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        
+        if criteria.reason == "deadline":
+            raise TimeoutError(f"生成超過期限（已生成 {len(output_ids)} 個 token）")
+        return output_ids
+    
+    def _request_generation_config(
+        self,
+        temperature: float,
+        max_tokens: int,
+        do_sample: bool = True
+    ) -> "GenerationConfig":
+        """依請求參數建立生成配置"""
+        from transformers import GenerationConfig
+        
+        return GenerationConfig(**{
+            **self.generation_config.to_dict(),
+            "temperature": temperature,
+            "max_new_tokens": min(max_tokens, 2048),
+            "do_sample": do_sample
+        })
+    
+    async def _submit_to_scheduler(
+        self,
+        input_ids: List[int],
+        prefix_length: int,
+        temperature: float,
+        max_tokens: int,
+        do_sample: bool = True,
+        on_token=None,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop: Optional[Dict[str, Any]] = None
+    ) -> List[int]:
+        """提交請求到連續批次排程器"""
+        return await self.scheduler.submit(
+            input_ids,
+            max_new_tokens=min(max_tokens, 2048),
+            temperature=temperature,
+            top_p=self.generation_config.top_p,
+            top_k=self.generation_config.top_k,
+            repetition_penalty=self.generation_config.repetition_penalty,
+            do_sample=do_sample,
+            on_token=on_token,
+            prefix_length=prefix_length,
+            telemetry=telemetry,
+            stop_criteria=CodeStoppingCriteria(self.tokenizer, **stop) if stop else None
+        )
+    
+    def _prefix_past(self, input_ids: List[int], prefix_length: int):
+        """取得系統提示詞前綴的 KV 快取副本（未啟用時回傳 None）"""
+        if self.prefix_cache is None or not 0 < prefix_length < len(input_ids):
+            return None
+        return layers_to_cache(clone_layers(self.prefix_cache.get(input_ids[:prefix_length])))
+    
+    def _coalesce_key(self, options: Dict[str, Any]) -> Optional[str]:
+        """可合併請求的鍵；取樣溫度高於 coalesce_max_temperature 或屬於工作階段的請求回傳 None
+
+        工作階段的請求會寫入各自的對話記錄，不能共用。timeout 與 speculative 不影響輸出，不列入鍵。
+        """
+        if not self.enable_coalescing or options["session_id"] is not None:
+            return None
+        if options["do_sample"] and options["temperature"] > self.coalesce_max_temperature:
+            return None
+        return flight_key(
+            self.model_name,
+            options["message"],
+            options["context"],
+            options["system_prompt"],
+            options["temperature"] if options["do_sample"] else None,
+            options["do_sample"],
+            options["max_tokens"],
+            options["stop"]
+        )
+    
+    def _encode_prompt(
+        self,
+        message: str,
+        context: ContextInput = None,
+        system_prompt: Optional[str] = None
+    ) -> Tuple[List[int], int]:
+        """編碼提示詞，回傳 (token id, 共用前綴長度)
+
+        各段落分開 token 化並快取，確保同一系統提示詞的前綴 token 完全一致；
+        超出 max_prompt_tokens 時截斷或捨棄分數最低的檢索內容。
+        """
+        return self.prompt_assembler.assemble(
+            system_prompt or DEFAULT_SYSTEM_PROMPT,
+            message,
+            context,
+            self.max_prompt_tokens
+        )
+
+    def _encode_request(
+        self,
+        message: str,
+        context: ContextInput = None,
+        system_prompt: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> Tuple[List[int], int]:
+        """編碼請求；屬於既有工作階段時將新一輪接在對話之後
+
+        對話加上新一輪超出 max_prompt_tokens 時捨棄舊對話，從這一輪重新開始。
+        """
+        system = system_prompt or DEFAULT_SYSTEM_PROMPT
+        session = self.session_history.get(session_id, system) if session_id is not None else None
+
+        if session is not None:
+            history = session["token_ids"]
+            budget = None if self.max_prompt_tokens is None else self.max_prompt_tokens - len(history)
+            turn_ids = self.prompt_assembler.assemble_turn(message, context, budget)
+            if budget is None or len(turn_ids) <= budget:
+                return history + turn_ids, session["prefix_length"]
+
+            logger.info(f"工作階段 {session_id} 已超出提示詞預算，重新開始對話")
+            self.session_history.drop(session_id)
+            self.session_history.stats["resets"] += 1
+
+        return self._encode_prompt(message, context, system)
+
+    def _record_compression(self, context: ContextInput, telemetry: GenerationTelemetry):
+        """記錄檢索內容壓縮（RAGService.compress_results）前後的 token 數，用於估計省下的預填時間"""
+        if not isinstance(context, list):
+            return
+        for chunk in context:
+            original = chunk.get("original_content")
+            if original is None:
+                continue
+            # 原文只在此計數，不放入提示詞段落快取
+            tokens = len(self.prompt_assembler.encode(chunk["content"]))
+            telemetry.context_tokens += tokens
+            telemetry.context_tokens_saved += max(
+                len(self.tokenizer.encode(original, add_special_tokens=False)) - tokens, 0
+            )
+
+    def _record_turn(
+        self,
+        session_id: Optional[str],
+        input_ids: List[int],
+        output_ids: List[int],
+        prefix_length: int,
+        system_prompt: Optional[str]
+    ):
+        """將完成的一輪加入工作階段（不含結尾的 EOS）"""
+        if session_id is None:
+            return
+        if output_ids and output_ids[-1] == self.tokenizer.eos_token_id:
+            output_ids = output_ids[:-1]
+        self.session_history.update(
+            session_id,
+            input_ids + output_ids,
+            prefix_length,
+            system_prompt or DEFAULT_SYSTEM_PROMPT
+        )
+
+    @_routed
+    def end_session(self, session_id: str) -> bool:
+        """結束工作階段並釋放其 KV 快取（工作程序中的快取由 LRU 自行淘汰）"""
+        if self.session_cache is not None:
+            self.session_cache.drop(session_id)
+        return self.session_history.drop(session_id)
+
     def _build_prompt(
         self, 
         message: str, 
-        context: Optional[str] = None,
+        context: ContextInput = None,
         system_prompt: Optional[str] = None
     ) -> str:
-        """構建提示詞"""
-        
-        # 預設系統提示詞
-        default_system = """你是一個專業的 Tekla Structures 建模助手，具備以下能力：
-1. 理解建築和結構工程概念
-2. 熟悉 Tekla Structures 2025 Open API
-3. 能夠生成準確的 C# 代碼
-4. 提供詳細的技術說明
-
-請用繁體中文回答，並確保代碼的正確性和實用性。"""
-        
-        system = system_prompt or default_system
+        """構建提示詞（未套用 token 預算的完整字串形式）"""
+        system = system_prompt or DEFAULT_SYSTEM_PROMPT
         
         # 構建對話格式
         prompt_parts = [
@@ -192,53 +1188,159 @@ class AIService:
         
         # 添加上下文
         if context:
-            prompt_parts.insert(-1, f"### 相關資訊\n{context}\n")
+            prompt_parts.insert(-1, f"### 相關資訊\n{context_text(context)}\n")
         
         prompt_parts.append("### 助手\n")
         
         return "\n".join(prompt_parts)
     
-    async def generate_tekla_code(
+    def _tekla_code_request(
         self,
         description: str,
-        context: Optional[str] = None,
-        api_references: Optional[List[str]] = None
-    ) -> str:
-        """生成 Tekla API 代碼"""
+        context: ContextInput = None,
+        api_references: Optional[List[str]] = None,
+        code_only: bool = False
+    ) -> Dict[str, Any]:
+        """構建 Tekla 代碼生成的請求參數"""
         
-        # 構建 Tekla 專用系統提示詞
-        system_prompt = """你是一個 Tekla Structures 2025 Open API 專家。請根據用戶需求生成準確的 C# 代碼。
-
-要求：
-1. 使用正確的 Tekla API 命名空間
-2. 包含必要的 using 語句
-3. 添加適當的錯誤處理
-4. 提供清晰的註解
-5. 確保代碼可以直接在 Tekla 中執行
-
-可用的主要命名空間：
-- Tekla.Structures.Model
-- Tekla.Structures.Geometry3d
-- Tekla.Structures.Catalogs
-- Tekla.Structures.Dialog
-- Tekla.Structures.Drawing"""
-        
-        # 添加 API 參考資訊
-        if api_references:
+        # 添加 API 參考資訊（檢索段落形式時作為最高分段落，不會被預算捨棄）
+        if api_references and isinstance(context, list):
+            references = "\n".join(["API 參考資訊：", *api_references])
+            context = context + [{"content": references, "score": float("inf")}]
+        elif api_references:
             context_parts = [context] if context else []
             context_parts.append("API 參考資訊：")
             context_parts.extend(api_references)
             context = "\n".join(context_parts)
         
-        return await self.generate_response(
-            message=f"請生成 Tekla Structures API 代碼：{description}",
-            context=context,
-            system_prompt=system_prompt,
-            temperature=0.3  # 較低溫度確保代碼準確性
-        )
+        message = f"請生成 Tekla Structures API 代碼：{description}"
+        if code_only:
+            message = f"{message}\n{CODE_ONLY_INSTRUCTION}"
+        
+        return {
+            "message": message,
+            "context": context,
+            "system_prompt": TEKLA_CODE_SYSTEM_PROMPT,
+            "temperature": 0.3,  # 較低溫度確保代碼準確性
+            "stop": default_stop_options(self.stop_sequences, code_only) if self.code_stopping or code_only else None
+        }
+    
+    def _response_cache_key(self, request: Dict[str, Any], max_tokens: int) -> str:
+        """Tekla 代碼請求的回應快取鍵（提示詞已包含 RAG 上下文）"""
+        settings = {
+            "temperature": request["temperature"],
+            "max_new_tokens": min(max_tokens, 2048),
+            "do_sample": False,
+            "repetition_penalty": self.generation_config.repetition_penalty,
+            "stop": request["stop"]
+        }
+        prompt = self._build_prompt(request["message"], request["context"], request["system_prompt"])
+        return response_key(self.model_name, settings, prompt)
     
+    @_routed
+    async def generate_tekla_code(
+        self,
+        description: str,
+        context: ContextInput = None,
+        api_references: Optional[List[str]] = None,
+        max_tokens: int = 2048,
+        code_only: bool = False
+    ) -> str:
+        """生成 Tekla API 代碼
+
+        啟用回應快取時改用貪婪解碼，相同請求直接回傳快取結果。
+        代碼完整（代碼區塊結束或大括號平衡後開始說明）即停止生成；code_only 時只回傳代碼。
+        """
+        request = self._tekla_code_request(description, context, api_references, code_only)
+        
+        if self.response_cache is None:
+            return await self.generate_response(**request, max_tokens=max_tokens)
+        
+        key = self._response_cache_key(request, max_tokens)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        response = await self.generate_response(**request, max_tokens=max_tokens, do_sample=False)
+        self.response_cache.put(key, response)
+        return response
+    
+    @_routed
+    async def stream_tekla_code(
+        self,
+        description: str,
+        context: ContextInput = None,
+        api_references: Optional[List[str]] = None,
+        max_tokens: int = 2048,
+        code_only: bool = False
+    ) -> AsyncIterator[str]:
+        """串流生成 Tekla API 代碼（回應快取命中時一次輸出完整結果）"""
+        request = self._tekla_code_request(description, context, api_references, code_only)
+        
+        if self.response_cache is None:
+            async for text in self.stream_response(**request, max_tokens=max_tokens):
+                yield text
+            return
+        
+        key = self._response_cache_key(request, max_tokens)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+        
+        # 只有完整生成的結果才寫入快取
+        chunks = []
+        async for text in self.stream_response(**request, max_tokens=max_tokens, do_sample=False):
+            chunks.append(text)
+            yield text
+        self.response_cache.put(key, "".join(chunks).strip())
+    
+    async def iter_tekla_code_batch(
+        self,
+        commands: List[Dict[str, Any]],
+        max_tokens: int = 2048,
+        max_concurrency: Optional[int] = None
+    ) -> AsyncIterator[Tuple[int, Optional[str], Optional[Exception]]]:
+        """批次生成 Tekla API 代碼，依完成順序產出 (命令索引, 代碼, 錯誤)
+
+        commands 的每一項為 generate_tekla_code 的參數（description、context、api_references、code_only）。
+        同時進行的請求由批次排程器併入同一個解碼批次（或分配到多個副本）；
+        max_concurrency 預設為批次大小（排程器）或副本數。內容相同的命令只生成一次。
+        呼叫端停止迭代時取消尚未完成的生成。
+        """
+        if max_concurrency is None:
+            max_concurrency = self.max_batch_size if self.enable_batching else len(self.replica_devices or [None])
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        
+        # 相同的命令共用一次生成
+        groups: Dict[str, List[int]] = {}
+        for index, command in enumerate(commands):
+            key = json.dumps(command, sort_keys=True, ensure_ascii=False, default=str)
+            groups.setdefault(key, []).append(index)
+        
+        async def run(indices: List[int]) -> Tuple[List[int], Optional[str], Optional[Exception]]:
+            async with semaphore:
+                try:
+                    code = await self.generate_tekla_code(**commands[indices[0]], max_tokens=max_tokens)
+                    return indices, code, None
+                except Exception as e:
+                    return indices, None, e
+        
+        tasks = [asyncio.ensure_future(run(indices)) for indices in groups.values()]
+        try:
+            for future in asyncio.as_completed(tasks):
+                indices, code, error = await future
+                for index in indices:
+                    yield index, code, error
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    @_routed
     def is_ready(self) -> bool:
         """檢查服務是否就緒"""
+        if self.worker is not None:
+            return self.is_initialized and self.tokenizer is not None and self.worker.is_alive()
         return (
             self.is_initialized and 
             self.tokenizer is not None and 
@@ -246,7 +1348,13 @@ class AIService:
         )
     
     def get_model_info(self) -> Dict[str, Any]:
-        """獲取模型資訊"""
+        """獲取模型資訊（含熱切換進度）"""
+        info = (self._active or self)._backend_info()
+        info["hot_swap"] = self.get_swap_status()
+        return info
+    
+    def _backend_info(self) -> Dict[str, Any]:
+        """目前模型的資訊"""
         if not self.is_ready():
             return {"status": "not_ready"}
         
@@ -254,20 +1362,101 @@ class AIService:
             "model_name": self.model_name,
             "device_map": self.device_map,
             "torch_dtype": str(self.torch_dtype),
-            "is_quantized": self.quantization_config is not None,
+            "is_quantized": self.quantization_config is not None or self.cpu_int8,
+            "cpu_int8": self.cpu_int8,
+            "inference_mode": self._inference_mode(),
             "status": "ready"
         }
         
-        if hasattr(self.model, 'get_memory_footprint'):
+        if self.worker is not None:
+            # 子程序啟動時回報的模型資訊（記憶體用量、前綴快取設定等）
+            info["worker"] = {**self.worker.get_stats(), "model_info": self.worker.model_info}
+        
+        if self.scheduler is not None:
+            info["batching"] = self.scheduler.get_stats()
+        
+        if self.prefix_cache is not None:
+            info["prefix_cache"] = self.prefix_cache.get_stats()
+        
+        if self.response_cache is not None:
+            info["response_cache"] = self.response_cache.get_stats()
+        
+        info["coalescing"] = {
+            "enabled": self.enable_coalescing,
+            "max_temperature": self.coalesce_max_temperature,
+            **self.single_flight.get_stats()
+        }
+        info["sessions"] = self.session_history.get_stats()
+        if self.session_cache is not None:
+            info["session_cache"] = self.session_cache.get_stats()
+        
+        info["prompt_assembly"] = {
+            "max_prompt_tokens": self.max_prompt_tokens,
+            **self.prompt_assembler.get_stats()
+        }
+        info["code_stopping"] = {
+            "enabled": self.code_stopping,
+            "stop_sequences": self.stop_sequences
+        }
+        
+        if self.draft_model is not None:
+            info["speculative"] = {
+                "draft_model": self.draft_model_name,
+                **self.speculative_stats.get_stats()
+            }
+        
+        if self.model is not None and hasattr(self.model, 'get_memory_footprint'):
             info["memory_footprint_mb"] = self.model.get_memory_footprint() / 1024 / 1024
         
         return info
     
     async def cleanup(self):
-        """清理資源"""
+        """清理資源（含熱切換後的新實例）"""
+        if self._active is not None:
+            active, self._active = self._active, None
+            await active.cleanup()
+        await self._release()
+    
+    async def _release(self):
+        """釋放本實例的模型與快取"""
         try:
+            import torch
+            
             logger.info("清理 AI 服務資源...")
             
+            if self.worker is not None:
+                await self.worker.stop()
+                self.worker = None
+            
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            
+            if self.scheduler is not None:
+                await self.scheduler.stop()
+                self.scheduler = None
+            
+            if self.prefix_cache is not None:
+                self.prefix_cache.clear()
+                self.prefix_cache = None
+            
+            if self.response_cache is not None:
+                self.response_cache.close()
+                self.response_cache = None
+            
+            if self.session_cache is not None:
+                self.session_cache.clear()
+                self.session_cache = None
+            self.session_history.clear()
+            
+            for counter in self._forward_counters.values():
+                counter.remove()
+            self._forward_counters = {}
+            
+            if self.draft_model is not None:
+                del self.draft_model
+                self.draft_model = None
+            
             if self.model is not None:
                 del self.model
                 self.model = None
@@ -291,6 +1480,8 @@ class AIService:
     
     def get_device_info(self) -> Dict[str, Any]:
         """獲取設備資訊"""
+        import torch
+        
         info = {
             "cuda_available": torch.cuda.is_available(),
             "device_count": torch.cuda.device_count() if torch.cuda.is_available() else 0
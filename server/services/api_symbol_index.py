@@ -0,0 +1,153 @@
+"""
+Tekla API 符號索引
+以字典樹索引命名空間、類別、方法與屬性，提供精確與前綴查詢
+"""
+
+import re
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+# 同名符號的排序優先權（數字越小越前面）
+KIND_PRIORITY = {"class": 0, "method": 1, "property": 1, "namespace": 2}
+
+# 自由文本中的符號引用，例如 Model.CommitChanges 或 Tekla.Structures.Model
+SYMBOL_PATTERN = re.compile(r"[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)+")
+
+
+class _TrieNode:
+    """字典樹節點"""
+
+    __slots__ = ("children", "symbol_ids")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.symbol_ids: List[int] = []
+
+
+class ApiSymbolIndex:
+    """Tekla API 符號索引
+
+    每個符號以完整名稱及其所有「點號後綴」建立鍵，例如
+    Tekla.Structures.Model.Model.CommitChanges 也可用 Model.CommitChanges
+    或 CommitChanges 查到。鍵不分大小寫，查詢時間與鍵長度成正比。
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self.symbols: List[Dict[str, Any]] = []
+
+    @classmethod
+    def from_api_docs(cls, api_docs: Dict[str, Any]) -> "ApiSymbolIndex":
+        """從 API 文檔結構建立索引"""
+        index = cls()
+        for namespace, namespace_data in api_docs.items():
+            index.add({
+                "name": namespace,
+                "kind": "namespace",
+                "namespace": namespace,
+                "description": namespace_data.get("description", ""),
+                "doc_id": f"namespace_{namespace}"
+            })
+
+            for class_name, class_data in namespace_data.get("classes", {}).items():
+                doc_id = f"class_{namespace}_{class_name}"
+                index.add({
+                    "name": f"{namespace}.{class_name}",
+                    "kind": "class",
+                    "namespace": namespace,
+                    "class_name": class_name,
+                    "description": class_data.get("description", ""),
+                    "doc_id": doc_id
+                })
+
+                for kind, members in (
+                    ("property", class_data.get("properties", {})),
+                    ("method", class_data.get("methods", {}))
+                ):
+                    for member, description in members.items():
+                        index.add({
+                            "name": f"{namespace}.{class_name}.{member}",
+                            "kind": kind,
+                            "namespace": namespace,
+                            "class_name": class_name,
+                            "member": member,
+                            "description": description,
+                            "doc_id": doc_id
+                        })
+        return index
+
+    @classmethod
+    def from_symbols(cls, symbols: Iterable[Dict[str, Any]]) -> "ApiSymbolIndex":
+        """從已序列化的符號清單重建索引"""
+        index = cls()
+        for symbol in symbols:
+            index.add(symbol)
+        return index
+
+    def add(self, symbol: Dict[str, Any]):
+        """加入符號"""
+        symbol_id = len(self.symbols)
+        self.symbols.append(symbol)
+
+        parts = symbol["name"].split(".")
+        for i in range(len(parts)):
+            node = self._root
+            for char in ".".join(parts[i:]).lower():
+                node = node.children.setdefault(char, _TrieNode())
+            node.symbol_ids.append(symbol_id)
+
+    def _find_node(self, key: str) -> Optional[_TrieNode]:
+        """走訪到鍵對應的節點"""
+        node = self._root
+        for char in key.lower():
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _sorted(self, symbol_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        """去重並依類型優先權排序"""
+        unique = dict.fromkeys(symbol_ids)
+        return sorted(
+            (self.symbols[i] for i in unique),
+            key=lambda s: (KIND_PRIORITY.get(s["kind"], 9), len(s["name"]))
+        )
+
+    def lookup(self, name: str) -> List[Dict[str, Any]]:
+        """精確查詢"""
+        node = self._find_node(name.strip())
+        if node is None:
+            return []
+        return self._sorted(node.symbol_ids)
+
+    def complete(self, prefix: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """前綴查詢（自動完成），較短的補全優先"""
+        node = self._find_node(prefix.strip())
+        if node is None:
+            return []
+
+        symbol_ids: List[int] = []
+        seen = set()
+        queue = deque([node])
+        while queue and len(seen) < limit:
+            current = queue.popleft()
+            for symbol_id in current.symbol_ids:
+                if symbol_id not in seen:
+                    seen.add(symbol_id)
+                    symbol_ids.append(symbol_id)
+            for char in sorted(current.children):
+                queue.append(current.children[char])
+
+        return self._sorted(symbol_ids)[:limit]
+
+    def resolve(self, text: str) -> List[Dict[str, Any]]:
+        """解析自由文本中以點號連接的符號引用"""
+        symbol_ids: List[int] = []
+        for match in SYMBOL_PATTERN.finditer(text):
+            node = self._find_node(match.group(0))
+            if node is not None:
+                symbol_ids.extend(node.symbol_ids)
+        return self._sorted(symbol_ids)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
@@ -0,0 +1,458 @@
+"""
+連續批次排程器
+將並行的生成請求動態組成批次，在每個解碼步驟之間加入新請求並移除已完成的序列
+"""
+
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from services.kv_cache_utils import (
+    cache_to_layers,
+    clone_layers,
+    layers_seq_length,
+    layers_to_cache,
+    left_pad_layers,
+    select_layers
+)
+from services.telemetry import GenerationTelemetry, peak_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRequest:
+    """排程中的單一生成請求"""
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        future: asyncio.Future,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float = 1.0,
+        top_k: int = 0,
+        repetition_penalty: float = 1.0,
+        do_sample: bool = True,
+        on_token: Optional[Callable[[int], None]] = None,
+        prefix_length: int = 0,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop_criteria: Optional[Any] = None
+    ):
+        self.input_ids = input_ids
+        self.prefix_length = prefix_length
+        self.future = future
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.do_sample = do_sample and temperature > 0
+        self.on_token = on_token
+        self.telemetry = telemetry
+        self.stop_criteria = stop_criteria  # 具有 push(token_ids) -> bool 的停止條件
+        self.generated: List[int] = []
+        self.finished = False
+
+
+class ContinuousBatchScheduler:
+    """連續批次排程器
+
+    所有張量運算都在單一執行緒中進行，因此不會阻塞事件迴圈。
+    每個步驟若有等待中的請求就先對它們做預填（prefill）並併入批次，
+    否則對整個批次做一次解碼；完成的序列在步驟之間移出批次。
+    批次使用左側補齊，並以 attention_mask 與 position_ids 遮蔽補齊位置。
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        tokenizer: Any,
+        max_batch_size: int = 8,
+        max_queue_size: int = 256,
+        prefix_cache: Optional[Any] = None
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.eos_token_id = tokenizer.eos_token_id
+
+        self._waiting: Deque[BatchRequest] = deque()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-scheduler")
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # 執行中批次的狀態（僅在排程執行緒中存取）
+        self._active: List[BatchRequest] = []
+        self._cache_layers: List = []
+        self._attention_mask = None
+        self._next_tokens = None
+
+        self.stats = {
+            "requests": 0,
+            "completed": 0,
+            "prefill_steps": 0,
+            "decode_steps": 0,
+            "generated_tokens": 0,
+            "max_batch_seen": 0
+        }
+
+    def _ensure_started(self):
+        """在目前事件迴圈中啟動排程迴圈"""
+        if self._loop_task is None or self._loop_task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._loop_task = self._loop.create_task(self._run())
+
+    async def submit(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int = 2048,
+        temperature: float = 0.7,
+        top_p: float = 1.0,
+        top_k: int = 0,
+        repetition_penalty: float = 1.0,
+        do_sample: bool = True,
+        on_token: Optional[Callable[[int], None]] = None,
+        prefix_length: int = 0,
+        telemetry: Optional[GenerationTelemetry] = None,
+        stop_criteria: Optional[Any] = None
+    ) -> List[int]:
+        """提交請求並等待生成結果（不含提示詞的 token id）
+
+        prefix_length 為提示詞開頭可共用的前綴長度（例如系統提示詞），
+        設定了前綴快取時只需預填其後的部分；telemetry 記錄排隊、預填與解碼時間；
+        stop_criteria 在每個新 token 後判斷是否提前結束（例如代碼已完整）。
+        """
+        self._ensure_started()
+
+        if len(self._waiting) >= self.max_queue_size:
+            raise RuntimeError(f"生成佇列已滿 ({self.max_queue_size})")
+
+        future = self._loop.create_future()
+        request = BatchRequest(
+            input_ids=list(input_ids),
+            future=future,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repetition_penalty=repetition_penalty,
+            do_sample=do_sample,
+            on_token=on_token,
+            prefix_length=prefix_length,
+            telemetry=telemetry,
+            stop_criteria=stop_criteria
+        )
+        self._waiting.append(request)
+        self.stats["requests"] += 1
+        self._wakeup.set()
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # 呼叫端取消時讓排程器在下個步驟移除此序列
+            request.finished = True
+            raise
+
+    async def _run(self):
+        """排程迴圈"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._active and not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            admitted = []
+            while self._waiting and len(self._active) + len(admitted) < self.max_batch_size:
+                request = self._waiting.popleft()
+                if not request.future.done():
+                    admitted.append(request)
+                    if request.telemetry is not None:
+                        request.telemetry.start()
+
+            try:
+                finished = await loop.run_in_executor(self._executor, self._step, admitted)
+            except Exception as e:
+                logger.error(f"批次生成步驟失敗: {e}")
+                for request in self._active + admitted:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                self._reset_batch()
+                continue
+
+            for request in finished:
+                if request.telemetry is not None:
+                    request.telemetry.finish(len(request.generated), peak_memory_bytes())
+                if not request.future.done():
+                    request.future.set_result(request.generated)
+                self.stats["completed"] += 1
+
+    def _reset_batch(self):
+        """清空執行中批次"""
+        self._active = []
+        self._cache_layers = []
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _step(self, admitted: List[BatchRequest]) -> List[BatchRequest]:
+        """執行一個排程步驟（於排程執行緒中執行）"""
+        import torch
+
+        with torch.no_grad():
+            if admitted:
+                self._prefill(admitted)
+                self.stats["prefill_steps"] += 1
+            else:
+                self._decode()
+                self.stats["decode_steps"] += 1
+
+        self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(self._active))
+        return self._retire_finished()
+
+    def _prefill(self, requests: List[BatchRequest]):
+        """預填新請求並併入執行中批次"""
+        with_prefix = [
+            r for r in requests
+            if self.prefix_cache is not None and 0 < r.prefix_length < len(r.input_ids)
+        ]
+        plain = [r for r in requests if r not in with_prefix]
+
+        if plain:
+            self._prefill_batch(plain)
+        for request in with_prefix:
+            self._prefill_with_prefix(request)
+
+    def _prefill_with_prefix(self, request: BatchRequest):
+        """以共用前綴快取為起點，只預填後綴"""
+        import torch
+
+        device = self.model.device
+        prefix_layers = clone_layers(self.prefix_cache.get(request.input_ids[:request.prefix_length]))
+        total_length = len(request.input_ids)
+
+        outputs = self.model(
+            input_ids=torch.tensor([request.input_ids[request.prefix_length:]], dtype=torch.long, device=device),
+            attention_mask=torch.ones((1, total_length), dtype=torch.long, device=device),
+            position_ids=torch.arange(request.prefix_length, total_length, device=device).unsqueeze(0),
+            past_key_values=layers_to_cache(prefix_layers),
+            use_cache=True
+        )
+
+        self._merge_into_batch(
+            [request],
+            cache_to_layers(outputs.past_key_values),
+            torch.ones((1, total_length), dtype=torch.long, device=device),
+            self._sample(outputs.logits[:, -1, :], [request])
+        )
+
+    def _prefill_batch(self, requests: List[BatchRequest]):
+        """對新請求做左側補齊的批次預填"""
+        import torch
+
+        device = self.model.device
+        max_length = max(len(r.input_ids) for r in requests)
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+        input_ids = torch.full((len(requests), max_length), pad_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros((len(requests), max_length), dtype=torch.long, device=device)
+        for row, request in enumerate(requests):
+            length = len(request.input_ids)
+            input_ids[row, max_length - length:] = torch.tensor(request.input_ids, device=device)
+            attention_mask[row, max_length - length:] = 1
+
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True
+        )
+
+        self._merge_into_batch(
+            requests,
+            cache_to_layers(outputs.past_key_values),
+            attention_mask,
+            self._sample(outputs.logits[:, -1, :], requests)
+        )
+
+    def _merge_into_batch(
+        self,
+        requests: List[BatchRequest],
+        new_layers: List,
+        attention_mask: Any,
+        next_tokens: Any
+    ):
+        """將預填完成的序列併入執行中批次"""
+        import torch
+
+        if self._active:
+            # 左側補零使兩個批次的序列長度一致後沿批次維度合併
+            target = max(layers_seq_length(self._cache_layers), attention_mask.shape[1])
+            old_layers = left_pad_layers(self._cache_layers, target)
+            new_layers = left_pad_layers(new_layers, target)
+            self._cache_layers = [
+                (torch.cat([ok, nk], dim=0), torch.cat([ov, nv], dim=0))
+                for (ok, ov), (nk, nv) in zip(old_layers, new_layers)
+            ]
+            self._attention_mask = torch.cat([
+                self._pad_mask(self._attention_mask, target),
+                self._pad_mask(attention_mask, target)
+            ], dim=0)
+            self._next_tokens = torch.cat([self._next_tokens, next_tokens], dim=0)
+        else:
+            self._cache_layers = new_layers
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens
+
+        self._active.extend(requests)
+        self._record_tokens(requests, next_tokens)
+
+    def _decode(self):
+        """對整個批次解碼一個 token"""
+        import torch
+
+        attention_mask = torch.cat([
+            self._attention_mask,
+            self._attention_mask.new_ones((self._attention_mask.shape[0], 1))
+        ], dim=1)
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=layers_to_cache(self._cache_layers),
+            use_cache=True
+        )
+
+        self._cache_layers = cache_to_layers(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self._next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        self._record_tokens(self._active, self._next_tokens)
+
+    @staticmethod
+    def _pad_mask(mask: Any, target: int) -> Any:
+        """在左側補零遮罩"""
+        import torch
+
+        pad = target - mask.shape[1]
+        if pad <= 0:
+            return mask
+        return torch.cat([mask.new_zeros((mask.shape[0], pad)), mask], dim=1)
+
+    def _record_tokens(self, requests: List[BatchRequest], tokens: Any):
+        """記錄新 token 並判斷是否完成"""
+        for request, token in zip(requests, tokens.tolist()):
+            if request.finished:
+                continue
+            if request.telemetry is not None:
+                request.telemetry.first_token()
+            if token == self.eos_token_id:
+                request.finished = True
+                continue
+            request.generated.append(token)
+            self.stats["generated_tokens"] += 1
+            if request.on_token is not None:
+                self._loop.call_soon_threadsafe(request.on_token, token)
+            if len(request.generated) >= request.max_new_tokens:
+                request.finished = True
+            elif request.stop_criteria is not None and request.stop_criteria.push([token]):
+                request.finished = True
+
+    def _retire_finished(self) -> List[BatchRequest]:
+        """移除已完成序列，並裁掉所有列都是補齊的開頭欄位"""
+        import torch
+
+        finished = [r for r in self._active if r.finished]
+        if not finished:
+            return []
+
+        keep = [i for i, r in enumerate(self._active) if not r.finished]
+        if not keep:
+            self._reset_batch()
+            return finished
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        mask = self._attention_mask[index]
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+
+        self._cache_layers = select_layers(self._cache_layers, index, start)
+        self._attention_mask = mask[:, start:]
+        self._next_tokens = self._next_tokens[index]
+        self._active = [self._active[i] for i in keep]
+        return finished
+
+    def _sample(self, logits: Any, requests: List[BatchRequest]) -> Any:
+        """依各請求的生成參數逐列取樣"""
+        import torch
+
+        logits = logits.float()
+        tokens = []
+        for row, request in enumerate(requests):
+            scores = logits[row]
+
+            if request.repetition_penalty != 1.0:
+                seen = torch.tensor(
+                    request.input_ids + request.generated,
+                    device=scores.device
+                ).unique()
+                penalized = scores[seen]
+                scores = scores.clone()
+                scores[seen] = torch.where(
+                    penalized < 0,
+                    penalized * request.repetition_penalty,
+                    penalized / request.repetition_penalty
+                )
+
+            if not request.do_sample:
+                tokens.append(int(scores.argmax()))
+                continue
+
+            scores = scores / request.temperature
+
+            if request.top_k and request.top_k < scores.shape[-1]:
+                threshold = torch.topk(scores, request.top_k).values[-1]
+                scores = scores.masked_fill(scores < threshold, float("-inf"))
+
+            if request.top_p < 1.0:
+                sorted_scores, sorted_index = torch.sort(scores, descending=True)
+                cumulative = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+                remove = cumulative > request.top_p
+                remove[1:] = remove[:-1].clone()
+                remove[0] = False
+                scores = scores.scatter(0, sorted_index[remove], float("-inf"))
+
+            probs = scores.softmax(dim=-1)
+            tokens.append(int(torch.multinomial(probs, num_samples=1)))
+
+        return torch.tensor(tokens, dtype=torch.long, device=logits.device)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取排程統計"""
+        return {
+            **self.stats,
+            "active": len(self._active),
+            "waiting": len(self._waiting)
+        }
+
+    async def stop(self):
+        """停止排程器"""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+        for request in list(self._waiting) + self._active:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("排程器已停止"))
+        self._waiting.clear()
+        self._reset_batch()
+        self._executor.shutdown(wait=False)
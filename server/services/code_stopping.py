@@ -0,0 +1,285 @@
+"""
+代碼感知的提前停止
+依 Tekla 代碼回應的結構判斷生成何時可以結束：代碼區塊的結束標記（```）、
+最後一個 } 之後大括號已平衡且接著是說明文字，或自訂的停止字串；
+可選擇只輸出代碼（去除代碼區塊前後的說明）。
+"""
+
+import re
+from typing import Any, Dict, List, Optional
+
+from services.streaming import IncrementalDecoder
+
+FENCE = "```"
+
+# 看起來像 C# 代碼的行（大括號平衡後若下一行不是代碼，視為開始說明而停止）
+CODE_LINE = re.compile(
+    r"^\s*(?:[{}\[\]()#@/.]"
+    r"|(?:using|namespace|public|private|protected|internal|static|sealed|abstract|partial|class|interface"
+    r"|struct|enum|var|const|return|if|else|for|foreach|while|do|switch|case|try|catch|finally|throw|new"
+    r"|await|async|void|int|double|bool|string)\b"
+    r"|.*[;{},]\s*$)"
+)
+
+
+def default_stop_options(
+    stop_sequences: Optional[List[str]] = None,
+    code_only: bool = False
+) -> Dict[str, Any]:
+    """代碼生成預設的停止選項（可序列化，傳給工作程序）"""
+    return {
+        "code_fence": True,
+        "balanced_braces": True,
+        "stop_sequences": list(stop_sequences or []),
+        "code_only": code_only
+    }
+
+
+class CodeStopScanner:
+    """逐段接收生成文字，判斷停止位置並產生裁切後的輸出
+
+    以完整的行為單位處理；大括號計數會略過字串、字元與註解中的大括號。
+    stop_at 為輸出應結束的位置（不含），停止後的文字一律捨棄。
+    """
+
+    def __init__(
+        self,
+        code_fence: bool = True,
+        balanced_braces: bool = True,
+        stop_sequences: Optional[List[str]] = None,
+        code_only: bool = False
+    ):
+        self.code_fence = code_fence
+        self.balanced_braces = balanced_braces
+        self.stop_sequences = [s for s in (stop_sequences or []) if s]
+        self.code_only = code_only
+
+        self.text = ""
+        self.stop_at: Optional[int] = None
+        self.reason: Optional[str] = None
+
+        self._line_start = 0
+        self._in_fence = False
+        self._fence_seen = False
+        self._code_start: Optional[int] = None  # 代碼區塊內容的起點
+        self._code_end: Optional[int] = None  # 代碼區塊結束標記的起點
+        self._depth = 0
+        self._opened = False  # 目前這段代碼是否出現過 {
+        self._pending_from: Optional[int] = None  # 大括號平衡的行尾，等待下一行判斷
+        self._in_block_comment = False
+        self._in_verbatim = False
+
+    @property
+    def stopped(self) -> bool:
+        """是否已達停止條件"""
+        return self.stop_at is not None
+
+    def feed(self, text: str):
+        """加入新生成的文字"""
+        if self.stopped or not text:
+            return
+        search_from = max(len(self.text) - max((len(s) for s in self.stop_sequences), default=0) + 1, 0)
+        self.text += text
+
+        while not self.stopped:
+            newline = self.text.find("\n", self._line_start)
+            if newline < 0:
+                break
+            self._process_line(self._line_start, newline)
+            self._line_start = newline + 1
+
+        # 不必等換行的情況：代碼區塊內只剩結束標記，或大括號平衡後的下一行以中文說明開頭
+        partial = self.text[self._line_start:].strip()
+        if not self.stopped and self._in_fence and partial == FENCE:
+            self._close_fence(self._line_start, len(self.text))
+        elif not self.stopped and self._pending_from is not None and partial and partial[0] >= "\u2e80":
+            self._stop(self._pending_from, "balanced_braces")
+
+        for sequence in self.stop_sequences:
+            index = self.text.find(sequence, search_from)
+            if index >= 0 and (self.stop_at is None or index < self.stop_at):
+                self._stop(index, "stop_sequence")
+
+    def finish(self):
+        """生成結束：處理最後一個不完整的行"""
+        if not self.stopped and self._line_start < len(self.text):
+            self._process_line(self._line_start, len(self.text))
+            self._line_start = len(self.text)
+
+    def _stop(self, offset: int, reason: str):
+        """記錄停止位置"""
+        self.stop_at = offset
+        self.reason = reason
+
+    def _process_line(self, start: int, end: int):
+        """處理一個完整的行"""
+        line = self.text[start:end]
+        stripped = line.strip()
+
+        if stripped.startswith(FENCE):
+            if self._in_fence:
+                self._close_fence(start, end)
+            elif self._pending_from is not None:
+                self._stop(self._pending_from, "balanced_braces")
+            else:
+                self._in_fence = True
+                self._fence_seen = True
+                self._code_start = end + 1
+                self._reset_braces()
+            return
+
+        if not stripped:
+            return
+
+        if self._pending_from is not None:
+            if CODE_LINE.match(line) or self._in_block_comment or self._in_verbatim:
+                self._pending_from = None
+            else:
+                self._stop(self._pending_from, "balanced_braces")
+                return
+
+        # 代碼區塊結束後的說明文字不計大括號
+        if self._in_fence or not self._fence_seen:
+            self._count_braces(line, end)
+
+    def _close_fence(self, start: int, end: int):
+        """代碼區塊結束"""
+        self._in_fence = False
+        self._code_end = start
+        self._pending_from = None
+        if self.code_fence or self.code_only:
+            self._stop(end, "code_fence")
+
+    def _reset_braces(self):
+        """重設大括號狀態"""
+        self._depth = 0
+        self._opened = False
+        self._pending_from = None
+        self._in_block_comment = False
+        self._in_verbatim = False
+
+    def _count_braces(self, line: str, end: int):
+        """計算一行的大括號深度（略過字串、字元與註解）"""
+        i = 0
+        string: Optional[str] = None  # 目前字串的結束字元
+        verbatim = self._in_verbatim
+        if verbatim:
+            string = '"'
+
+        while i < len(line):
+            char = line[i]
+            pair = line[i:i + 2]
+
+            if self._in_block_comment:
+                if pair == "*/":
+                    self._in_block_comment = False
+                    i += 2
+                    continue
+                i += 1
+                continue
+
+            if string is not None:
+                if verbatim and pair == '""':
+                    i += 2
+                    continue
+                if not verbatim and char == "\\":
+                    i += 2
+                    continue
+                if char == string:
+                    string = None
+                    verbatim = False
+                i += 1
+                continue
+
+            if pair == "//":
+                break
+            if pair == "/*":
+                self._in_block_comment = True
+                i += 2
+                continue
+            if char == '"':
+                string = '"'
+                verbatim = line[max(i - 2, 0):i].replace("$", "").endswith("@")
+            elif char == "'":
+                string = "'"
+            elif char == "{":
+                self._depth += 1
+                self._opened = True
+            elif char == "}":
+                self._depth = max(self._depth - 1, 0)
+            i += 1
+
+        self._in_verbatim = string is not None and verbatim
+        if self.balanced_braces and self._opened and self._depth == 0 and line.rstrip().endswith("}"):
+            self._pending_from = end
+
+    def output(self, final: bool = False) -> str:
+        """目前可輸出的文字
+
+        非最終結果時保留尚未確定的部分（等待判斷的行、可能是停止字串開頭的字元、結尾空白），
+        因此逐次輸出的結果一定是最終結果的前綴（最終結果會去除結尾空白）。
+        """
+        end = len(self.text)
+        if self.stopped:
+            end = self.stop_at
+        elif not final:
+            if self._pending_from is not None:
+                end = self._pending_from
+            else:
+                end = self._line_start if self.code_only else end
+            longest = max((len(s) for s in self.stop_sequences), default=0)
+            if longest > 1:
+                end = max(0, min(end, len(self.text) - longest + 1))
+
+        if self.code_only and self._code_start is not None:
+            code_end = end if self._code_end is None else min(end, self._code_end)
+            text = self.text[self._code_start:max(code_end, self._code_start)]
+        elif self.code_only and not final:
+            # 尚未出現代碼區塊：可能是前置說明，先不輸出
+            text = ""
+        else:
+            text = self.text[:end]
+
+        text = text.rstrip()
+        if not final:
+            return text
+        if self._in_fence and not self.code_only:
+            # 在代碼區塊內依大括號停止時補上結束標記
+            text += f"\n{FENCE}"
+        return text
+
+
+class CodeStoppingCriteria:
+    """代碼停止條件
+
+    可作為 transformers generate 的 stopping criteria（單一序列），
+    也可由批次排程器逐 token 呼叫 push。
+    """
+
+    def __init__(self, tokenizer: Any, prompt_length: int = 0, **options):
+        self.prompt_length = prompt_length
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.scanner = CodeStopScanner(**options)
+        self._seen = 0
+
+    def push(self, token_ids: List[int]) -> bool:
+        """加入新 token，回傳是否應停止"""
+        self.scanner.feed(self.decoder.push(token_ids))
+        return self.scanner.stopped
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs) -> Any:
+        import torch
+
+        start = self.prompt_length + self._seen
+        new_ids = input_ids[0, start:].tolist()
+        self._seen += len(new_ids)
+        stopped = self.push(new_ids) if new_ids else self.scanner.stopped
+        return torch.full((input_ids.shape[0],), stopped, dtype=torch.bool, device=input_ids.device)
+
+
+def trim_code_output(text: str, **options) -> str:
+    """依停止選項裁切完整的生成文字"""
+    scanner = CodeStopScanner(**options)
+    scanner.feed(text)
+    scanner.finish()
+    return scanner.output(final=True)
@@ -0,0 +1,263 @@
+"""
+檢索內容壓縮
+在 RAG 查詢結果放入提示詞之前，以句子為單位依查詢相似度做抽取式選取：
+重疊的段落（分割時的 chunk_overlap 或重複索引的文檔）只保留一次，代碼範例整段保留不切割。
+"""
+
+import math
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from services.code_stopping import CODE_LINE, FENCE
+
+# 句子結尾：中文標點，或英文標點後接空白（避免切開 Tekla.Structures.Model 這類名稱）
+SENTENCE_END = re.compile(r"(?<=[。！？；])|(?<=[.!?;:])\s+")
+WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[⺀-鿿]")
+
+
+def normalize_text(text: str) -> str:
+    """比對重複用的正規化文字（忽略空白與大小寫）"""
+    return re.sub(r"\s+", "", text).lower()
+
+
+def _is_code_run(lines: List[str]) -> bool:
+    """連續的行是否為未加標記的代碼範例"""
+    return (
+        len(lines) >= 2
+        and all(CODE_LINE.match(line) for line in lines)
+        and any(";" in line or "{" in line for line in lines)
+    )
+
+
+def split_units(text: str) -> List[Dict[str, Any]]:
+    """將段落切為句子與代碼區塊，回傳 [{"text", "start", "end", "code"}]（依原本順序）"""
+    units: List[Dict[str, Any]] = []
+    lines = text.splitlines(keepends=True)
+    offsets = []
+    position = 0
+    for line in lines:
+        offsets.append(position)
+        position += len(line)
+
+    def add(start: int, end: int, code: bool):
+        # 單元範圍不含前後空白（代碼保留第一行的縮排）
+        chunk = text[start:end]
+        stripped = chunk.strip("\r\n") if code else chunk.strip()
+        if not stripped.strip():
+            return
+        start += chunk.index(stripped)
+        units.append({"text": stripped.rstrip(), "start": start, "end": start + len(stripped.rstrip()), "code": code})
+
+    def add_prose(index: int):
+        line, start = lines[index], offsets[index]
+        cursor = 0
+        pieces = [m.end() for m in SENTENCE_END.finditer(line) if 0 < m.end() < len(line.rstrip())]
+        for end in pieces + [len(line)]:
+            add(start + cursor, start + end, False)
+            cursor = end
+
+    i = 0
+    while i < len(lines):
+        if lines[i].strip().startswith(FENCE):
+            # 代碼區塊整段保留；沒有對應結束標記的（段落在代碼區塊中間被切開）只略過標記本身
+            j = i + 1
+            while j < len(lines) and not lines[j].strip().startswith(FENCE):
+                j += 1
+            if j < len(lines):
+                add(offsets[i], offsets[j] + len(lines[j]), True)
+                i = j + 1
+            else:
+                i += 1
+            continue
+
+        j = i
+        while j < len(lines) and lines[j].strip() and CODE_LINE.match(lines[j]) and not lines[j].strip().startswith(FENCE):
+            j += 1
+        if _is_code_run(lines[i:j]):
+            add(offsets[i], offsets[j - 1] + len(lines[j - 1]), True)
+            i = j
+            continue
+
+        add_prose(i)
+        i += 1
+
+    return units
+
+
+class ContextCompressor:
+    """檢索內容的抽取式壓縮
+
+    encode 為嵌入函式（例如 SentenceTransformer.encode），以查詢與句子的餘弦相似度評分；
+    未提供時以詞彙重疊評分。每個段落保留相似度達 min_similarity 的句子（最多 max_keep_ratio 比例，
+    至少保留最相關的一句），代碼區塊不切割且預設一律保留。
+    """
+
+    def __init__(
+        self,
+        encode: Optional[Callable[[List[str]], Any]] = None,
+        min_similarity: float = 0.3,
+        max_keep_ratio: float = 0.5,
+        min_chunk_chars: int = 200,
+        keep_code: bool = True,
+        min_duplicate_chars: int = 12
+    ):
+        self.encode = encode
+        self.min_similarity = min_similarity
+        self.max_keep_ratio = max_keep_ratio
+        self.min_chunk_chars = min_chunk_chars  # 短於此長度的段落不壓縮（只去除重複）
+        self.keep_code = keep_code
+        self.min_duplicate_chars = min_duplicate_chars  # 短句（例如單獨的 }）不做重複比對
+        self.stats = {
+            "requests": 0,
+            "chunks": 0,
+            "duplicate_chunks": 0,
+            "duplicate_sentences": 0,
+            "sentences": 0,
+            "sentences_kept": 0,
+            "code_blocks": 0,
+            "original_chars": 0,
+            "compressed_chars": 0,
+            "seconds": 0.0
+        }
+
+    def compress(
+        self,
+        query: str,
+        results: Sequence[Dict[str, Any]]
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """壓縮 RAG 查詢結果，回傳 (結果, 本次壓縮報告)
+
+        回傳的結果保留原本的欄位與順序，content 換成壓縮後的文字，並附上 original_content
+        （AIService 以此計算省下的提示詞 token 與預填時間）；內容完全重複的段落會被移除。
+        """
+        started = time.perf_counter()
+        report = {
+            "chunks": len(results),
+            "duplicate_chunks": 0,
+            "duplicate_sentences": 0,
+            "sentences": 0,
+            "sentences_kept": 0,
+            "code_blocks": 0,
+            "original_chars": 0,
+            "compressed_chars": 0
+        }
+
+        # 依分數由高到低去除重複，較相關的段落保留重疊部分
+        order = sorted(range(len(results)), key=lambda i: results[i].get("score", 0.0), reverse=True)
+        seen: List[str] = []
+        chunk_units: Dict[int, List[Dict[str, Any]]] = {}
+        for index in order:
+            content = results[index].get("content") or ""
+            report["original_chars"] += len(content)
+            normalized = normalize_text(content)
+            if not normalized or any(normalized in previous for previous in seen):
+                report["duplicate_chunks"] += 1
+                continue
+
+            units = []
+            for unit in split_units(content):
+                key = normalize_text(unit["text"])
+                if len(key) >= self.min_duplicate_chars and any(key in previous for previous in seen):
+                    report["duplicate_sentences"] += 1
+                    continue
+                units.append(unit)
+            seen.append(normalized)
+            if units:
+                chunk_units[index] = units
+            else:
+                report["duplicate_chunks"] += 1
+
+        scores = self._score(query, [unit for index in sorted(chunk_units) for unit in chunk_units[index]])
+        compressed = []
+        for index in sorted(chunk_units):
+            units = chunk_units[index]
+            unit_scores, scores = scores[:len(units)], scores[len(units):]
+            kept = self._select(results[index]["content"], units, unit_scores)
+
+            report["sentences"] += sum(1 for unit in units if not unit["code"])
+            report["sentences_kept"] += sum(1 for i in kept if not units[i]["code"])
+            report["code_blocks"] += sum(1 for i in kept if units[i]["code"])
+
+            text = self._join(results[index]["content"], [units[i] for i in kept])
+            report["compressed_chars"] += len(text)
+            compressed.append({
+                **results[index],
+                "content": text,
+                "original_content": results[index].get("original_content", results[index]["content"])
+            })
+
+        report["compression_ratio"] = (
+            round(report["compressed_chars"] / report["original_chars"], 4) if report["original_chars"] else 1.0
+        )
+        report["seconds"] = round(time.perf_counter() - started, 4)
+
+        self.stats["requests"] += 1
+        for key in self.stats:
+            if key in report:
+                self.stats[key] += report[key]
+        return compressed, report
+
+    def _score(self, query: str, units: List[Dict[str, Any]]) -> List[float]:
+        """查詢與每個句子的相似度"""
+        if not units:
+            return []
+        texts = [unit["text"] for unit in units]
+        if self.encode is None:
+            return [self._lexical_similarity(query, text) for text in texts]
+
+        import numpy as np
+
+        embeddings = np.asarray(self.encode([query] + texts), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1)
+        norms[norms == 0] = 1.0
+        embeddings = embeddings / norms[:, None]
+        return (embeddings[1:] @ embeddings[0]).tolist()
+
+    @staticmethod
+    def _lexical_similarity(query: str, text: str) -> float:
+        """詞彙重疊（查詢詞在句子中出現的比例）"""
+        query_words = {word.lower() for word in WORD.findall(query)}
+        if not query_words:
+            return 0.0
+        text_words = {word.lower() for word in WORD.findall(text)}
+        return len(query_words & text_words) / len(query_words)
+
+    def _select(self, content: str, units: List[Dict[str, Any]], scores: List[float]) -> List[int]:
+        """選出要保留的單元索引（依原本順序）"""
+        if len(content) < self.min_chunk_chars:
+            return list(range(len(units)))
+
+        kept = {i for i, unit in enumerate(units) if unit["code"] and self.keep_code}
+        candidates = [i for i in range(len(units)) if i not in kept]
+        if not candidates:
+            return sorted(kept)
+
+        ranked = sorted(candidates, key=lambda i: scores[i], reverse=True)
+        limit = max(math.ceil(len(candidates) * self.max_keep_ratio), 1)
+        selected = [i for i in ranked[:limit] if scores[i] >= self.min_similarity]
+        if not selected and not kept:
+            selected = ranked[:1]
+        return sorted(kept.union(selected))
+
+    @staticmethod
+    def _join(content: str, units: List[Dict[str, Any]]) -> str:
+        """以原文中的間隔接回相鄰的單元，不相鄰的單元之間換行"""
+        parts = []
+        previous: Optional[Dict[str, Any]] = None
+        for unit in units:
+            if previous is not None:
+                gap = content[previous["end"]:unit["start"]]
+                parts.append(gap if not gap.strip() else "\n")
+            parts.append(unit["text"])
+            previous = unit
+        return "".join(parts).strip()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取壓縮統計"""
+        original = self.stats["original_chars"]
+        return {
+            **self.stats,
+            "seconds": round(self.stats["seconds"], 4),
+            "compression_ratio": round(self.stats["compressed_chars"] / original, 4) if original else 1.0
+        }
@@ -0,0 +1,44 @@
+"""
+CPU 推論後端
+無 CUDA 的節點以 int8 動態量化載入模型並調整執行緒數
+"""
+
+import io
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def configure_cpu_threads(num_threads: Optional[int] = None, interop_threads: Optional[int] = None):
+    """設定 torch CPU 執行緒數（None 表示沿用 torch 預設，即實體核心數）"""
+    import torch
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # 已有平行工作啟動後無法再變更
+            logger.warning("inter-op 執行緒數只能在第一次平行運算前設定，已略過")
+
+    logger.info(f"CPU 執行緒: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+
+def quantize_dynamic_int8(model: Any) -> Any:
+    """將所有 Linear 層轉為 int8 動態量化（權重 int8、激活值於執行時量化）"""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    model = model.to(torch.float32).eval()
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(model: Any) -> float:
+    """模型權重序列化後的大小（量化後的 packed 權重不算在參數內，故以 state_dict 計算）"""
+    import torch
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 / 1024
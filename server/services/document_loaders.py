@@ -0,0 +1,191 @@
+"""
+文檔載入器
+以程序池逐頁擷取 PDF / DOCX 文字，並以非同步迭代器依頁序串流輸出
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_SUFFIXES = {".pdf", ".docx"}
+
+
+def _count_pdf_pages(path: str) -> int:
+    """計算 PDF 頁數（於子程序執行）"""
+    from pypdf import PdfReader
+
+    return len(PdfReader(path).pages)
+
+
+def _extract_pdf_pages(path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """擷取 PDF 指定頁範圍的文字（於子程序執行）
+
+    pypdf 按需解析頁面內容，因此每個任務只會載入自己負責的頁面。
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    pages = []
+    for index in range(start, end):
+        try:
+            text = reader.pages[index].extract_text() or ""
+        except Exception as e:
+            logger.warning(f"擷取 PDF 第 {index + 1} 頁失敗 {path}: {e}")
+            text = ""
+        pages.append((index + 1, text))
+    return pages
+
+
+def _extract_docx_pages(path: str) -> List[Tuple[int, str]]:
+    """擷取 DOCX 文字並依分頁符號切分頁面（於子程序執行）
+
+    DOCX 沒有固定頁面，以手動分頁與 Word 記錄的分頁位置作為頁界；段落在分頁元素處切開，
+    分頁前的文字留在前一頁。每個分頁都會遞增頁碼（空白頁不回傳但保留頁碼），
+    只有文字會回傳給主程序。
+    """
+    import docx
+    from docx.oxml.ns import qn
+    from docx.table import Table
+
+    document = docx.Document(path)
+    pages: List[Tuple[int, str]] = []
+    current: List[str] = []  # 目前頁面的各行
+    line: List[str] = []  # 目前段落在本頁的文字
+    page = 1
+    has_text = False  # 上一個分頁之後是否出現過文字
+
+    def end_line():
+        text = "".join(line)
+        if text:
+            current.append(text)
+        line.clear()
+
+    def page_break():
+        nonlocal page, has_text
+        end_line()
+        text = "\n".join(current).strip()
+        if text:
+            pages.append((page, text))
+        current.clear()
+        page += 1
+        has_text = False
+
+    for child in document.element.body.iterchildren():
+        if child.tag == qn("w:p"):
+            for run in child.xpath("./w:r | ./w:hyperlink/w:r | ./w:ins/w:r"):
+                for element in run.iterchildren():
+                    if element.tag == qn("w:t"):
+                        line.append(element.text or "")
+                        has_text = has_text or bool((element.text or "").strip())
+                    elif element.tag == qn("w:tab"):
+                        line.append("\t")
+                    elif element.tag == qn("w:cr"):
+                        line.append("\n")
+                    elif element.tag == qn("w:br"):
+                        if element.get(qn("w:type")) == "page":
+                            page_break()
+                        else:
+                            line.append("\n")
+                    elif element.tag == qn("w:lastRenderedPageBreak") and has_text:
+                        # 緊接在手動分頁後的記錄是同一個分頁，不重複計算
+                        page_break()
+            end_line()
+        elif child.tag == qn("w:tbl"):
+            for row in Table(child, document).rows:
+                cells = [cell.text.strip() for cell in row.cells]
+                current.append(" | ".join(cells))
+                has_text = has_text or any(cells)
+
+    page_break()
+    return pages
+
+
+class DocumentPageLoader:
+    """PDF / DOCX 逐頁載入器"""
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        pages_per_task: int = 8,
+        max_pending_tasks: Optional[int] = None
+    ):
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.pages_per_task = pages_per_task
+        # 同時在途的任務數上限，避免整份文件的文字堆積在記憶體中
+        self.max_pending_tasks = max_pending_tasks or self.max_workers * 2
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @staticmethod
+    def supports(file_path: Path) -> bool:
+        """檢查是否支援此檔案格式"""
+        return file_path.suffix.lower() in SUPPORTED_SUFFIXES
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """延遲建立程序池（使用 spawn 避免複製已載入模型的父程序）"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def iter_pages(self, file_path: Path) -> AsyncIterator[Tuple[int, str]]:
+        """依頁序串流 (頁碼, 文字)"""
+        suffix = file_path.suffix.lower()
+        if suffix == ".pdf":
+            async for page in self._iter_pdf_pages(file_path):
+                yield page
+        elif suffix == ".docx":
+            async for page in self._iter_docx_pages(file_path):
+                yield page
+        else:
+            raise ValueError(f"不支援的檔案格式: {file_path}")
+
+    async def _iter_pdf_pages(self, file_path: Path) -> AsyncIterator[Tuple[int, str]]:
+        """平行擷取 PDF 頁面並依序輸出"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        path = str(file_path)
+
+        page_count = await loop.run_in_executor(executor, _count_pdf_pages, path)
+        ranges = deque(
+            (start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        )
+
+        pending: deque = deque()
+        try:
+            while ranges or pending:
+                while ranges and len(pending) < self.max_pending_tasks:
+                    start, end = ranges.popleft()
+                    pending.append(
+                        loop.run_in_executor(executor, _extract_pdf_pages, path, start, end)
+                    )
+
+                for page in await pending.popleft():
+                    yield page
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _iter_docx_pages(self, file_path: Path) -> AsyncIterator[Tuple[int, str]]:
+        """於子程序擷取 DOCX 頁面"""
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(
+            self._get_executor(), _extract_docx_pages, str(file_path)
+        )
+        for page in pages:
+            yield page
+
+    def shutdown(self):
+        """關閉程序池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,424 @@
+"""
+中央推論伺服器
+多工作程序部署時只在一個程序中載入模型，各 API 工作程序透過本機 socket（或具名管道）連線送出生成請求，
+而不是每個工作程序各載入一份模型。通訊協定與推論工作程序相同，用戶端即為連線版的 InferenceWorker。
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from services.inference_worker import InferenceWorker, InferenceWorkerError
+
+logger = logging.getLogger(__name__)
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address: str) -> Address:
+    """解析位址：「主機:埠」為 TCP，其餘（/tmp/inference.sock、\\\\.\\pipe\\inference）為 Unix socket 或具名管道"""
+    if address.startswith(("/", "\\\\", ".")):
+        return address
+    host, separator, port = address.rpartition(":")
+    if not separator or not port.isdigit():
+        raise ValueError(f"無效的推論伺服器位址: {address}（格式: 主機:埠 或 socket 路徑）")
+    return host or "127.0.0.1", int(port)
+
+
+def _authkey(address: Address, authkey: Optional[str]) -> Optional[bytes]:
+    """連線驗證金鑰（訊息以 pickle 傳遞，TCP 連線必須驗證）"""
+    if isinstance(address, tuple) and not authkey:
+        raise ValueError("TCP 位址的推論伺服器必須設定 authkey")
+    return authkey.encode("utf-8") if authkey else None
+
+
+def _remove_stale_socket(address: Address):
+    """移除崩潰的伺服器留下、已無人監聽的 Unix socket 檔案"""
+    if not isinstance(address, str) or not hasattr(socket, "AF_UNIX") or not os.path.exists(address):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(address)
+    except ConnectionRefusedError:
+        os.unlink(address)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
+class _ClientConnection:
+    """伺服器端的一條用戶端連線，回應由寫入執行緒依序送出（慢速用戶端不會阻塞事件迴圈）"""
+
+    def __init__(self, connection: Connection, number: int):
+        self.connection = connection
+        self.number = number
+        self.tasks: Dict[int, "asyncio.Task"] = {}
+        self._outbox: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        threading.Thread(target=self._write, name=f"inference-writer-{number}", daemon=True).start()
+
+    def send(self, message: tuple):
+        """排入待送出的回應"""
+        self._outbox.put(message)
+
+    def _write(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            try:
+                self.connection.send(message)
+            except (OSError, ValueError):
+                return
+
+    def close(self):
+        """結束寫入執行緒並關閉連線"""
+        self._outbox.put(None)
+        self.connection.close()
+
+
+class InferenceServer:
+    """中央推論伺服器：載入一次模型，服務多個 API 工作程序
+
+    service_kwargs 為伺服器程序中 AIService 的參數（可啟用連續批次排程或多副本，讓不同工作程序的請求共用解碼步驟）；
+    用戶端斷線時取消其進行中的請求。
+    """
+
+    def __init__(self, service_kwargs: Dict[str, Any], address: Address, authkey: Optional[str] = None):
+        self.service_kwargs = service_kwargs
+        self.address = address
+        self.authkey = _authkey(address, authkey)
+        self.service = None
+        self._listener: Optional[Listener] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Future] = None
+        self._clients: Dict[int, _ClientConnection] = {}
+        self._numbers = 0
+        self.stats = {
+            "connections": 0,
+            "requests": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "errors": 0
+        }
+
+    async def serve(self, on_ready: Optional[Callable[[Dict[str, Any]], None]] = None):
+        """載入模型、開始接受連線，直到 stop() 為止"""
+        from services.ai_service import AIService
+
+        self._loop = asyncio.get_running_loop()
+        self._stopped = self._loop.create_future()
+        self.service = AIService(**self.service_kwargs)
+        await self.service.initialize()
+
+        _remove_stale_socket(self.address)
+        self._listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, name="inference-accept", daemon=True).start()
+        logger.info(f"✅ 中央推論伺服器已就緒: {self._listener.address}")
+        if on_ready is not None:
+            on_ready(self.service.get_model_info())
+
+        try:
+            await self._stopped
+        finally:
+            self._listener.close()
+            for client in list(self._clients.values()):
+                self._disconnected(client)
+            await self.service.cleanup()
+
+    def stop(self):
+        """停止伺服器（可從其他執行緒呼叫）"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(lambda: self._stopped.done() or self._stopped.set_result(None))
+
+    def _accept(self):
+        """接受連線（於背景執行緒中執行）"""
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError) as e:
+                if self._stopped.done():
+                    return
+                # 驗證失敗或連線中途關閉
+                logger.warning(f"拒絕推論連線: {e}")
+                continue
+            self._loop.call_soon_threadsafe(self._connected, connection)
+
+    def _connected(self, connection: Connection):
+        """新的用戶端：回報模型資訊並開始讀取請求"""
+        self._numbers += 1
+        client = _ClientConnection(connection, self._numbers)
+        self._clients[client.number] = client
+        self.stats["connections"] += 1
+        client.send(("ready", None, self.service.get_model_info()))
+        threading.Thread(
+            target=self._read, args=(client,), name=f"inference-reader-{client.number}", daemon=True
+        ).start()
+        logger.info(f"推論用戶端 #{client.number} 已連線")
+
+    def _read(self, client: _ClientConnection):
+        """讀取用戶端訊息並轉交事件迴圈（於背景執行緒中執行）"""
+        while True:
+            try:
+                kind, message = client.connection.recv()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, client, kind, message)
+        self._loop.call_soon_threadsafe(self._disconnected, client)
+
+    def _dispatch(self, client: _ClientConnection, kind: str, message: Any):
+        """處理一則用戶端訊息"""
+        if message is None:
+            return
+        if kind == "request":
+            request_id, payload = message
+            self.stats["requests"] += 1
+            client.tasks[request_id] = self._loop.create_task(self._generate(client, request_id, payload))
+        elif kind == "control":
+            task = client.tasks.pop(message[1], None)
+            if task is not None:
+                task.cancel()
+                self.stats["cancelled"] += 1
+
+    async def _generate(self, client: _ClientConnection, request_id: int, payload: Dict[str, Any]):
+        """執行一個生成請求並回傳結果"""
+        from services.telemetry import GenerationTelemetry
+
+        try:
+            deadline = payload.pop("deadline", None)
+            timeout = deadline - time.time() if deadline is not None else None
+            if timeout is not None and timeout <= 0:
+                raise TimeoutError("請求在佇列中等待超過期限")
+
+            on_tokens = None
+            if payload.pop("stream", False):
+                on_tokens = lambda ids: client.send(("tokens", request_id, ids))
+
+            telemetry = GenerationTelemetry(len(payload["input_ids"]), payload.pop("submitted_at", None))
+            output_ids = await self.service._generate_ids(
+                **payload, on_tokens=on_tokens, timeout=timeout, telemetry=telemetry
+            )
+            client.send(("done", request_id, (output_ids, telemetry.to_dict())))
+            self.stats["completed"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            client.send(("error", request_id, (type(e).__name__, str(e))))
+            self.stats["errors"] += 1
+        finally:
+            client.tasks.pop(request_id, None)
+
+    def _disconnected(self, client: _ClientConnection):
+        """用戶端斷線：取消其進行中的請求"""
+        if self._clients.pop(client.number, None) is None:
+            return
+        for task in client.tasks.values():
+            task.cancel()
+        self.stats["cancelled"] += len(client.tasks)
+        client.tasks.clear()
+        client.close()
+        logger.info(f"推論用戶端 #{client.number} 已斷線")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取伺服器統計"""
+        return {
+            **self.stats,
+            "clients": len(self._clients),
+            "in_flight": sum(len(client.tasks) for client in self._clients.values())
+        }
+
+
+def _server_main(service_kwargs: Dict[str, Any], address: Address, authkey: Optional[str], status: Any):
+    """伺服器程序進入點"""
+    from utils.logger import setup_logger
+
+    setup_logger("services")
+    server = InferenceServer(service_kwargs, address, authkey)
+    try:
+        asyncio.run(server.serve(lambda info: status.put(("ready", info))))
+    except Exception as e:
+        status.put(("failed", str(e)))
+
+
+def start_inference_server(
+    service_kwargs: Dict[str, Any],
+    address: str,
+    authkey: Optional[str] = None,
+    startup_timeout: float = 900.0
+) -> multiprocessing.Process:
+    """在子程序中啟動中央推論伺服器並等待模型載入完成（於啟動 API 工作程序前呼叫）"""
+    context = multiprocessing.get_context("spawn")
+    status = context.Queue()
+    process = context.Process(
+        target=_server_main,
+        args=(service_kwargs, parse_address(address), authkey, status),
+        name="inference-server",
+        daemon=True
+    )
+    process.start()
+    try:
+        kind, data = status.get(timeout=startup_timeout)
+    except queue.Empty:
+        process.kill()
+        raise InferenceWorkerError(f"中央推論伺服器未在 {startup_timeout} 秒內就緒")
+    finally:
+        status.close()
+    if kind == "failed":
+        process.join()
+        raise InferenceWorkerError(f"中央推論伺服器初始化失敗: {data}")
+    logger.info(f"中央推論伺服器已啟動 (pid {process.pid}, {address})")
+    return process
+
+
+def _shutdown(connection: Connection):
+    """中斷連線並喚醒阻塞在 recv 的讀取執行緒（由讀取執行緒負責關閉連線，避免關閉使用中的檔案描述元）"""
+    try:
+        sock = socket.socket(fileno=os.dup(connection.fileno()))
+    except (OSError, ValueError):
+        # 具名管道或已關閉的連線
+        connection.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+class _Channel:
+    """以連線送出訊息、介面與 multiprocessing.Queue 相同的通道"""
+
+    def __init__(self, connection: Connection, kind: str, lock: threading.Lock):
+        self.connection = connection
+        self.kind = kind
+        self.lock = lock
+
+    def put(self, message: Any):
+        # None 為推論工作程序的停止訊號；中央伺服器由啟動者負責停止
+        if message is None:
+            return
+        with self.lock:
+            self.connection.send((self.kind, message))
+
+    def close(self):
+        _shutdown(self.connection)
+
+    def cancel_join_thread(self):
+        pass
+
+
+class _ServerLink:
+    """以連線代表中央伺服器，提供 InferenceWorker 使用的程序介面"""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.pid = None
+        self.exitcode = None
+        self.stopped = False  # 由本端停止，不視為伺服器異常
+
+    def is_alive(self) -> bool:
+        return not self.stopped and not self.connection.closed
+
+    def join(self, timeout: Optional[float] = None):
+        self.stopped = True
+        _shutdown(self.connection)
+
+    def kill(self):
+        self.join()
+
+
+class RemoteInferenceWorker(InferenceWorker):
+    """中央推論伺服器的用戶端（在 API 工作程序的事件迴圈中使用）
+
+    請求、串流、取消與期限的處理與 InferenceWorker 相同；連線中斷時進行中的請求失敗，並自動重新連線。
+    """
+
+    def __init__(
+        self,
+        address: str,
+        authkey: Optional[str] = None,
+        max_queue_size: int = 64,
+        connect_timeout: float = 900.0,
+        timeout_grace: float = 5.0,
+        reconnect: bool = True
+    ):
+        super().__init__(
+            {},
+            max_queue_size=max_queue_size,
+            startup_timeout=connect_timeout,
+            timeout_grace=timeout_grace,
+            restart_on_crash=reconnect
+        )
+        self.address = parse_address(address)
+        self.authkey = _authkey(self.address, authkey)
+
+    async def _spawn(self):
+        """連線到中央伺服器並等待就緒訊息
+
+        伺服器尚在載入模型、或連線在就緒前中斷（例如舊的伺服器正在結束）時持續重試，直到 startup_timeout。
+        """
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            self._ready = self._loop.create_future()
+            try:
+                connection = await self._loop.run_in_executor(
+                    None, lambda: Client(self.address, authkey=self.authkey)
+                )
+            except (ConnectionRefusedError, FileNotFoundError) as e:
+                error: Exception = e
+            else:
+                self._attach(connection)
+                try:
+                    self.model_info = await asyncio.wait_for(
+                        asyncio.shield(self._ready), max(deadline - time.monotonic(), 0)
+                    )
+                    logger.info(f"已連線到中央推論伺服器: {self.address}")
+                    return
+                except asyncio.TimeoutError:
+                    self._process.kill()
+                    raise InferenceWorkerError(f"中央推論伺服器未在 {self.startup_timeout} 秒內回應")
+                except InferenceWorkerError as e:
+                    error = e
+
+            if time.monotonic() >= deadline:
+                raise InferenceWorkerError(f"無法連線到中央推論伺服器 {self.address}: {error}")
+            await asyncio.sleep(0.5)
+
+    def _attach(self, connection: Connection):
+        """以新連線取代請求與控制通道，並開始讀取回應"""
+        lock = threading.Lock()
+        self._requests = _Channel(connection, "request", lock)
+        self._controls = _Channel(connection, "control", lock)
+        self._process = _ServerLink(connection)
+        threading.Thread(
+            target=self._read_connection,
+            args=(self._process,),
+            name="inference-client-reader",
+            daemon=True
+        ).start()
+
+    def _read_connection(self, link: _ServerLink):
+        """讀取伺服器回應並轉交事件迴圈（於背景執行緒中執行）"""
+        while True:
+            try:
+                message = link.connection.recv()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+        link.connection.close()
+        if not link.stopped:
+            self._loop.call_soon_threadsafe(self._on_exit, link)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取用戶端統計"""
+        stats = super().get_stats()
+        stats["address"] = str(self.address)
+        return stats
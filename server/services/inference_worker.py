@@ -0,0 +1,382 @@
+"""
+推論工作程序
+在獨立子程序中載入模型並依序處理生成請求，API 程序的事件迴圈不會被生成阻塞；
+工作程序崩潰時只會讓進行中的請求失敗，並可自動重新啟動。
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from services.telemetry import GenerationTelemetry
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceWorkerError(RuntimeError):
+    """推論工作程序無法啟動或異常結束"""
+
+
+def _worker_main(
+    service_kwargs: Dict[str, Any],
+    torch_threads: Optional[int],
+    requests: Any,
+    responses: Any,
+    controls: Any
+):
+    """工作程序進入點：載入模型後逐一處理請求"""
+    from services.ai_service import AIService
+    from services.telemetry import GenerationTelemetry
+    from utils.logger import setup_logger
+
+    setup_logger("services")
+    if torch_threads:
+        import torch
+
+        torch.set_num_threads(torch_threads)
+
+    service = AIService(**service_kwargs)
+    try:
+        asyncio.run(service.initialize())
+    except Exception as e:
+        responses.put(("failed", None, str(e)))
+        return
+
+    # 取消訊息由獨立執行緒接收，透過停止條件在下一個解碼步驟生效
+    lock = threading.Lock()
+    events: Dict[int, threading.Event] = {}
+    cancelled = set()  # 仍在佇列中、取出時略過的請求
+    last_received = -1  # 請求依 id 遞增的順序送達
+
+    def watch_controls():
+        while True:
+            message = controls.get()
+            if message is None:
+                return
+            request_id = message[1]
+            with lock:
+                event = events.get(request_id)
+                # 已完成的請求不記錄，避免集合無限增長
+                if event is None and request_id > last_received:
+                    cancelled.add(request_id)
+            if event is not None:
+                event.set()
+
+    threading.Thread(target=watch_controls, name="inference-controls", daemon=True).start()
+    responses.put(("ready", None, service.get_model_info()))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+
+        request_id, payload = message
+        with lock:
+            last_received = request_id
+            if request_id in cancelled:
+                cancelled.discard(request_id)
+                continue
+            event = events[request_id] = threading.Event()
+
+        try:
+            deadline = payload.get("deadline")
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError("請求在佇列中等待超過期限")
+
+            on_tokens = None
+            if payload.pop("stream", False):
+                on_tokens = lambda ids, rid=request_id: responses.put(("tokens", rid, ids))
+
+            telemetry = GenerationTelemetry(len(payload["input_ids"]), payload.pop("submitted_at", None))
+            output_ids = service._generate_sync(
+                **payload, on_tokens=on_tokens, stop_event=event, telemetry=telemetry
+            )
+            responses.put(("done", request_id, (output_ids, telemetry.to_dict())))
+        except Exception as e:
+            responses.put(("error", request_id, (type(e).__name__, str(e))))
+        finally:
+            with lock:
+                events.pop(request_id, None)
+
+
+class _PendingRequest:
+    """等待工作程序回應的請求"""
+
+    def __init__(
+        self,
+        future: asyncio.Future,
+        on_tokens: Optional[Callable[[List[int]], None]],
+        telemetry: Optional["GenerationTelemetry"] = None
+    ):
+        self.future = future
+        self.on_tokens = on_tokens
+        self.telemetry = telemetry
+
+
+class InferenceWorker:
+    """推論工作程序用戶端（在 API 程序的事件迴圈中使用）
+
+    請求透過佇列送往子程序；每個請求可設定期限，取消與逾時會通知子程序停止生成。
+    """
+
+    def __init__(
+        self,
+        service_kwargs: Dict[str, Any],
+        max_queue_size: int = 64,
+        startup_timeout: float = 900.0,
+        timeout_grace: float = 5.0,
+        restart_on_crash: bool = True,
+        torch_threads: Optional[int] = None
+    ):
+        self.service_kwargs = service_kwargs
+        self.max_queue_size = max_queue_size
+        self.startup_timeout = startup_timeout
+        self.timeout_grace = timeout_grace  # 子程序未能自行停止時，額外等待的秒數
+        self.restart_on_crash = restart_on_crash
+        self.torch_threads = torch_threads  # 子程序的 torch 執行緒數（多個 CPU 副本時避免互搶核心）
+
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._requests = None
+        self._responses = None
+        self._controls = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._pending: Dict[int, _PendingRequest] = {}
+        self._ids = itertools.count()
+        self._stopping = False
+
+        self.model_info: Dict[str, Any] = {}
+        self.stats = {
+            "requests": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "crashes": 0,
+            "restarts": 0
+        }
+
+    async def start(self):
+        """啟動工作程序並等待模型載入完成"""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        await self._spawn()
+
+    async def _spawn(self):
+        """建立子程序與通訊佇列"""
+        self._ready = self._loop.create_future()
+        self._requests = self._context.Queue()
+        self._responses = self._context.Queue()
+        self._controls = self._context.Queue()
+        self._process = self._context.Process(
+            target=_worker_main,
+            args=(self.service_kwargs, self.torch_threads, self._requests, self._responses, self._controls),
+            name="inference-worker",
+            daemon=True
+        )
+        self._process.start()
+        logger.info(f"推論工作程序已啟動 (pid {self._process.pid})")
+
+        threading.Thread(
+            target=self._read_responses,
+            args=(self._process, self._responses),
+            name="inference-reader",
+            daemon=True
+        ).start()
+
+        try:
+            self.model_info = await asyncio.wait_for(asyncio.shield(self._ready), self.startup_timeout)
+        except asyncio.TimeoutError:
+            self._process.kill()
+            raise InferenceWorkerError(f"推論工作程序未在 {self.startup_timeout} 秒內就緒")
+
+    def _read_responses(self, process: Any, responses: Any):
+        """讀取子程序回應並轉交事件迴圈（於背景執行緒中執行）"""
+        while True:
+            try:
+                message = responses.get(timeout=0.5)
+            except queue.Empty:
+                if not process.is_alive():
+                    break
+                continue
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+
+        self._loop.call_soon_threadsafe(self._on_exit, process)
+
+    def _dispatch(self, message: tuple):
+        """處理一則子程序回應"""
+        kind, request_id, data = message
+
+        if kind == "ready":
+            if not self._ready.done():
+                self._ready.set_result(data)
+            return
+        if kind == "failed":
+            if not self._ready.done():
+                self._ready.set_exception(InferenceWorkerError(f"推論工作程序初始化失敗: {data}"))
+            return
+
+        pending = self._pending.get(request_id)
+        if pending is None:
+            return
+        if kind == "tokens":
+            if pending.on_tokens is not None:
+                pending.on_tokens(data)
+            return
+
+        del self._pending[request_id]
+        if pending.future.done():
+            return
+        if kind == "done":
+            output_ids, telemetry = data
+            if pending.telemetry is not None:
+                pending.telemetry.update(telemetry)
+            pending.future.set_result(output_ids)
+            self.stats["completed"] += 1
+        else:
+            name, detail = data
+            if name == "TimeoutError":
+                # 子程序依期限停止，與本地逾時同樣計入
+                pending.future.set_exception(TimeoutError(detail))
+                self.stats["timeouts"] += 1
+            else:
+                pending.future.set_exception(InferenceWorkerError(f"{name}: {detail}"))
+                self.stats["errors"] += 1
+
+    def _on_exit(self, process: Any):
+        """子程序結束：讓進行中的請求失敗，必要時重新啟動"""
+        if process is not self._process or self._stopping:
+            return
+
+        self._close_queues()
+        error = InferenceWorkerError(f"推論工作程序異常結束 (exit code {process.exitcode})")
+        if not self._ready.done():
+            self._ready.set_exception(error)
+            return
+
+        logger.error(f"{error}，{len(self._pending)} 個請求失敗")
+        self.stats["crashes"] += 1
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(error)
+        self._pending.clear()
+
+        if self.restart_on_crash:
+            self.stats["restarts"] += 1
+            self._loop.create_task(self._restart())
+
+    async def _restart(self):
+        """重新啟動崩潰的工作程序"""
+        try:
+            await self._spawn()
+            logger.info("推論工作程序已重新啟動")
+        except Exception as e:
+            logger.error(f"推論工作程序重新啟動失敗: {e}")
+
+    def is_alive(self) -> bool:
+        """工作程序是否執行中"""
+        return self._process is not None and self._process.is_alive()
+
+    async def generate(
+        self,
+        payload: Dict[str, Any],
+        on_tokens: Optional[Callable[[List[int]], None]] = None,
+        timeout: Optional[float] = None,
+        telemetry: Optional["GenerationTelemetry"] = None
+    ) -> List[int]:
+        """送出生成請求並等待結果（新 token id）
+
+        payload 為 AIService._generate_sync 的參數；on_tokens 在事件迴圈中接收串流 token；
+        telemetry 會合併子程序量測的排隊、預填與解碼時間。
+        """
+        if not self.is_alive():
+            raise InferenceWorkerError("推論工作程序未執行")
+        if len(self._pending) >= self.max_queue_size:
+            raise RuntimeError(f"推論佇列已滿 ({self.max_queue_size})")
+
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = _PendingRequest(future, on_tokens, telemetry)
+        self.stats["requests"] += 1
+
+        self._requests.put((request_id, {
+            **payload,
+            "stream": on_tokens is not None,
+            "deadline": time.time() + timeout if timeout else None,
+            "submitted_at": telemetry.submitted_at if telemetry is not None else time.time()
+        }))
+
+        try:
+            # 子程序依期限自行停止；額外寬限時間內仍無回應（例如單一步驟過久）則直接放棄
+            done, _ = await asyncio.wait({future}, timeout=timeout + self.timeout_grace if timeout else None)
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            self._cancel(request_id)
+            raise
+        if not done:
+            self.stats["timeouts"] += 1
+            self._cancel(request_id)
+            raise TimeoutError(f"推論工作程序未在 {timeout} 秒內完成")
+        return future.result()
+
+    def _cancel(self, request_id: int):
+        """通知子程序停止請求"""
+        pending = self._pending.pop(request_id, None)
+        if pending is None:
+            return
+        pending.future.cancel()
+        try:
+            self._controls.put(("cancel", request_id))
+        except (ValueError, OSError):
+            pass
+
+    async def stop(self):
+        """停止工作程序"""
+        self._stopping = True
+        if self._process is None:
+            return
+
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(InferenceWorkerError("推論工作程序已停止"))
+        self._pending.clear()
+
+        process = self._process
+        try:
+            self._requests.put(None)
+            self._controls.put(None)
+        except (ValueError, OSError):
+            pass
+
+        await self._loop.run_in_executor(None, process.join, 10)
+        if process.is_alive():
+            process.kill()
+            await self._loop.run_in_executor(None, process.join)
+        self._close_queues()
+        self._process = None
+
+    def _close_queues(self):
+        """關閉與目前子程序的通訊佇列"""
+        for channel in (self._requests, self._responses, self._controls):
+            if channel is not None:
+                channel.close()
+                channel.cancel_join_thread()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取工作程序統計"""
+        return {
+            **self.stats,
+            "alive": self.is_alive(),
+            "pid": self._process.pid if self._process is not None else None,
+            "pending": len(self._pending),
+            "max_queue_size": self.max_queue_size
+        }
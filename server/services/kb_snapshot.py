@@ -0,0 +1,121 @@
+"""
+知識庫快照
+將處理後的文檔集合編譯為二進位快照，來源未變更時直接載入
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 快照格式或文檔結構變更時需遞增
+SNAPSHOT_SCHEMA_VERSION = 2
+
+
+def file_sha256(path: Path, block_size: int = 1024 * 1024) -> str:
+    """計算檔案 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class KnowledgeSnapshot:
+    """知識庫快照管理"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._cached_sources: Dict[str, Dict[str, Any]] = {}
+
+    def fingerprint(self, sources: Iterable[Path]) -> Dict[str, Dict[str, Any]]:
+        """計算來源檔案指紋
+
+        大小與修改時間皆未變更時沿用上次的雜湊值，避免每次啟動重新讀取大型 PDF；
+        只要其中一項變更就重新計算內容雜湊，因此單純 touch 不會使快照失效。
+        """
+        fingerprints = {}
+        for source in sorted(Path(p) for p in sources):
+            stat = source.stat()
+            key = str(source)
+            previous = self._cached_sources.get(key)
+            if previous and previous["size"] == stat.st_size and \
+                    previous["mtime_ns"] == stat.st_mtime_ns:
+                sha256 = previous["sha256"]
+            else:
+                sha256 = file_sha256(source)
+            fingerprints[key] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": sha256
+            }
+        return fingerprints
+
+    def load(self, sources: Iterable[Path], config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """載入快照；結構版本、設定或來源不一致時回傳 None"""
+        if not self.path.exists():
+            return None
+
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"讀取知識庫快照失敗，將重新建立: {e}")
+            return None
+
+        if snapshot.get("schema_version") != SNAPSHOT_SCHEMA_VERSION:
+            logger.info("知識庫快照版本不符，將重新建立")
+            return None
+
+        if snapshot.get("config") != config:
+            logger.info("知識庫設定已變更，將重新建立快照")
+            return None
+
+        self._cached_sources = snapshot.get("sources", {})
+        current = self.fingerprint(sources)
+        if {k: v["sha256"] for k, v in current.items()} != \
+                {k: v["sha256"] for k, v in self._cached_sources.items()}:
+            logger.info("知識庫來源已變更，將重新建立快照")
+            return None
+
+        # 僅修改時間不同時更新快照中的指紋，下次啟動可直接比對
+        if current != self._cached_sources:
+            snapshot["sources"] = current
+            self._write(snapshot)
+
+        return snapshot
+
+    def save(
+        self,
+        sources: Iterable[Path],
+        config: Dict[str, Any],
+        documents: List[Dict],
+        **extra: Any
+    ):
+        """寫入快照"""
+        snapshot = {
+            "schema_version": SNAPSHOT_SCHEMA_VERSION,
+            "config": config,
+            "sources": self.fingerprint(sources),
+            "documents": documents,
+            **extra
+        }
+        self._write(snapshot)
+        self._cached_sources = snapshot["sources"]
+        logger.info(f"✅ 知識庫快照已寫入: {self.path}")
+
+    def _write(self, snapshot: Dict[str, Any]):
+        """以暫存檔原子寫入"""
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def invalidate(self):
+        """刪除快照"""
+        self.path.unlink(missing_ok=True)
+        self._cached_sources = {}
@@ -0,0 +1,74 @@
+"""
+KV 快取工具
+在 transformers 各版本的快取物件與逐層 (key, value) 張量之間轉換
+
+張量形狀皆為 [batch, heads, seq_len, head_dim]（Llama / DeepSeek-Coder 架構）。
+"""
+
+from typing import Any, List, Sequence, Tuple
+
+# 逐層 (key, value)
+CacheLayers = List[Tuple[Any, Any]]
+
+
+def cache_to_layers(cache: Any) -> CacheLayers:
+    """將模型回傳的 past_key_values 轉為逐層 (key, value)"""
+    if cache is None:
+        return []
+    if hasattr(cache, "layers"):
+        # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    if hasattr(cache, "to_legacy_cache"):
+        return [tuple(layer) for layer in cache.to_legacy_cache()]
+    return [tuple(layer) for layer in cache]
+
+
+def layers_to_cache(layers: Sequence[Tuple[Any, Any]]) -> Any:
+    """將逐層 (key, value) 轉回模型可接受的快取物件"""
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(list(layers))
+
+
+def layers_seq_length(layers: CacheLayers) -> int:
+    """快取涵蓋的序列長度"""
+    return layers[0][0].shape[2] if layers else 0
+
+
+def layers_nbytes(layers: CacheLayers) -> int:
+    """快取佔用的位元組數"""
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in layers
+    )
+
+
+def clone_layers(layers: CacheLayers) -> CacheLayers:
+    """複製快取（共用前綴被生成過程原地擴充前需先複製）"""
+    return [(key.clone(), value.clone()) for key, value in layers]
+
+
+def left_pad_layers(layers: CacheLayers, target_length: int) -> CacheLayers:
+    """在序列維度左側補零至指定長度"""
+    import torch
+
+    padded = []
+    for key, value in layers:
+        pad = target_length - key.shape[2]
+        if pad > 0:
+            key = torch.cat([key.new_zeros(key.shape[0], key.shape[1], pad, key.shape[3]), key], dim=2)
+            value = torch.cat([value.new_zeros(value.shape[0], value.shape[1], pad, value.shape[3]), value], dim=2)
+        padded.append((key, value))
+    return padded
+
+
+def select_layers(layers: CacheLayers, batch_index: Any, start: int = 0) -> CacheLayers:
+    """選取批次列並裁掉序列開頭 start 個位置"""
+    return [
+        (key[batch_index, :, start:], value[batch_index, :, start:])
+        for key, value in layers
+    ]
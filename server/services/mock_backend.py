@@ -0,0 +1,148 @@
+"""
+模擬推論後端
+簡化伺服器以此模擬各端點的處理時間（可設定的延遲分布），取代固定的 asyncio.sleep；
+負載測試可切換為零延遲後端，單獨量測框架本身的開銷。
+"""
+
+import asyncio
+import math
+import random
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+ENDPOINTS = ("chat", "rag", "tekla", "token")
+
+# 預設後端：chat / rag / tekla 為每個請求的處理時間，token 為串流每個片段的間隔（秒）
+PRESETS = {
+    # 與原本固定等待相同
+    "default": "chat=const:0.5,rag=zero,tekla=const:1.0,token=const:0.02",
+    # 沒有任何模擬延遲，只剩框架與序列化的開銷
+    "zero": "chat=zero,rag=zero,tekla=zero,token=zero",
+    # 接近單張 GPU 上 7B 模型的分布（長尾）
+    "gpu": "chat=lognormal:1.2:0.5,rag=lognormal:0.03:0.3,tekla=lognormal:2.5:0.5,token=const:0.025"
+}
+
+
+# 目前請求累計的模擬延遲（由伺服器的中介層設定，用於回報框架開銷）
+request_delay: ContextVar[Optional[List[float]]] = ContextVar("mock_request_delay", default=None)
+
+
+class LatencyDistribution:
+    """延遲分布（秒）
+
+    格式：zero、const:秒、uniform:最小:最大、normal:平均:標準差、
+    lognormal:中位數:sigma、exp:平均；取樣結果不小於 0。
+    """
+
+    KINDS = {"zero": 0, "const": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exp": 1}
+
+    def __init__(self, spec: str):
+        kind, *params = spec.strip().split(":")
+        if kind not in self.KINDS:
+            raise ValueError(f"未知的延遲分布: {kind}（可用: {', '.join(self.KINDS)}）")
+        if len(params) != self.KINDS[kind]:
+            raise ValueError(f"延遲分布 {kind} 需要 {self.KINDS[kind]} 個參數: {spec}")
+        try:
+            self.params = [float(param) for param in params]
+        except ValueError:
+            raise ValueError(f"延遲分布參數必須是數字: {spec}") from None
+        if any(param < 0 for param in self.params):
+            raise ValueError(f"延遲分布參數不可為負數: {spec}")
+
+        self.kind = kind
+        self.spec = ":".join([kind, *params])
+
+    def sample(self, rng: random.Random) -> float:
+        """取樣一個延遲"""
+        if self.kind == "zero":
+            return 0.0
+        if self.kind == "const":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "normal":
+            return max(rng.gauss(*self.params), 0.0)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+
+    @property
+    def mean(self) -> float:
+        """分布的平均值（未考慮截斷）"""
+        if self.kind == "zero":
+            return 0.0
+        if self.kind == "uniform":
+            return sum(self.params) / 2
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return median * math.exp(sigma ** 2 / 2)
+        return self.params[0]
+
+
+class MockBackend:
+    """各端點延遲可設定的模擬後端
+
+    spec 為預設名稱（見 PRESETS）或「端點=分布」以逗號分隔的設定，未指定的端點沿用 default；
+    error_rate 為隨機回傳錯誤的比例，用於驗證負載測試的錯誤統計。
+    """
+
+    def __init__(self, spec: str = "default", error_rate: float = 0.0, seed: Optional[int] = None):
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError(f"error_rate 必須介於 0 與 1 之間: {error_rate}")
+
+        self.distributions = self._parse(PRESETS["default"])
+        self.distributions.update(self._parse(PRESETS.get(spec, spec)))
+        self.name = spec if spec in PRESETS else "custom"
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self.stats = {endpoint: {"requests": 0, "errors": 0, "delay_seconds": 0.0} for endpoint in ENDPOINTS}
+
+    @staticmethod
+    def _parse(spec: str) -> Dict[str, LatencyDistribution]:
+        """解析「端點=分布」設定"""
+        distributions = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            endpoint, separator, distribution = item.partition("=")
+            if not separator or endpoint not in ENDPOINTS:
+                raise ValueError(f"無效的後端設定: {item}（端點: {', '.join(ENDPOINTS)}）")
+            distributions[endpoint] = LatencyDistribution(distribution)
+        return distributions
+
+    async def delay(self, endpoint: str):
+        """依端點的分布等待，依 error_rate 拋出 RuntimeError"""
+        seconds = self.distributions[endpoint].sample(self._rng)
+        stats = self.stats[endpoint]
+        stats["requests"] += 1
+        stats["delay_seconds"] += seconds
+        accumulated = request_delay.get()
+        if accumulated is not None:
+            accumulated[0] += seconds
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+        if self.error_rate and endpoint != "token" and self._rng.random() < self.error_rate:
+            stats["errors"] += 1
+            raise RuntimeError("模擬後端錯誤")
+
+    def get_config(self) -> Dict[str, Any]:
+        """目前的設定"""
+        return {
+            "backend": self.name,
+            "error_rate": self.error_rate,
+            "latency": {
+                endpoint: {"spec": distribution.spec, "mean_seconds": round(distribution.mean, 4)}
+                for endpoint, distribution in self.distributions.items()
+            },
+            "presets": PRESETS
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各端點的請求數與模擬延遲"""
+        return {
+            endpoint: {
+                **stats,
+                "delay_seconds": round(stats["delay_seconds"], 4),
+                "mean_delay_seconds": round(stats["delay_seconds"] / stats["requests"], 4) if stats["requests"] else 0.0
+            }
+            for endpoint, stats in self.stats.items()
+        }
@@ -0,0 +1,222 @@
+"""
+多副本模型池
+每個副本是一個綁定單一裝置（GPU 或 CPU）的推論工作程序，
+請求分派給未完成 token 數最少的健康副本，失敗的副本自動移出分派。
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from services.inference_worker import InferenceWorker, InferenceWorkerError
+
+if TYPE_CHECKING:
+    from services.telemetry import GenerationTelemetry
+
+logger = logging.getLogger(__name__)
+
+
+class ModelReplica:
+    """模型副本與其負載狀態"""
+
+    def __init__(self, index: int, device: str, worker: InferenceWorker):
+        self.index = index
+        self.device = device
+        self.worker = worker
+        self.healthy = False
+        self.outstanding_tokens = 0  # 已分派但未完成請求的 (提示詞 + 最大生成) token 數
+        self.active_requests = 0
+        self.completed = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取副本狀態"""
+        return {
+            "index": self.index,
+            "device": self.device,
+            "healthy": self.healthy,
+            "pid": self.worker.get_stats()["pid"],
+            "outstanding_tokens": self.outstanding_tokens,
+            "active_requests": self.active_requests,
+            "completed": self.completed,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
+
+
+class ModelPool:
+    """多副本推論池，介面與 InferenceWorker 相同（start / generate / stop / get_stats）"""
+
+    def __init__(
+        self,
+        service_kwargs: Dict[str, Any],
+        devices: List[str],
+        max_queue_size: int = 64,
+        torch_threads: Optional[int] = None,
+        startup_timeout: float = 900.0
+    ):
+        self.max_queue_size = max_queue_size  # 每個副本
+        self.replicas = [
+            ModelReplica(
+                index,
+                device,
+                InferenceWorker(
+                    {**service_kwargs, "device_map": device},
+                    max_queue_size=max_queue_size,
+                    startup_timeout=startup_timeout,
+                    restart_on_crash=False,
+                    torch_threads=torch_threads
+                )
+            )
+            for index, device in enumerate(devices)
+        ]
+        self.stats = {"requests": 0, "retries": 0, "removed_replicas": 0, "session_affinity_hits": 0}
+        self._session_replicas: "OrderedDict[str, int]" = OrderedDict()  # 工作階段上次使用的副本
+        self.max_session_affinity = 4096
+
+    @property
+    def model_info(self) -> Dict[str, Any]:
+        """第一個健康副本回報的模型資訊"""
+        for replica in self.replicas:
+            if replica.healthy:
+                return replica.worker.model_info
+        return {}
+
+    async def start(self):
+        """平行啟動所有副本；無法啟動的副本不加入分派"""
+        results = await asyncio.gather(
+            *(replica.worker.start() for replica in self.replicas),
+            return_exceptions=True
+        )
+        for replica, result in zip(self.replicas, results):
+            if isinstance(result, BaseException):
+                self._remove(replica, str(result))
+            else:
+                replica.healthy = True
+                logger.info(f"模型副本 {replica.index} ({replica.device}) 已就緒")
+
+        if not self.is_alive():
+            raise InferenceWorkerError("沒有任何模型副本成功啟動")
+
+    def is_alive(self) -> bool:
+        """是否仍有健康副本"""
+        return any(replica.healthy for replica in self.replicas)
+
+    def _select(
+        self,
+        exclude: List[ModelReplica],
+        session_id: Optional[str] = None,
+        cost: int = 0
+    ) -> Optional[ModelReplica]:
+        """選出未完成 token 數最少、佇列未滿的健康副本
+
+        工作階段優先回到保存其 KV 快取的副本，除非該副本比最空閒的副本多出超過一個請求的負載。
+        """
+        candidates = []
+        for replica in self.replicas:
+            if not replica.healthy or replica in exclude:
+                continue
+            if not replica.worker.is_alive():
+                self._remove(replica, "工作程序已結束")
+                continue
+            if replica.active_requests < self.max_queue_size:
+                candidates.append(replica)
+
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda r: (r.outstanding_tokens, r.active_requests, r.index))
+
+        index = self._session_replicas.get(session_id) if session_id is not None else None
+        for replica in candidates:
+            if replica.index == index and replica.outstanding_tokens <= best.outstanding_tokens + cost:
+                self.stats["session_affinity_hits"] += 1
+                return replica
+        return best
+
+    def _remember_session(self, session_id: Optional[str], replica: ModelReplica):
+        """記錄工作階段使用的副本"""
+        if session_id is None:
+            return
+        self._session_replicas.pop(session_id, None)
+        self._session_replicas[session_id] = replica.index
+        while len(self._session_replicas) > self.max_session_affinity:
+            self._session_replicas.popitem(last=False)
+
+    def _remove(self, replica: ModelReplica, reason: str):
+        """將副本移出分派並停止其工作程序"""
+        was_healthy = replica.healthy
+        replica.healthy = False
+        replica.last_error = reason
+        if was_healthy:
+            self.stats["removed_replicas"] += 1
+            logger.error(f"模型副本 {replica.index} ({replica.device}) 已移除: {reason}")
+        asyncio.ensure_future(replica.worker.stop())
+
+    async def generate(
+        self,
+        payload: Dict[str, Any],
+        on_tokens: Optional[Callable[[List[int]], None]] = None,
+        timeout: Optional[float] = None,
+        telemetry: Optional["GenerationTelemetry"] = None
+    ) -> List[int]:
+        """分派生成請求；副本在輸出任何 token 前失敗時改由其他副本重試"""
+        self.stats["requests"] += 1
+        cost = len(payload["input_ids"]) + min(payload["max_tokens"], 2048)
+        tried: List[ModelReplica] = []
+        streamed = False
+
+        def relay(token_ids: List[int]):
+            nonlocal streamed
+            streamed = True
+            on_tokens(token_ids)
+
+        while True:
+            replica = self._select(tried, payload.get("session_id"), cost)
+            if replica is None:
+                if not self.is_alive():
+                    raise InferenceWorkerError("沒有可用的模型副本")
+                raise RuntimeError(f"所有模型副本的推論佇列已滿 ({self.max_queue_size})")
+            if tried:
+                self.stats["retries"] += 1
+            tried.append(replica)
+
+            replica.outstanding_tokens += cost
+            replica.active_requests += 1
+            try:
+                result = await replica.worker.generate(
+                    payload,
+                    on_tokens=relay if on_tokens is not None else None,
+                    timeout=timeout,
+                    telemetry=telemetry
+                )
+                replica.completed += 1
+                self._remember_session(payload.get("session_id"), replica)
+                return result
+            except InferenceWorkerError as e:
+                replica.failures += 1
+                # 工作程序仍存活表示是單一請求的錯誤，不影響副本健康
+                if replica.worker.is_alive():
+                    raise
+                self._remove(replica, str(e))
+                if streamed:
+                    raise
+            finally:
+                replica.outstanding_tokens -= cost
+                replica.active_requests -= 1
+
+    async def stop(self):
+        """停止所有副本"""
+        await asyncio.gather(*(replica.worker.stop() for replica in self.replicas))
+        for replica in self.replicas:
+            replica.healthy = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取模型池統計"""
+        return {
+            **self.stats,
+            "alive": self.is_alive(),
+            "healthy_replicas": sum(replica.healthy for replica in self.replicas),
+            "replicas": [replica.get_stats() for replica in self.replicas]
+        }
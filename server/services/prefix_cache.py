@@ -0,0 +1,96 @@
+"""
+共用前綴 KV 快取
+固定系統提示詞的注意力鍵值只計算一次，之後的請求只需預填用戶專屬的後綴
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from services.kv_cache_utils import CacheLayers, cache_to_layers, layers_nbytes
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_key(token_ids: List[int]) -> str:
+    """前綴 token 序列的雜湊鍵"""
+    return hashlib.sha256(",".join(map(str, token_ids)).encode()).hexdigest()
+
+
+class PrefixKVCache:
+    """以前綴 token 雜湊為鍵、記憶體上限內 LRU 淘汰的 KV 快取
+
+    回傳的快取由多個請求共用，使用前必須先複製（generate 會原地擴充快取）。
+    """
+
+    def __init__(self, model: Any, max_bytes: int = 512 * 1024 * 1024):
+        self.model = model
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CacheLayers]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "prefill_tokens_saved": 0}
+
+    def get(self, prefix_ids: List[int]) -> CacheLayers:
+        """獲取前綴快取，不存在時計算並加入"""
+        key = prefix_key(prefix_ids)
+
+        with self._lock:
+            layers = self._entries.get(key)
+            if layers is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["prefill_tokens_saved"] += len(prefix_ids)
+                return layers
+            self.stats["misses"] += 1
+
+        layers = self._compute(prefix_ids)
+        size = layers_nbytes(layers)
+        if size > self.max_bytes:
+            logger.warning(f"前綴快取 {size / 1024 / 1024:.1f} MB 超過上限，不予快取")
+            return layers
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = layers
+                self._sizes[key] = size
+                self.total_bytes += size
+                self._evict()
+        return layers
+
+    def _compute(self, prefix_ids: List[int]) -> CacheLayers:
+        """執行前綴預填"""
+        import torch
+
+        input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=self.model.device)
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        return cache_to_layers(outputs.past_key_values)
+
+    def _evict(self):
+        """淘汰最久未使用的項目直到符合記憶體上限"""
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, _ = self._entries.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(key)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取快取統計"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "memory_mb": round(self.total_bytes / 1024 / 1024, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
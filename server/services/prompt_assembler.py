@@ -0,0 +1,167 @@
+"""
+Token 預算提示詞組裝
+以 token 為單位組裝系統提示詞、檢索內容與用戶訊息；各段落的 token 化結果會被快取，
+超出預算時依分數由低到高截斷或捨棄檢索內容。
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# 檢索內容：字串或 RAG 查詢結果（含 content 與 score）
+ContextInput = Union[str, List[Dict[str, Any]], None]
+
+CONTEXT_HEADER = "### 相關資訊\n"
+CHUNK_SEPARATOR = "\n\n"
+
+
+def normalize_context(context: ContextInput) -> List[Dict[str, Any]]:
+    """將檢索內容轉為 [{"content", "score"}]，單一字串視為最高分"""
+    if not context:
+        return []
+    if isinstance(context, str):
+        return [{"content": context, "score": float("inf")}]
+    return [
+        {"content": chunk["content"], "score": chunk.get("score", 0.0)}
+        for chunk in context
+        if chunk.get("content")
+    ]
+
+
+def context_text(context: ContextInput) -> str:
+    """檢索內容的字串形式"""
+    return CHUNK_SEPARATOR.join(chunk["content"] for chunk in normalize_context(context))
+
+
+class PromptAssembler:
+    """在 token 預算內組裝提示詞
+
+    提示詞格式與 AIService._build_prompt 相同：
+    系統前綴 | 相關資訊標題 | 檢索段落... | 用戶訊息與助手標題。
+    """
+
+    def __init__(self, tokenizer: Any, cache_size: int = 2048, min_chunk_tokens: int = 32):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self.min_chunk_tokens = min_chunk_tokens  # 截斷後少於此長度的段落直接捨棄
+        self._segments: "OrderedDict[Tuple[str, bool], List[int]]" = OrderedDict()
+        self.stats = {
+            "prompts": 0,
+            "segment_hits": 0,
+            "segment_misses": 0,
+            "context_tokens": 0,
+            "context_tokens_used": 0,
+            "dropped_chunks": 0,
+            "trimmed_chunks": 0,
+            "prefill_tokens_saved": 0
+        }
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        """token 化段落（LRU 快取）"""
+        key = (text, add_special_tokens)
+        ids = self._segments.get(key)
+        if ids is not None:
+            self._segments.move_to_end(key)
+            self.stats["segment_hits"] += 1
+            return ids
+
+        self.stats["segment_misses"] += 1
+        ids = self.tokenizer.encode(text, add_special_tokens=add_special_tokens)
+        self._segments[key] = ids
+        if len(self._segments) > self.cache_size:
+            self._segments.popitem(last=False)
+        return ids
+
+    def assemble(
+        self,
+        system: str,
+        message: str,
+        context: ContextInput = None,
+        max_prompt_tokens: Optional[int] = None
+    ) -> Tuple[List[int], int]:
+        """組裝提示詞，回傳 (token id, 系統前綴長度)"""
+        prefix_ids = self.encode(f"### 系統\n{system}\n\n", add_special_tokens=True)
+        tail_ids = self.encode(f"### 用戶\n{message}\n\n### 助手\n")
+        chunks = normalize_context(context)
+
+        context_ids = self._fit_context(
+            chunks,
+            None if max_prompt_tokens is None else max_prompt_tokens - len(prefix_ids) - len(tail_ids)
+        )
+
+        self.stats["prompts"] += 1
+        return prefix_ids + context_ids + tail_ids, len(prefix_ids)
+
+    def assemble_turn(
+        self,
+        message: str,
+        context: ContextInput = None,
+        max_turn_tokens: Optional[int] = None
+    ) -> List[int]:
+        """組裝多輪對話中接在上一輪回應之後的新一輪（輪次分隔 | 相關資訊 | 用戶訊息與助手標題）"""
+        separator_ids = self.encode(CHUNK_SEPARATOR)
+        tail_ids = self.encode(f"### 用戶\n{message}\n\n### 助手\n")
+        chunks = normalize_context(context)
+
+        context_ids = self._fit_context(
+            chunks,
+            None if max_turn_tokens is None else max_turn_tokens - len(separator_ids) - len(tail_ids)
+        )
+
+        self.stats["prompts"] += 1
+        return separator_ids + context_ids + tail_ids
+
+    def _fit_context(self, chunks: List[Dict[str, Any]], budget: Optional[int]) -> List[int]:
+        """在預算內選取檢索段落，維持原本順序"""
+        if not chunks:
+            return []
+
+        header_ids = self.encode(CONTEXT_HEADER)
+        separator_ids = self.encode(CHUNK_SEPARATOR)
+        chunk_ids = [self.encode(chunk["content"]) for chunk in chunks]
+        total = sum(len(ids) + len(separator_ids) for ids in chunk_ids)
+        self.stats["context_tokens"] += total
+
+        if budget is not None and budget < len(header_ids) + len(separator_ids) + self.min_chunk_tokens:
+            if budget < 0:
+                logger.warning(f"用戶訊息已超出提示詞預算 {-budget} 個 token")
+            self.stats["dropped_chunks"] += len(chunks)
+            self.stats["prefill_tokens_saved"] += total
+            return []
+
+        # 依分數由高到低放入，第一個放不下的段落截斷，其餘捨棄
+        remaining = None if budget is None else budget - len(header_ids)
+        selected: Dict[int, List[int]] = {}
+        for index in sorted(range(len(chunks)), key=lambda i: chunks[i]["score"], reverse=True):
+            cost = len(chunk_ids[index]) + len(separator_ids)
+            if remaining is None or cost <= remaining:
+                selected[index] = chunk_ids[index]
+                if remaining is not None:
+                    remaining -= cost
+            elif remaining - len(separator_ids) >= self.min_chunk_tokens:
+                selected[index] = chunk_ids[index][:remaining - len(separator_ids)]
+                remaining = 0
+                self.stats["trimmed_chunks"] += 1
+            else:
+                self.stats["dropped_chunks"] += 1
+
+        context_ids = list(header_ids)
+        for index in sorted(selected):
+            context_ids.extend(selected[index])
+            context_ids.extend(separator_ids)
+
+        used = len(context_ids) - len(header_ids)
+        self.stats["context_tokens_used"] += used
+        self.stats["prefill_tokens_saved"] += total - used
+        return context_ids
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取組裝統計"""
+        lookups = self.stats["segment_hits"] + self.stats["segment_misses"]
+        return {
+            **self.stats,
+            "cached_segments": len(self._segments),
+            "segment_hit_ratio": round(self.stats["segment_hits"] / lookups, 4) if lookups else 0.0
+        }
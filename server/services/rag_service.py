@@ -5,13 +5,18 @@ RAG (Retrieval-Augmented Generation) 服務
 
 import asyncio
 import logging
-import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
-from sentence_transformers import SentenceTransformer
-import chromadb
-from chromadb.config import Settings
+from typing import TYPE_CHECKING, AsyncIterator, List, Dict, Any, Optional, Tuple
 import json
 
+from services.context_compressor import ContextCompressor
+from services.shared_index import SharedIndex, SharedKnowledgeBase, write_shared_index
+from utils.startup_timer import startup_timer
+
+# sentence_transformers / chromadb 匯入耗時，延後到初始化時才載入
+if TYPE_CHECKING:
+    import chromadb
+    from sentence_transformers import SentenceTransformer
+
 logger = logging.getLogger(__name__)
 
 class RAGService:
@@ -22,16 +27,23 @@ class RAGService:
         tekla_kb,
         embedding_model_name: str = "all-MiniLM-L6-v2",
         vector_db_path: str = "./data/vectordb",
-        collection_name: str = "tekla_knowledge"
+        collection_name: str = "tekla_knowledge",
+        compress_context: bool = True,
+        shared_index_path: Optional[str] = None
     ):
         self.tekla_kb = tekla_kb
         self.embedding_model_name = embedding_model_name
         self.vector_db_path = vector_db_path
         self.collection_name = collection_name
+        self.compress_context = compress_context  # 查詢結果放入提示詞前做句子級抽取式壓縮
+        # 多工作程序模式：以記憶體映射開啟父程序建立的共用索引取代 ChromaDB（唯讀）
+        self.shared_index_path = shared_index_path
         
-        self.embedding_model: Optional[SentenceTransformer] = None
-        self.chroma_client: Optional[chromadb.Client] = None
-        self.collection: Optional[chromadb.Collection] = None
+        self.embedding_model: Optional["SentenceTransformer"] = None
+        self.chroma_client: Optional["chromadb.Client"] = None
+        self.collection: Optional["chromadb.Collection"] = None
+        self.shared_index: Optional[SharedIndex] = None
+        self.context_compressor: Optional[ContextCompressor] = None
         self.is_initialized = False
     
     async def initialize(self):
@@ -39,10 +51,47 @@ class RAGService:
         try:
             logger.info("初始化 RAG 服務...")
             
-            # 載入嵌入模型
+            with startup_timer.phase("import", "rag_service"):
+                from sentence_transformers import SentenceTransformer
+            
+            # 載入嵌入模型（只用於編碼查詢；文檔向量在共用索引中）
             logger.info(f"載入嵌入模型: {self.embedding_model_name}")
-            self.embedding_model = SentenceTransformer(self.embedding_model_name)
+            with startup_timer.phase("model_load", "rag_service"):
+                self.embedding_model = SentenceTransformer(self.embedding_model_name)
+            
+            if self.shared_index_path:
+                with startup_timer.phase("index_open", "rag_service"):
+                    self.shared_index = SharedIndex(self.shared_index_path)
+                    if self.tekla_kb is None:
+                        self.tekla_kb = SharedKnowledgeBase(self.shared_index)
+                    logger.info(f"開啟共用索引: {self.shared_index_path}（{len(self.shared_index)} 個文檔）")
+            else:
+                await self._open_collection()
+            
+            # 預熱：第一次編碼會初始化 tokenizer 與運算核心
+            with startup_timer.phase("warmup", "rag_service"):
+                self.embedding_model.encode(["Tekla"], show_progress_bar=False)
             
+            if self.compress_context:
+                # 與檢索共用嵌入模型評分句子
+                self.context_compressor = ContextCompressor(
+                    lambda texts: self.embedding_model.encode(texts, show_progress_bar=False)
+                )
+            
+            self.is_initialized = True
+            logger.info("✅ RAG 服務初始化完成")
+            
+        except Exception as e:
+            logger.error(f"❌ RAG 服務初始化失敗: {e}")
+            raise
+    
+    async def _open_collection(self):
+        """開啟 ChromaDB 集合，集合為空時建立索引"""
+        with startup_timer.phase("import", "rag_service"):
+            import chromadb
+            from chromadb.config import Settings
+        
+        with startup_timer.phase("index_open", "rag_service"):
             # 初始化 ChromaDB
             logger.info("初始化向量資料庫...")
             self.chroma_client = chromadb.PersistentClient(
@@ -73,13 +122,6 @@ class RAGService:
                 await self._build_index()
             else:
                 logger.info(f"集合已包含 {count} 個文檔")
-            
-            self.is_initialized = True
-            logger.info("✅ RAG 服務初始化完成")
-            
-        except Exception as e:
-            logger.error(f"❌ RAG 服務初始化失敗: {e}")
-            raise
     
     async def _build_index(self):
         """建立向量索引"""
@@ -128,6 +170,8 @@ class RAGService:
                 }
                 
                 # 添加額外的元數據
+                if "page" in doc.get("metadata", {}):
+                    metadata["page"] = doc["metadata"]["page"]
                 if "namespace" in doc:
                     metadata["namespace"] = doc["namespace"]
                 if "class_name" in doc:
@@ -167,30 +211,85 @@ class RAGService:
             return []
         
         try:
-            # 生成查詢向量
-            query_embedding = self.embedding_model.encode([query])
-            
-            # 準備查詢參數
-            query_params = {
-                "query_embeddings": query_embedding.tolist(),
-                "n_results": top_k
-            }
-            
-            # 添加過濾條件
-            if filter_metadata:
-                query_params["where"] = filter_metadata
-            
-            # 執行查詢
-            results = self.collection.query(**query_params)
-            
-            # 處理結果
+            results = self._search_batch([query], top_k, threshold, filter_metadata)[0]
+            logger.info(f"查詢 '{query}' 返回 {len(results)} 個結果")
+            return results
+        except Exception as e:
+            logger.error(f"RAG 查詢失敗: {e}")
+            return []
+    
+    async def iter_query_batch(
+        self,
+        queries: List[str],
+        top_k: int = 5,
+        threshold: float = 0.7,
+        filter_metadata: Optional[Dict] = None,
+        batch_size: int = 32
+    ) -> AsyncIterator[Tuple[int, List[Dict[str, Any]]]]:
+        """批次查詢，每完成一批即依序產出 (查詢索引, 結果)
+
+        每批查詢一次編碼、一次向量搜尋，並在執行緒中進行，不阻塞事件迴圈；
+        某一批失敗時該批的查詢回傳空結果（與 query 相同）。
+        """
+        if not self.is_ready():
+            logger.warning("RAG 服務未就緒")
+            for index in range(len(queries)):
+                yield index, []
+            return
+        
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            try:
+                results = await loop.run_in_executor(
+                    None, self._search_batch, batch, top_k, threshold, filter_metadata
+                )
+            except Exception as e:
+                logger.error(f"RAG 批次查詢失敗 ({start}-{start + len(batch) - 1}): {e}")
+                results = [[] for _ in batch]
+            for offset, result in enumerate(results):
+                yield start + offset, result
+        
+        logger.info(f"批次查詢 {len(queries)} 個查詢完成")
+    
+    def _search_batch(
+        self,
+        queries: List[str],
+        top_k: int,
+        threshold: float,
+        filter_metadata: Optional[Dict] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """以一次編碼與一次向量搜尋處理多個查詢（符號完全相符的查詢不經過嵌入模型）"""
+        symbol_results = [self._query_symbols(query, top_k, filter_metadata) for query in queries]
+        results: List[List[Dict[str, Any]]] = [[] for _ in queries]
+        
+        # 符號快速路徑：整個查詢就是 API 符號時直接回傳
+        pending = []
+        for index, symbols in enumerate(symbol_results):
+            if symbols and symbols[0]["metadata"]["exact_match"]:
+                results[index] = symbols
+            else:
+                pending.append(index)
+        if not pending:
+            return results
+        
+        # 生成查詢向量
+        query_embeddings = self.embedding_model.encode(
+            [queries[index] for index in pending],
+            show_progress_bar=False
+        )
+        
+        # 執行查詢
+        search = self._vector_search(query_embeddings, top_k, filter_metadata)
+        
+        for position, index in enumerate(pending):
             formatted_results = []
-            if results["documents"] and results["documents"][0]:
-                for i, (doc, metadata, distance) in enumerate(zip(
-                    results["documents"][0],
-                    results["metadatas"][0],
-                    results["distances"][0]
-                )):
+            if search["documents"] and search["documents"][position]:
+                for doc, metadata, distance in zip(
+                    search["documents"][position],
+                    search["metadatas"][position],
+                    search["distances"][position]
+                ):
                     # 計算相似度分數 (1 - distance)
                     score = 1 - distance
                     
@@ -208,12 +307,129 @@ class RAGService:
             # 按分數排序
             formatted_results.sort(key=lambda x: x["score"], reverse=True)
             
-            logger.info(f"查詢 '{query}' 返回 {len(formatted_results)} 個結果")
-            return formatted_results
+            # 文本中引用的符號排在向量結果之前
+            if symbol_results[index]:
+                symbol_contents = {r["content"] for r in symbol_results[index]}
+                formatted_results = symbol_results[index] + [
+                    r for r in formatted_results if r["content"] not in symbol_contents
+                ]
+                formatted_results = formatted_results[:top_k]
             
+            results[index] = formatted_results
+        
+        return results
+    
+    def _vector_search(
+        self,
+        query_embeddings,
+        top_k: int,
+        filter_metadata: Optional[Dict] = None
+    ) -> Dict[str, List[List[Any]]]:
+        """向量搜尋，回傳與 ChromaDB collection.query 相同格式的結果"""
+        if self.shared_index is None:
+            query_params = {
+                "query_embeddings": query_embeddings.tolist(),
+                "n_results": top_k
+            }
+            if filter_metadata:
+                query_params["where"] = filter_metadata
+            return self.collection.query(**query_params)
+        
+        search = {"documents": [], "metadatas": [], "distances": []}
+        for matches in self.shared_index.search(query_embeddings, top_k, filter_metadata):
+            search["documents"].append([self.shared_index.documents[row]["content"] for row, _ in matches])
+            search["metadatas"].append([self.shared_index.metadatas[row] for row, _ in matches])
+            search["distances"].append([distance for _, distance in matches])
+        return search
+    
+    def compress_results(
+        self,
+        query: str,
+        results: List[Dict[str, Any]]
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """壓縮查詢結果後再交給 AIService 組裝提示詞，回傳 (結果, 壓縮報告)
+
+        只保留與查詢相關的句子並去除重疊段落，代碼範例整段保留；未啟用或未就緒時原樣回傳。
+        """
+        if self.context_compressor is None or not results:
+            return results, {}
+        
+        try:
+            compressed, report = self.context_compressor.compress(query, results)
+            logger.info(
+                f"檢索內容壓縮: {report['original_chars']} -> {report['compressed_chars']} 字元 "
+                f"(比例 {report['compression_ratio']:.2f})"
+            )
+            return compressed, report
         except Exception as e:
-            logger.error(f"RAG 查詢失敗: {e}")
+            logger.error(f"檢索內容壓縮失敗，使用原始結果: {e}")
+            return results, {}
+    
+    def _query_symbols(
+        self,
+        query: str,
+        top_k: int,
+        filter_metadata: Optional[Dict] = None
+    ) -> List[Dict[str, Any]]:
+        """以 API 符號索引解析查詢"""
+        if self.tekla_kb is None or not hasattr(self.tekla_kb, "lookup_symbol"):
             return []
+        
+        exact_match = True
+        symbols = self.tekla_kb.lookup_symbol(query)
+        if not symbols:
+            exact_match = False
+            symbols = self.tekla_kb.resolve_symbols(query)
+        
+        results = []
+        seen_docs = set()
+        for symbol in symbols:
+            doc = self.tekla_kb.get_document(symbol["doc_id"])
+            if doc is None or doc["id"] in seen_docs:
+                continue
+            if not self._matches_filter(doc, filter_metadata):
+                continue
+            seen_docs.add(doc["id"])
+            
+            metadata = {
+                "type": doc.get("type", "unknown"),
+                "title": doc.get("title", ""),
+                "source": doc.get("metadata", {}).get("source", ""),
+                "namespace": symbol["namespace"],
+                "symbol": symbol["name"],
+                "symbol_kind": symbol["kind"],
+                "exact_match": exact_match
+            }
+            if "class_name" in symbol:
+                metadata["class_name"] = symbol["class_name"]
+            
+            results.append({
+                "content": doc["content"],
+                "score": 1.0,
+                "source": metadata["source"],
+                "type": metadata["type"],
+                "title": metadata["title"],
+                "metadata": metadata
+            })
+            if len(results) >= top_k:
+                break
+        
+        return results
+    
+    @staticmethod
+    def _matches_filter(doc: Dict, filter_metadata: Optional[Dict]) -> bool:
+        """檢查文檔是否符合查詢過濾條件（支援等值與 $in）"""
+        if not filter_metadata:
+            return True
+        
+        for key, condition in filter_metadata.items():
+            value = doc.get(key)
+            if isinstance(condition, dict):
+                if "$in" in condition and value not in condition["$in"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
     
     async def query_by_type(
         self, 
@@ -257,7 +473,7 @@ class RAGService:
         metadata: Dict[str, Any]
     ) -> bool:
         """添加新文檔"""
-        if not self.is_ready():
+        if not self.is_ready() or self._is_read_only():
             return False
         
         try:
@@ -286,7 +502,7 @@ class RAGService:
         metadata: Dict[str, Any]
     ) -> bool:
         """更新文檔"""
-        if not self.is_ready():
+        if not self.is_ready() or self._is_read_only():
             return False
         
         try:
@@ -310,7 +526,7 @@ class RAGService:
     
     async def delete_document(self, doc_id: str) -> bool:
         """刪除文檔"""
-        if not self.is_ready():
+        if not self.is_ready() or self._is_read_only():
             return False
         
         try:
@@ -322,18 +538,57 @@ class RAGService:
             logger.error(f"刪除文檔失敗: {e}")
             return False
     
+    def _is_read_only(self) -> bool:
+        """共用索引為唯讀，變更需在父程序更新 ChromaDB 後重新匯出"""
+        if self.shared_index is not None:
+            logger.warning("共用索引為唯讀，無法變更文檔")
+            return True
+        return False
+    
+    async def export_shared_index(self, directory: str) -> Dict[str, Any]:
+        """將集合（文檔、嵌入向量、中繼資料）與 API 符號匯出為共用索引，供多工作程序以記憶體映射開啟"""
+        if self.collection is None:
+            raise RuntimeError("RAG 服務未初始化或已使用共用索引")
+        
+        def export() -> Dict[str, Any]:
+            data = self.collection.get(include=["documents", "metadatas", "embeddings"])
+            documents = []
+            for doc_id, content, metadata in zip(data["ids"], data["documents"], data["metadatas"]):
+                doc = self.tekla_kb.get_document(doc_id) if self.tekla_kb is not None else None
+                documents.append(doc or {"id": doc_id, "content": content, "metadata": metadata or {}})
+            
+            symbol_index = getattr(self.tekla_kb, "symbol_index", None)
+            write_shared_index(
+                directory,
+                documents,
+                metadatas=[metadata or {} for metadata in data["metadatas"]],
+                embeddings=data["embeddings"],
+                symbols=symbol_index.symbols if symbol_index is not None else (),
+                metric=(self.collection.metadata or {}).get("hnsw:space", "l2")
+            )
+            return SharedIndex(directory).get_stats()
+        
+        return await asyncio.get_running_loop().run_in_executor(None, export)
+    
     def get_collection_stats(self) -> Dict[str, Any]:
         """獲取集合統計資訊"""
         if not self.is_ready():
             return {"status": "not_ready"}
         
         try:
-            count = self.collection.count()
+            if self.shared_index is not None:
+                count = len(self.shared_index)
+            else:
+                count = self.collection.count()
             return {
                 "status": "ready",
                 "document_count": count,
                 "collection_name": self.collection_name,
-                "embedding_model": self.embedding_model_name
+                "shared_index": self.shared_index.get_stats() if self.shared_index is not None else None,
+                "embedding_model": self.embedding_model_name,
+                "context_compression": (
+                    self.context_compressor.get_stats() if self.context_compressor is not None else None
+                )
             }
         except Exception as e:
             logger.error(f"獲取集合統計失敗: {e}")
@@ -344,7 +599,7 @@ class RAGService:
         return (
             self.is_initialized and
             self.embedding_model is not None and
-            self.collection is not None
+            (self.collection is not None or self.shared_index is not None)
         )
     
     async def cleanup(self):
@@ -352,6 +607,7 @@ class RAGService:
         try:
             logger.info("清理 RAG 服務資源...")
             
+            self.context_compressor = None
             if self.embedding_model is not None:
                 del self.embedding_model
                 self.embedding_model = None
@@ -360,6 +616,7 @@ class RAGService:
                 # ChromaDB 會自動處理連接關閉
                 self.chroma_client = None
                 self.collection = None
+            self.shared_index = None
             
             self.is_initialized = False
             logger.info("✅ RAG 服務資源清理完成")
@@ -371,6 +628,8 @@ class RAGService:
         """重建索引"""
         try:
             logger.info("開始重建 RAG 索引...")
+            if self.shared_index is not None:
+                raise RuntimeError("共用索引為唯讀，請在父程序重建後重新匯出")
             
             # 清空現有集合
             if self.collection:
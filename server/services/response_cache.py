@@ -0,0 +1,152 @@
+"""
+確定性回應快取
+以 (模型名稱, 生成設定, 正規化提示詞) 為鍵保存貪婪解碼的回應，重複請求無需重新生成
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(text: str) -> str:
+    """正規化提示詞：統一全形/半形字元並合併空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def response_key(model_name: str, settings: Dict[str, Any], prompt: str) -> str:
+    """計算快取鍵"""
+    payload = json.dumps(
+        {"model": model_name, "settings": settings, "prompt": normalize_prompt(prompt)},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """TTL + LRU 的回應快取，以 SQLite 持久化並在記憶體保留熱門項目
+
+    只有確定性（貪婪解碼）的生成結果適合放入快取。
+    """
+
+    def __init__(
+        self,
+        path: str = "data/cache/response_cache.db",
+        ttl_seconds: float = 24 * 3600,
+        max_entries: int = 1000,
+        memory_entries: int = 128
+    ):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "writes": 0}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed_at)")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """查詢快取，過期項目視為未命中並刪除"""
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                row = self._db.execute(
+                    "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                entry = tuple(row) if row else None
+
+            if entry is not None and now - entry[1] > self.ttl_seconds:
+                self._delete(key)
+                self._db.commit()
+                self.stats["expired"] += 1
+                entry = None
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, entry)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key: str, response: str):
+        """寫入快取並淘汰最久未使用的項目"""
+        now = time.time()
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._remember(key, (response, now))
+            self.stats["writes"] += 1
+
+            count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                stale = self._db.execute(
+                    "SELECT key FROM responses ORDER BY accessed_at LIMIT ?",
+                    (count - self.max_entries,)
+                ).fetchall()
+                for (stale_key,) in stale:
+                    self._delete(stale_key)
+                self.stats["evictions"] += len(stale)
+            self._db.commit()
+
+    def _remember(self, key: str, entry: tuple):
+        """放入記憶體 LRU"""
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _delete(self, key: str):
+        """刪除項目（呼叫者負責提交）"""
+        self._memory.pop(key, None)
+        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self):
+        """關閉資料庫連線"""
+        with self._lock:
+            self._db.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取快取統計"""
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": entries,
+            "memory_entries": len(self._memory),
+            "ttl_seconds": self.ttl_seconds,
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,140 @@
+"""
+多輪對話工作階段快取
+SessionHistory 保存每個工作階段至今的 token 序列（在 API 程序中）；
+SessionKVCache 保存對應的注意力鍵值（與模型位於同一程序），每一輪只需預填新增的部分。
+鍵值快取在記憶體上限內 LRU 淘汰，被淘汰或不一致時由呼叫端改為完整預填。
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from services.kv_cache_utils import CacheLayers, layers_nbytes
+
+logger = logging.getLogger(__name__)
+
+
+class SessionHistory:
+    """工作階段的對話 token 序列（依工作階段數量 LRU 淘汰）"""
+
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {"turns": 0, "resets": 0, "evictions": 0}
+
+    def get(self, session_id: str, system_prompt: str) -> Optional[Dict[str, Any]]:
+        """獲取工作階段（系統提示詞不同時視為新對話）"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if session["system_prompt"] != system_prompt:
+            self.drop(session_id)
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def update(self, session_id: str, token_ids: List[int], prefix_length: int, system_prompt: str):
+        """記錄完成一輪後的完整 token 序列"""
+        previous = self._sessions.pop(session_id, None)
+        self._sessions[session_id] = {
+            "token_ids": token_ids,
+            "prefix_length": prefix_length,
+            "system_prompt": system_prompt,
+            "turns": (previous["turns"] if previous else 0) + 1
+        }
+        self.stats["turns"] += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def drop(self, session_id: str) -> bool:
+        """結束工作階段"""
+        return self._sessions.pop(session_id, None) is not None
+
+    def clear(self):
+        """清空所有工作階段"""
+        self._sessions.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取工作階段統計"""
+        return {
+            **self.stats,
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions
+        }
+
+
+class SessionKVCache:
+    """以工作階段為鍵、全域記憶體上限內 LRU 淘汰的 KV 快取
+
+    take 取出的快取由單一請求獨占（generate 會原地擴充），生成完成後再以 put 放回。
+    快取附帶其涵蓋的 token 序列，只有在新提示詞以該序列開頭時才會使用。
+    """
+
+    def __init__(self, max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "prefill_tokens_saved": 0}
+
+    def take(self, session_id: str, input_ids: List[int]) -> Optional[CacheLayers]:
+        """取出可延續 input_ids 的快取，沒有或不一致時回傳 None"""
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.total_bytes -= entry["nbytes"]
+
+            token_ids = entry["token_ids"]
+            if len(token_ids) >= len(input_ids) or input_ids[:len(token_ids)] != token_ids:
+                self.stats["stale"] += 1
+                return None
+
+            self.stats["hits"] += 1
+            self.stats["prefill_tokens_saved"] += len(token_ids)
+            return entry["layers"]
+
+    def put(self, session_id: str, token_ids: List[int], layers: CacheLayers):
+        """放回生成後的快取（涵蓋 token_ids）"""
+        nbytes = layers_nbytes(layers)
+        if nbytes > self.max_bytes:
+            logger.warning(f"工作階段 {session_id} 的 KV 快取 {nbytes / 1024 / 1024:.1f} MB 超過上限，不予快取")
+            return
+
+        with self._lock:
+            previous = self._entries.pop(session_id, None)
+            if previous is not None:
+                self.total_bytes -= previous["nbytes"]
+            self._entries[session_id] = {"token_ids": token_ids, "layers": layers, "nbytes": nbytes}
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted["nbytes"]
+                self.stats["evictions"] += 1
+
+    def drop(self, session_id: str):
+        """移除工作階段的快取"""
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry["nbytes"]
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取快取統計"""
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["stale"]
+        return {
+            **self.stats,
+            "sessions": len(self._entries),
+            "memory_mb": round(self.total_bytes / 1024 / 1024, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,411 @@
+"""
+共用唯讀索引
+多工作程序模式下，由父程序建立一次文檔、嵌入矩陣、中繼資料欄位與 API 符號索引並寫成扁平檔案，
+各工作程序以記憶體映射開啟：實體記憶體由作業系統的頁面快取共用，不會每個程序各複製一份。
+"""
+
+import bisect
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services.api_symbol_index import KIND_PRIORITY, SYMBOL_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# 檔案格式變更時需遞增
+SHARED_INDEX_SCHEMA_VERSION = 1
+MANIFEST = "manifest.json"
+
+# 與 ChromaDB 相同的距離定義（分數為 1 - 距離）
+METRICS = ("l2", "cosine", "ip")
+
+
+class StringTable:
+    """記憶體映射的字串表（UTF-8 資料檔 + int64 位移陣列），依索引讀取時才解碼"""
+
+    def __init__(self, directory: Path, name: str):
+        self.offsets = np.load(directory / f"{name}.offsets.npy", mmap_mode="r")
+        data_path = directory / f"{name}.bin"
+        # 空檔案無法映射
+        if data_path.stat().st_size:
+            self._data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    @staticmethod
+    def write(directory: Path, name: str, strings: Iterable[str]):
+        """寫入字串表"""
+        offsets = [0]
+        with open(directory / f"{name}.bin", "wb") as f:
+            for text in strings:
+                data = text.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        np.save(directory / f"{name}.offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return self._data[start:end].tobytes().decode("utf-8")
+
+
+class JsonTable(Sequence):
+    """每一列為 JSON 的字串表"""
+
+    def __init__(self, directory: Path, name: str):
+        self.strings = StringTable(directory, name)
+
+    @staticmethod
+    def write(directory: Path, name: str, rows: Iterable[Any]):
+        """寫入 JSON 列"""
+        StringTable.write(directory, name, (json.dumps(row, ensure_ascii=False, default=str) for row in rows))
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def __getitem__(self, index: int) -> Any:
+        return json.loads(self.strings[index])
+
+
+def _symbol_keys(symbol: Dict[str, Any]) -> List[str]:
+    """符號的查詢鍵：完整名稱及所有點號後綴（與 ApiSymbolIndex 相同，不分大小寫）"""
+    parts = symbol["name"].split(".")
+    return [".".join(parts[i:]).lower() for i in range(len(parts))]
+
+
+def _column_value(value: Any) -> bool:
+    """可做為過濾欄位的值"""
+    return isinstance(value, (str, int, float, bool))
+
+
+def write_shared_index(
+    directory: str,
+    documents: Sequence[Dict[str, Any]],
+    metadatas: Optional[Sequence[Dict[str, Any]]] = None,
+    embeddings: Optional[Any] = None,
+    symbols: Sequence[Dict[str, Any]] = (),
+    metric: str = "l2",
+    source_hash: Optional[str] = None
+) -> Path:
+    """建立共用索引目錄
+
+    documents 為知識庫文檔（需含 id 與 content）；metadatas 為向量搜尋的扁平中繼資料
+    （與 ChromaDB 集合相同，預設取各文檔的 metadata），其中的純量欄位會建立過濾用的欄位編碼；
+    embeddings 為與 documents 同順序的嵌入矩陣（None 表示只提供文檔與符號查詢）；
+    symbols 為 ApiSymbolIndex.symbols；source_hash 為來源內容的雜湊，記錄在 manifest 中供判斷索引是否過期。
+    先寫入暫存目錄再整個替換，已開啟舊索引的程序不受影響。
+    """
+    if metric not in METRICS:
+        raise ValueError(f"未知的距離: {metric}（可用: {', '.join(METRICS)}）")
+    if metadatas is None:
+        metadatas = [doc.get("metadata", {}) for doc in documents]
+    if len(metadatas) != len(documents):
+        raise ValueError("metadatas 與 documents 數量不一致")
+
+    target = Path(directory)
+    staging = target.with_name(f"{target.name}.tmp-{os.getpid()}")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+
+    # 文檔與依 id 排序的查詢表
+    JsonTable.write(staging, "documents", documents)
+    JsonTable.write(staging, "metadatas", metadatas)
+    order = sorted(range(len(documents)), key=lambda row: documents[row]["id"])
+    StringTable.write(staging, "doc_ids", (documents[row]["id"] for row in order))
+    np.save(staging / "doc_rows.npy", np.asarray(order, dtype=np.int64))
+
+    # 中繼資料欄位：每個欄位以詞彙表編碼（-1 表示沒有此欄位）
+    columns: Dict[str, List[Any]] = {}
+    for metadata in metadatas:
+        for key, value in metadata.items():
+            if _column_value(value):
+                vocabulary = columns.setdefault(key, [])
+                if value not in vocabulary:
+                    vocabulary.append(value)
+    column_files = {}
+    for number, (key, vocabulary) in enumerate(columns.items()):
+        lookup = {value: code for code, value in enumerate(vocabulary)}
+        codes = [lookup.get(metadata.get(key), -1) if _column_value(metadata.get(key)) else -1 for metadata in metadatas]
+        column_files[key] = f"column.{number}.npy"
+        np.save(staging / column_files[key], np.asarray(codes, dtype=np.int32))
+
+    dim = 0
+    if embeddings is not None:
+        matrix = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+        if matrix.ndim != 2 or len(matrix) != len(documents):
+            raise ValueError("embeddings 必須是 (文檔數, 維度) 的矩陣")
+        dim = matrix.shape[1]
+        np.save(staging / "embeddings.npy", matrix)
+        np.save(staging / "norms.npy", np.einsum("ij,ij->i", matrix, matrix))
+
+    # API 符號：排序的鍵與 CSR 格式的符號清單
+    postings: Dict[str, List[int]] = {}
+    for symbol_id, symbol in enumerate(symbols):
+        for key in _symbol_keys(symbol):
+            postings.setdefault(key, []).append(symbol_id)
+    keys = sorted(postings)
+    JsonTable.write(staging, "symbols", symbols)
+    StringTable.write(staging, "symbol_keys", keys)
+    offsets = np.cumsum([0] + [len(postings[key]) for key in keys], dtype=np.int64)
+    np.save(staging / "symbol_offsets.npy", offsets)
+    np.save(staging / "symbol_postings.npy", np.asarray([i for key in keys for i in postings[key]], dtype=np.int32))
+
+    manifest = {
+        "schema_version": SHARED_INDEX_SCHEMA_VERSION,
+        "documents": len(documents),
+        "dim": dim,
+        "metric": metric,
+        "columns": {key: {"file": column_files[key], "values": columns[key]} for key in columns},
+        "symbols": len(symbols),
+        "source_hash": source_hash,
+        "created_at": time.time()
+    }
+    with open(staging / MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    # 替換舊索引（已映射的舊檔案在關閉前仍可讀取）
+    previous = target.with_name(f"{target.name}.old-{os.getpid()}")
+    if target.exists():
+        os.replace(target, previous)
+    os.replace(staging, target)
+    shutil.rmtree(previous, ignore_errors=True)
+
+    logger.info(f"✅ 共用索引已寫入: {target}（{len(documents)} 個文檔，{len(symbols)} 個符號）")
+    return target
+
+
+class SharedIndex:
+    """以記憶體映射開啟的共用索引（唯讀）
+
+    search 以暴力矩陣運算計算距離，定義與 ChromaDB 相同（l2 為平方距離），where 支援
+    等值、$eq、$ne、$in、$nin、$and、$or；符號查詢的結果與 ApiSymbolIndex 相同。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        with open(self.directory / MANIFEST, encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("schema_version") != SHARED_INDEX_SCHEMA_VERSION:
+            raise RuntimeError(f"共用索引版本不符: {self.directory}")
+
+        self.metric = self.manifest["metric"]
+        self.documents = JsonTable(self.directory, "documents")
+        self.metadatas = JsonTable(self.directory, "metadatas")
+        self._doc_ids = StringTable(self.directory, "doc_ids")
+        self._doc_rows = np.load(self.directory / "doc_rows.npy", mmap_mode="r")
+        self._columns = {
+            key: (np.load(self.directory / column["file"], mmap_mode="r"), column["values"])
+            for key, column in self.manifest["columns"].items()
+        }
+
+        self.embeddings = None
+        self._norms = None
+        if self.manifest["dim"]:
+            self.embeddings = np.load(self.directory / "embeddings.npy", mmap_mode="r")
+            self._norms = np.load(self.directory / "norms.npy", mmap_mode="r")
+
+        self.symbols = JsonTable(self.directory, "symbols")
+        self._symbol_keys = StringTable(self.directory, "symbol_keys")
+        self._symbol_offsets = np.load(self.directory / "symbol_offsets.npy", mmap_mode="r")
+        self._symbol_postings = np.load(self.directory / "symbol_postings.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    # 文檔
+
+    def get_document(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        """依 id 取得文檔"""
+        position = bisect.bisect_left(self._doc_ids, doc_id)
+        if position < len(self._doc_ids) and self._doc_ids[position] == doc_id:
+            return self.documents[int(self._doc_rows[position])]
+        return None
+
+    # 向量搜尋
+
+    def search(
+        self,
+        query_embeddings: Any,
+        top_k: int,
+        where: Optional[Dict[str, Any]] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """每個查詢回傳距離最小的 top_k 個 (文檔列, 距離)"""
+        if self.embeddings is None:
+            raise RuntimeError("共用索引不含嵌入向量")
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if queries.shape[1] != self.embeddings.shape[1]:
+            raise ValueError(f"查詢向量維度 {queries.shape[1]} 與索引 {self.embeddings.shape[1]} 不符")
+
+        mask = self._filter(where) if where else None
+        candidates = np.flatnonzero(mask) if mask is not None else None
+        if candidates is not None and not len(candidates):
+            return [[] for _ in queries]
+
+        matrix = self.embeddings if candidates is None else self.embeddings[candidates]
+        dots = queries @ matrix.T
+        if self.metric == "l2":
+            norms = self._norms if candidates is None else self._norms[candidates]
+            distances = np.einsum("ij,ij->i", queries, queries)[:, None] + norms[None, :] - 2 * dots
+        elif self.metric == "cosine":
+            norms = np.sqrt(self._norms if candidates is None else self._norms[candidates])
+            query_norms = np.linalg.norm(queries, axis=1)
+            denominator = np.maximum(query_norms[:, None] * norms[None, :], 1e-12)
+            distances = 1 - dots / denominator
+        else:
+            distances = 1 - dots
+
+        k = min(top_k, distances.shape[1])
+        results = []
+        for row in distances:
+            top = np.argpartition(row, k - 1)[:k] if k < len(row) else np.arange(len(row))
+            top = top[np.argsort(row[top], kind="stable")]
+            rows = top if candidates is None else candidates[top]
+            results.append([(int(doc_row), float(row[i])) for doc_row, i in zip(rows, top)])
+        return results
+
+    def _filter(self, where: Dict[str, Any]) -> np.ndarray:
+        """將 where 條件轉為文檔遮罩"""
+        mask = np.ones(len(self), dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self._filter(clause)
+            elif key == "$or":
+                mask &= np.logical_or.reduce([self._filter(clause) for clause in condition])
+            else:
+                mask &= self._match(key, condition)
+        return mask
+
+    def _match(self, key: str, condition: Any) -> np.ndarray:
+        """單一欄位的條件"""
+        codes, values = self._columns.get(key, (np.full(len(self), -1, dtype=np.int32), []))
+
+        def isin(allowed: Iterable[Any]) -> np.ndarray:
+            allowed_codes = [code for code, value in enumerate(values) if value in list(allowed)]
+            return np.isin(codes, allowed_codes)
+
+        if not isinstance(condition, dict):
+            return isin([condition])
+        operator, operand = next(iter(condition.items()))
+        if operator == "$eq":
+            return isin([operand])
+        if operator == "$ne":
+            return ~isin([operand])
+        if operator == "$in":
+            return isin(operand)
+        if operator == "$nin":
+            return ~isin(operand)
+        raise ValueError(f"共用索引不支援的過濾條件: {operator}")
+
+    # API 符號
+
+    def _symbol_ids(self, position: int) -> List[int]:
+        """鍵對應的符號 id"""
+        start, end = int(self._symbol_offsets[position]), int(self._symbol_offsets[position + 1])
+        return self._symbol_postings[start:end].tolist()
+
+    def _sorted_symbols(self, symbol_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        """去重並依類型優先權排序"""
+        symbols = [self.symbols[i] for i in dict.fromkeys(symbol_ids)]
+        return sorted(symbols, key=lambda s: (KIND_PRIORITY.get(s["kind"], 9), len(s["name"])))
+
+    def lookup_symbol(self, name: str) -> List[Dict[str, Any]]:
+        """精確查詢"""
+        key = name.strip().lower()
+        position = bisect.bisect_left(self._symbol_keys, key)
+        if position < len(self._symbol_keys) and self._symbol_keys[position] == key:
+            return self._sorted_symbols(self._symbol_ids(position))
+        return []
+
+    def complete_symbol(self, prefix: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """前綴查詢，較短的補全優先（與字典樹的廣度優先順序相同）"""
+        key = prefix.strip().lower()
+        start = bisect.bisect_left(self._symbol_keys, key)
+        end = bisect.bisect_left(self._symbol_keys, key + "\U0010ffff")
+        positions = sorted(range(start, end), key=lambda i: (len(self._symbol_keys[i]), self._symbol_keys[i]))
+
+        symbol_ids: List[int] = []
+        seen = set()
+        for position in positions:
+            if len(seen) >= limit:
+                break
+            for symbol_id in self._symbol_ids(position):
+                if symbol_id not in seen:
+                    seen.add(symbol_id)
+                    symbol_ids.append(symbol_id)
+        return self._sorted_symbols(symbol_ids)[:limit]
+
+    def resolve_symbols(self, text: str) -> List[Dict[str, Any]]:
+        """解析自由文本中以點號連接的符號引用"""
+        symbol_ids: List[int] = []
+        for match in SYMBOL_PATTERN.finditer(text):
+            key = match.group(0).lower()
+            position = bisect.bisect_left(self._symbol_keys, key)
+            if position < len(self._symbol_keys) and self._symbol_keys[position] == key:
+                symbol_ids.extend(self._symbol_ids(position))
+        return self._sorted_symbols(symbol_ids)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """索引資訊"""
+        return {
+            "directory": str(self.directory),
+            "documents": len(self),
+            "symbols": len(self.symbols),
+            "dim": self.manifest["dim"],
+            "metric": self.metric,
+            "columns": list(self._columns),
+            "embedding_bytes": int(self.embeddings.nbytes) if self.embeddings is not None else 0,
+            "source_hash": self.manifest.get("source_hash"),
+            "created_at": self.manifest["created_at"]
+        }
+
+
+class SharedKnowledgeBase:
+    """以共用索引提供 TeklaKnowledgeBase 的查詢介面（唯讀，工作程序不必各自載入文檔）"""
+
+    def __init__(self, index: SharedIndex):
+        self.index = index
+
+    def is_ready(self) -> bool:
+        """是否有文檔"""
+        return len(self.index) > 0
+
+    def get_documents(self) -> Sequence[Dict]:
+        """所有文檔（逐筆解碼）"""
+        return self.index.documents
+
+    def get_document(self, doc_id: str) -> Optional[Dict]:
+        """依 ID 獲取文檔"""
+        return self.index.get_document(doc_id)
+
+    def lookup_symbol(self, name: str) -> List[Dict]:
+        """精確查詢 API 符號"""
+        return self.index.lookup_symbol(name)
+
+    def complete_symbol(self, prefix: str, limit: int = 20) -> List[Dict]:
+        """API 符號自動完成"""
+        return self.index.complete_symbol(prefix, limit)
+
+    def resolve_symbols(self, text: str) -> List[Dict]:
+        """解析文本中引用的 API 符號"""
+        return self.index.resolve_symbols(text)
+
+    def search_documents(self, query: str, doc_type: Optional[str] = None) -> List[Dict]:
+        """搜尋文檔（子字串比對）"""
+        query_lower = query.lower()
+        return [
+            doc for doc in self.index.documents
+            if (not doc_type or doc.get("type") == doc_type)
+            and (query_lower in doc["content"].lower() or query_lower in doc.get("title", "").lower())
+        ]
@@ -0,0 +1,167 @@
+"""
+進行中請求合併（single-flight）
+鍵相同的請求在第一個請求尚未完成時加入同一次計算並取得相同結果；
+串流請求由同一個生成來源輸出，較晚加入的請求先補送已產生的片段。
+只適用於確定性（貪婪解碼或低溫度）的生成，結果不依賴呼叫端。
+"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from prometheus_client import Counter
+
+from services.response_cache import normalize_prompt
+
+COALESCED_REQUESTS = Counter(
+    "ai_coalesced_requests", "併入進行中相同請求的請求數", ["flight", "kind"]
+)
+
+
+def _normalize(value: Any) -> Any:
+    """正規化鍵內容中的文字（統一全形/半形字元並合併空白）"""
+    if isinstance(value, str):
+        return normalize_prompt(value)
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def flight_key(*parts: Any) -> str:
+    """計算請求的合併鍵（文字經正規化，字典不分鍵的順序）"""
+    payload = json.dumps(_normalize(list(parts)), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """一次進行中的計算"""
+
+    def __init__(self):
+        self.task: Optional["asyncio.Task"] = None
+        self.waiters = 0
+        # 串流：已產生的片段與通知讀取端的事件
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.updated = asyncio.Event()
+
+    def notify(self):
+        """喚醒等待新片段的讀取端"""
+        event, self.updated = self.updated, asyncio.Event()
+        event.set()
+
+
+class SingleFlight:
+    """以鍵合併進行中的相同請求
+
+    do 合併一般請求，stream 合併串流請求；計算完成後即移除，不保留結果（快取見 ResponseCache）。
+    所有等待的請求都離開（取消或斷線）時才取消共用的計算。
+    """
+
+    def __init__(self, name: str = "default"):
+        self.name = name
+        self._calls: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _Flight] = {}
+        self.stats = {
+            "requests": 0,
+            "coalesced": 0,
+            "stream_requests": 0,
+            "stream_coalesced": 0,
+            "errors": 0,
+            "cancelled": 0
+        }
+
+    def _start(self, flights: Dict[str, _Flight], key: str, run: Callable[[_Flight], Awaitable]) -> _Flight:
+        """建立計算，完成後自動移除"""
+        flight = _Flight()
+        flight.task = asyncio.ensure_future(run(flight))
+        flights[key] = flight
+
+        def finished(task: "asyncio.Task"):
+            if flights.get(key) is flight:
+                del flights[key]
+            if not task.cancelled() and task.exception() is not None:
+                self.stats["errors"] += 1
+
+        flight.task.add_done_callback(finished)
+        return flight
+
+    def _leave(self, flights: Dict[str, _Flight], key: str, flight: _Flight):
+        """等待者離開；最後一個離開時取消尚未完成的計算"""
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # 先移除，避免新的請求加入即將取消的計算
+            if flights.get(key) is flight:
+                del flights[key]
+            flight.task.cancel()
+            self.stats["cancelled"] += 1
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """執行 factory()，鍵相同的進行中請求直接等待其結果（錯誤同樣傳給所有等待者）"""
+        self.stats["requests"] += 1
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = self._start(self._calls, key, lambda _: factory())
+        else:
+            self.stats["coalesced"] += 1
+            COALESCED_REQUESTS.labels(self.name, "request").inc()
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(self._calls, key, flight)
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """串流 factory() 的片段，鍵相同的進行中串流共用同一個來源（從第一個片段開始輸出）"""
+        self.stats["stream_requests"] += 1
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = self._start(self._streams, key, lambda started: self._produce(started, factory))
+        else:
+            self.stats["stream_coalesced"] += 1
+            COALESCED_REQUESTS.labels(self.name, "stream").inc()
+
+        flight.waiters += 1
+        position = 0
+        try:
+            while True:
+                while position < len(flight.chunks):
+                    yield flight.chunks[position]
+                    position += 1
+                if flight.done:
+                    break
+                await flight.updated.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            self._leave(self._streams, key, flight)
+
+    async def _produce(self, flight: _Flight, factory: Callable[[], AsyncIterator[Any]]):
+        """讀取來源串流並通知所有讀取端"""
+        iterator = factory()
+        try:
+            async for chunk in iterator:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+            self.stats["errors"] += 1
+        finally:
+            flight.done = True
+            flight.notify()
+            await iterator.aclose()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取合併統計"""
+        requests = self.stats["requests"] + self.stats["stream_requests"]
+        coalesced = self.stats["coalesced"] + self.stats["stream_coalesced"]
+        return {
+            **self.stats,
+            "in_flight": len(self._calls),
+            "streams_in_flight": len(self._streams),
+            "coalesced_ratio": round(coalesced / requests, 4) if requests else 0.0
+        }
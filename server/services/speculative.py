@@ -0,0 +1,80 @@
+"""
+推測解碼統計
+以前向呼叫次數推算草稿 token 接受率，並比較輔助解碼與一般解碼的速度
+"""
+
+import threading
+from typing import Any, Dict
+
+
+class ForwardCounter:
+    """計算模型前向呼叫次數（依執行緒分開計數，並行生成互不干擾）"""
+
+    def __init__(self, model: Any):
+        self._local = threading.local()
+        self._handle = model.register_forward_hook(self._hook)
+
+    def _hook(self, module: Any, args: Any, output: Any):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self) -> int:
+        """目前執行緒累計的前向呼叫次數"""
+        return getattr(self._local, "count", 0)
+
+    def remove(self):
+        """移除 hook"""
+        self._handle.remove()
+
+
+class SpeculativeDecodingStats:
+    """輔助（推測）解碼統計
+
+    每次草稿模型前向提出一個 token；每次目標模型前向驗證一輪並至少產生一個 token，
+    因此接受的草稿 token 數 = 生成 token 數 - 目標模型前向次數。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.assisted = {"requests": 0, "tokens": 0, "seconds": 0.0, "target_forwards": 0, "draft_tokens": 0}
+        self.plain = {"requests": 0, "tokens": 0, "seconds": 0.0}
+
+    def record_assisted(self, new_tokens: int, seconds: float, target_forwards: int, draft_forwards: int):
+        """記錄一次輔助解碼"""
+        with self._lock:
+            self.assisted["requests"] += 1
+            self.assisted["tokens"] += new_tokens
+            self.assisted["seconds"] += seconds
+            self.assisted["target_forwards"] += target_forwards
+            self.assisted["draft_tokens"] += draft_forwards
+
+    def record_plain(self, new_tokens: int, seconds: float):
+        """記錄一次一般解碼"""
+        with self._lock:
+            self.plain["requests"] += 1
+            self.plain["tokens"] += new_tokens
+            self.plain["seconds"] += seconds
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取統計"""
+        with self._lock:
+            assisted = dict(self.assisted)
+            plain = dict(self.plain)
+
+        accepted = max(assisted["tokens"] - assisted["target_forwards"], 0)
+        assisted_rate = assisted["tokens"] / assisted["seconds"] if assisted["seconds"] else 0.0
+        plain_rate = plain["tokens"] / plain["seconds"] if plain["seconds"] else 0.0
+
+        return {
+            "assisted_requests": assisted["requests"],
+            "plain_requests": plain["requests"],
+            "draft_tokens": assisted["draft_tokens"],
+            "accepted_tokens": accepted,
+            "acceptance_rate": round(accepted / assisted["draft_tokens"], 4) if assisted["draft_tokens"] else 0.0,
+            "tokens_per_target_forward": (
+                round(assisted["tokens"] / assisted["target_forwards"], 3) if assisted["target_forwards"] else 0.0
+            ),
+            "assisted_tokens_per_second": round(assisted_rate, 2),
+            "plain_tokens_per_second": round(plain_rate, 2),
+            "speedup": round(assisted_rate / plain_rate, 3) if assisted_rate and plain_rate else None
+        }
@@ -0,0 +1,88 @@
+"""
+串流生成工具
+跨執行緒傳遞 token、增量解碼、取消與逾時停止生成
+"""
+
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+
+class IncrementalDecoder:
+    """增量解碼器
+
+    只重新解碼最近一段 token，避免每個 token 都解碼整個序列；
+    結尾為不完整 UTF-8 字元（\\ufffd）時暫緩輸出。
+    """
+
+    def __init__(self, tokenizer: Any):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token_ids: List[int]) -> str:
+        """加入新 token 並回傳新增的文字"""
+        self.token_ids.extend(token_ids)
+
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset],
+            skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:],
+            skip_special_tokens=True
+        )
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+
+class TokenStreamer:
+    """transformers generate 的 streamer，將生成執行緒產生的 token 交給回呼函數
+
+    回呼在生成執行緒中執行，跨執行緒/程序傳遞由回呼自行處理。
+    """
+
+    def __init__(self, on_tokens: Callable[[List[int]], None], skip_prompt: bool = True):
+        self.on_tokens = on_tokens
+        self.skip_prompt = skip_prompt
+        self._prompt_skipped = False
+
+    def put(self, value: Any):
+        """接收 generate 產生的 token（第一次呼叫為提示詞）"""
+        if self.skip_prompt and not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        self.on_tokens(value.reshape(-1).tolist())
+
+    def end(self):
+        """生成結束（結束訊號由呼叫端在 generate 返回後處理）"""
+
+
+class CancellationCriteria:
+    """停止條件：事件被設定或超過期限（time.time() 絕對時間）時讓 generate 在下一個解碼步驟結束"""
+
+    def __init__(self, event: threading.Event, deadline: Optional[float] = None):
+        self.event = event
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs) -> Any:
+        import torch
+
+        if self.reason is None:
+            if self.event.is_set():
+                self.reason = "cancelled"
+            elif self.deadline is not None and time.time() >= self.deadline:
+                self.reason = "deadline"
+
+        return torch.full(
+            (input_ids.shape[0],),
+            self.reason is not None,
+            dtype=torch.bool,
+            device=input_ids.device
+        )
@@ -12,28 +12,53 @@ from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
 import aiofiles
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
+
+from services.api_symbol_index import ApiSymbolIndex
+from services.document_loaders import DocumentPageLoader
+from services.kb_snapshot import KnowledgeSnapshot
+from services.text_splitter import RecursiveTextSplitter
+from utils.startup_timer import startup_timer
 
 logger = logging.getLogger(__name__)
 
 class TeklaKnowledgeBase:
     """Tekla 知識庫管理類"""
     
-    def __init__(self, data_dir: str = "data/tekla"):
+    def __init__(
+        self,
+        data_dir: str = "data/tekla",
+        token_aware_chunking: bool = False,
+        chunk_tokens: Optional[int] = None,
+        chunk_overlap_tokens: int = 32,
+        loader_workers: Optional[int] = None,
+        use_snapshot: bool = True
+    ):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(parents=True, exist_ok=True)
         
-        # 文本分割器
-        self.text_splitter = RecursiveCharacterTextSplitter(
+        # 文本分割器（token 模式會在嵌入模型載入後重建）
+        self.token_aware_chunking = token_aware_chunking
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.text_splitter = RecursiveTextSplitter(
             chunk_size=1000,
             chunk_overlap=200,
             separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
         )
         
+        # PDF / DOCX 逐頁載入器
+        self.page_loader = DocumentPageLoader(max_workers=loader_workers)
+        
+        # 已處理文檔的編譯快照
+        self.snapshot = KnowledgeSnapshot(self.data_dir / "kb_snapshot.pkl") if use_snapshot else None
+        
         # 嵌入模型
         self.embedding_model = None
         self.documents: List[Dict] = []
+        self._documents_by_id: Dict[str, Dict] = {}
+        
+        # API 符號索引（精確與前綴查詢）
+        self.symbol_index = ApiSymbolIndex()
         self.is_initialized = False
         
     async def initialize(self):
@@ -41,15 +66,28 @@ class TeklaKnowledgeBase:
         try:
             logger.info("初始化 Tekla 知識庫...")
             
+            # sentence_transformers 匯入耗時，延後到初始化時才載入
+            with startup_timer.phase("import", "tekla_kb"):
+                from sentence_transformers import SentenceTransformer
+            
             # 載入嵌入模型
             logger.info("載入嵌入模型...")
-            self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+            with startup_timer.phase("model_load", "tekla_kb"):
+                self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
             
-            # 創建 Tekla API 文檔
-            await self._create_tekla_api_docs()
+            if self.token_aware_chunking:
+                self._use_token_splitter()
             
-            # 載入現有文檔
-            await self._load_documents()
+            with startup_timer.phase("index_open", "tekla_kb"):
+                # 創建 Tekla API 文檔
+                await self._create_tekla_api_docs()
+                
+                # 來源未變更時直接載入快照，否則重新處理並寫入快照
+                if not self._load_snapshot():
+                    await self._load_documents()
+                    self._save_snapshot()
+                
+                self._documents_by_id = {doc["id"]: doc for doc in self.documents}
             
             self.is_initialized = True
             logger.info(f"✅ Tekla 知識庫初始化完成，載入 {len(self.documents)} 個文檔")
@@ -58,6 +96,16 @@ class TeklaKnowledgeBase:
             logger.error(f"❌ Tekla 知識庫初始化失敗: {e}")
             raise
     
+    def _use_token_splitter(self):
+        """改用嵌入模型 tokenizer 計算區塊長度"""
+        chunk_tokens = self.chunk_tokens or self.embedding_model.max_seq_length
+        self.text_splitter = RecursiveTextSplitter.from_tokenizer(
+            self.embedding_model.tokenizer,
+            chunk_size=chunk_tokens,
+            chunk_overlap=min(self.chunk_overlap_tokens, chunk_tokens // 2)
+        )
+        logger.info(f"使用 token 分割模式: 每區塊 {chunk_tokens} tokens")
+    
     async def _create_tekla_api_docs(self):
         """創建 Tekla API 文檔"""
         api_docs = {
@@ -210,13 +258,67 @@ gaDrawing.Insert();
             }
         }
         
-        # 保存 API 文檔
+        # 保存 API 文檔（內容相同時略過寫入，保留檔案時間戳以利快照比對）
         api_file = self.data_dir / "tekla_api_docs.json"
+        content = json.dumps(api_docs, ensure_ascii=False, indent=2)
+        if api_file.exists():
+            async with aiofiles.open(api_file, 'r', encoding='utf-8') as f:
+                if await f.read() == content:
+                    logger.info(f"Tekla API 文檔未變更: {api_file}")
+                    return
+        
         async with aiofiles.open(api_file, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(api_docs, ensure_ascii=False, indent=2))
+            await f.write(content)
         
         logger.info(f"✅ Tekla API 文檔已創建: {api_file}")
     
+    def _source_files(self) -> List[Path]:
+        """列出所有會被載入的來源檔案"""
+        return [
+            file_path for file_path in self.data_dir.iterdir()
+            if file_path.name == "tekla_api_docs.json"
+            or file_path.suffix in (".txt", ".md")
+            or self.page_loader.supports(file_path)
+        ]
+    
+    def _snapshot_config(self) -> Dict:
+        """影響處理結果的設定，變更時快照失效"""
+        return {
+            "chunk_size": self.text_splitter.chunk_size,
+            "chunk_overlap": self.text_splitter.chunk_overlap,
+            "separators": self.text_splitter.separators,
+            "token_aware_chunking": self.token_aware_chunking
+        }
+    
+    def _load_snapshot(self) -> bool:
+        """嘗試從快照載入文檔"""
+        if self.snapshot is None:
+            return False
+        
+        snapshot = self.snapshot.load(self._source_files(), self._snapshot_config())
+        if snapshot is None:
+            return False
+        
+        self.documents = snapshot["documents"]
+        self.symbol_index = ApiSymbolIndex.from_symbols(snapshot.get("symbols", []))
+        logger.info(f"從快照載入 {len(self.documents)} 個文檔")
+        return True
+    
+    def _save_snapshot(self):
+        """寫入快照（失敗不影響初始化）"""
+        if self.snapshot is None:
+            return
+        
+        try:
+            self.snapshot.save(
+                self._source_files(),
+                self._snapshot_config(),
+                self.documents,
+                symbols=self.symbol_index.symbols
+            )
+        except Exception as e:
+            logger.warning(f"寫入知識庫快照失敗: {e}")
+    
     async def _load_documents(self):
         """載入文檔到記憶體"""
         try:
@@ -234,6 +336,10 @@ gaDrawing.Insert();
             
             for file_path in self.data_dir.glob("*.md"):
                 await self._load_markdown_file(file_path)
+            
+            for file_path in sorted(self.data_dir.iterdir()):
+                if self.page_loader.supports(file_path):
+                    await self._load_paged_file(file_path)
                 
         except Exception as e:
             logger.error(f"載入文檔失敗: {e}")
@@ -241,6 +347,9 @@ gaDrawing.Insert();
     
     async def _process_api_docs(self, api_docs: Dict):
         """處理 API 文檔"""
+        self.symbol_index = ApiSymbolIndex.from_api_docs(api_docs)
+        logger.info(f"已建立 API 符號索引: {len(self.symbol_index)} 個符號")
+        
         for namespace, namespace_data in api_docs.items():
             # 添加命名空間文檔
             self.documents.append({
@@ -328,10 +437,54 @@ gaDrawing.Insert();
         except Exception as e:
             logger.error(f"載入 Markdown 檔案失敗 {file_path}: {e}")
     
+    async def _load_paged_file(self, file_path: Path):
+        """逐頁載入 PDF / DOCX 檔案"""
+        doc_type = file_path.suffix.lower().lstrip(".")
+        page_count = 0
+        chunk_count = 0
+        
+        try:
+            async for page_number, text in self.page_loader.iter_pages(file_path):
+                page_count += 1
+                
+                # 分割單頁文本
+                chunks = self.text_splitter.split_text(text)
+                
+                for i, chunk in enumerate(chunks):
+                    self.documents.append({
+                        "id": f"{doc_type}_{file_path.stem}_p{page_number}_{i}",
+                        "type": doc_type,
+                        "title": f"{file_path.name} (第 {page_number} 頁)",
+                        "content": chunk,
+                        "metadata": {"source": str(file_path), "page": page_number}
+                    })
+                chunk_count += len(chunks)
+            
+            logger.info(f"已載入 {file_path.name}: {page_count} 頁, {chunk_count} 個區塊")
+                
+        except Exception as e:
+            logger.error(f"載入分頁檔案失敗 {file_path}: {e}")
+    
     def get_documents(self) -> List[Dict]:
         """獲取所有文檔"""
         return self.documents
     
+    def get_document(self, doc_id: str) -> Optional[Dict]:
+        """依 ID 獲取文檔"""
+        return self._documents_by_id.get(doc_id)
+    
+    def lookup_symbol(self, name: str) -> List[Dict]:
+        """精確查詢 API 符號，例如 Model.CommitChanges"""
+        return self.symbol_index.lookup(name)
+    
+    def complete_symbol(self, prefix: str, limit: int = 20) -> List[Dict]:
+        """API 符號自動完成"""
+        return self.symbol_index.complete(prefix, limit)
+    
+    def resolve_symbols(self, text: str) -> List[Dict]:
+        """解析文本中引用的 API 符號"""
+        return self.symbol_index.resolve(text)
+    
     def search_documents(self, query: str, doc_type: Optional[str] = None) -> List[Dict]:
         """搜尋文檔"""
         results = []
@@ -355,6 +508,9 @@ gaDrawing.Insert();
     
     async def cleanup(self):
         """清理資源"""
+        self.page_loader.shutdown()
         self.documents.clear()
+        self._documents_by_id.clear()
+        self.symbol_index = ApiSymbolIndex()
         self.is_initialized = False
         logger.info("Tekla 知識庫已清理")
@@ -0,0 +1,217 @@
+"""
+生成遙測
+記錄每個請求的提示詞/生成 token 數、排隊時間、首 token 延遲、預填與解碼速度、記憶體峰值
+及檢索內容壓縮的效果，並匯出為 Prometheus 直方圖
+"""
+
+import asyncio
+import sys
+import time
+from typing import Any, Dict, Optional
+
+from prometheus_client import Counter, Histogram
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+MEMORY_BUCKETS = tuple(gb * 1024 ** 3 for gb in (1, 2, 4, 8, 12, 16, 24, 32, 48, 80))
+
+PROMPT_TOKENS = Histogram(
+    "ai_prompt_tokens", "提示詞 token 數", ["mode"], buckets=TOKEN_BUCKETS
+)
+GENERATED_TOKENS = Histogram(
+    "ai_generated_tokens", "生成 token 數", ["mode"], buckets=TOKEN_BUCKETS
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "ai_queue_wait_seconds", "請求排隊等待時間", ["mode"], buckets=LATENCY_BUCKETS
+)
+TTFT_SECONDS = Histogram(
+    "ai_time_to_first_token_seconds", "從提交到第一個 token 的時間", ["mode"], buckets=LATENCY_BUCKETS
+)
+PREFILL_SECONDS = Histogram(
+    "ai_prefill_seconds", "預填（含第一個 token）時間", ["mode"], buckets=LATENCY_BUCKETS
+)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "ai_decode_tokens_per_second", "解碼階段每秒 token 數", ["mode"], buckets=RATE_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "ai_request_seconds", "請求總時間", ["mode"], buckets=LATENCY_BUCKETS
+)
+PEAK_MEMORY_BYTES = Histogram(
+    "ai_peak_memory_bytes", "生成期間的裝置記憶體峰值（GPU）或常駐記憶體（CPU）", ["mode"], buckets=MEMORY_BUCKETS
+)
+CONTEXT_COMPRESSION_RATIO = Histogram(
+    "ai_context_compression_ratio", "檢索內容壓縮後與壓縮前的 token 數比例", ["mode"], buckets=RATIO_BUCKETS
+)
+PREFILL_SECONDS_SAVED = Histogram(
+    "ai_prefill_seconds_saved", "檢索內容壓縮省下的預填時間（估計）", ["mode"], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter(
+    "ai_generation_requests", "生成請求數", ["mode", "outcome"]
+)
+
+
+def _on_cuda(device: Any) -> bool:
+    """裝置是否為 CUDA（None 表示目前的 CUDA 裝置，若有的話）"""
+    # 尚未載入 torch 的程序（例如模擬伺服器）不可能配置 GPU 記憶體，也不必為此載入
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return False
+    return device is None or torch.device(device).type == "cuda"
+
+
+def reset_peak_memory(device: Any = None):
+    """重設 GPU 記憶體峰值統計（CPU 無作用）"""
+    if _on_cuda(device):
+        sys.modules["torch"].cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_bytes(device: Any = None) -> Optional[int]:
+    """GPU 的已配置記憶體峰值；CPU 則回傳目前常駐記憶體"""
+    if _on_cuda(device):
+        return sys.modules["torch"].cuda.max_memory_allocated(device)
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+class GenerationTelemetry:
+    """單一生成請求的遙測資料
+
+    submitted_at 使用 time.time()，可跨程序計算排隊時間；其餘區間使用 perf_counter。
+    """
+
+    def __init__(self, prompt_tokens: int = 0, submitted_at: Optional[float] = None):
+        self.prompt_tokens = prompt_tokens
+        self.generated_tokens = 0
+        self.submitted_at = submitted_at if submitted_at is not None else time.time()
+        self.queue_wait_seconds: Optional[float] = None
+        self.prefill_seconds: Optional[float] = None
+        self.decode_seconds: Optional[float] = None
+        self.peak_memory_bytes: Optional[int] = None
+        self.context_tokens = 0  # 經過壓縮的檢索內容（壓縮後）token 數
+        self.context_tokens_saved = 0  # 壓縮移除的 token 數
+        self._started: Optional[float] = None
+
+    def start(self):
+        """開始生成（離開佇列）"""
+        self.queue_wait_seconds = max(time.time() - self.submitted_at, 0.0)
+        self._started = time.perf_counter()
+
+    def first_token(self):
+        """產生第一個 token（可重複呼叫，只記錄第一次）"""
+        if self.prefill_seconds is None and self._started is not None:
+            self.prefill_seconds = time.perf_counter() - self._started
+
+    def finish(self, generated_tokens: int, peak_memory: Optional[int] = None):
+        """生成結束"""
+        self.generated_tokens = generated_tokens
+        self.peak_memory_bytes = peak_memory
+        if self._started is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        if self.prefill_seconds is None:
+            self.prefill_seconds = elapsed
+        self.decode_seconds = max(elapsed - self.prefill_seconds, 0.0)
+
+    @property
+    def ttft_seconds(self) -> Optional[float]:
+        """首 token 延遲（含排隊）"""
+        if self.prefill_seconds is None:
+            return None
+        return (self.queue_wait_seconds or 0.0) + self.prefill_seconds
+
+    @property
+    def decode_tokens_per_second(self) -> Optional[float]:
+        """解碼速度（不含第一個 token）"""
+        if not self.decode_seconds or self.generated_tokens < 2:
+            return None
+        return (self.generated_tokens - 1) / self.decode_seconds
+
+    @property
+    def total_seconds(self) -> Optional[float]:
+        """請求總時間"""
+        if self.prefill_seconds is None:
+            return None
+        return self.ttft_seconds + (self.decode_seconds or 0.0)
+
+    @property
+    def context_compression_ratio(self) -> Optional[float]:
+        """檢索內容壓縮後與壓縮前的 token 數比例"""
+        original = self.context_tokens + self.context_tokens_saved
+        if not original:
+            return None
+        return self.context_tokens / original
+
+    @property
+    def prefill_seconds_saved(self) -> Optional[float]:
+        """壓縮省下的預填時間：移除的 token 數乘以本次請求每個提示詞 token 的預填時間"""
+        if not self.context_tokens_saved or self.prefill_seconds is None or not self.prompt_tokens:
+            return None
+        return self.context_tokens_saved * self.prefill_seconds / self.prompt_tokens
+
+    def copy_from(self, other: "GenerationTelemetry"):
+        """複製另一個請求的遙測（合併的請求共用同一次生成），保留本請求的提交時間"""
+        submitted_at = self.submitted_at
+        self.__dict__.update(other.__dict__)
+        self.submitted_at = submitted_at
+
+    def update(self, data: Dict[str, Any]):
+        """合併其他程序回報的遙測資料"""
+        for key in ("generated_tokens", "queue_wait_seconds", "prefill_seconds", "decode_seconds", "peak_memory_bytes"):
+            if data.get(key) is not None:
+                setattr(self, key, data[key])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """轉為回應內容"""
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return round(value, 4) if value is not None else None
+
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "queue_wait_seconds": rounded(self.queue_wait_seconds),
+            "ttft_seconds": rounded(self.ttft_seconds),
+            "prefill_seconds": rounded(self.prefill_seconds),
+            "decode_seconds": rounded(self.decode_seconds),
+            "decode_tokens_per_second": rounded(self.decode_tokens_per_second),
+            "total_seconds": rounded(self.total_seconds),
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "context_tokens": self.context_tokens,
+            "context_tokens_saved": self.context_tokens_saved,
+            "context_compression_ratio": rounded(self.context_compression_ratio),
+            "prefill_seconds_saved": rounded(self.prefill_seconds_saved)
+        }
+
+    def observe(self, mode: str):
+        """寫入 Prometheus 直方圖"""
+        REQUESTS.labels(mode, "ok").inc()
+        PROMPT_TOKENS.labels(mode).observe(self.prompt_tokens)
+        GENERATED_TOKENS.labels(mode).observe(self.generated_tokens)
+        for histogram, value in (
+            (QUEUE_WAIT_SECONDS, self.queue_wait_seconds),
+            (TTFT_SECONDS, self.ttft_seconds),
+            (PREFILL_SECONDS, self.prefill_seconds),
+            (DECODE_TOKENS_PER_SECOND, self.decode_tokens_per_second),
+            (REQUEST_SECONDS, self.total_seconds),
+            (PEAK_MEMORY_BYTES, self.peak_memory_bytes),
+            (CONTEXT_COMPRESSION_RATIO, self.context_compression_ratio),
+            (PREFILL_SECONDS_SAVED, self.prefill_seconds_saved)
+        ):
+            if value is not None:
+                histogram.labels(mode).observe(value)
+
+
+def record_failure(mode: str, error: BaseException):
+    """記錄失敗的請求"""
+    if isinstance(error, TimeoutError):
+        outcome = "timeout"
+    elif isinstance(error, asyncio.CancelledError):
+        outcome = "cancelled"
+    else:
+        outcome = "error"
+    REQUESTS.labels(mode, outcome).inc()
@@ -0,0 +1,159 @@
+"""
+文本分割器
+單趟遞迴字元分割，與 langchain RecursiveCharacterTextSplitter 輸出一致
+"""
+
+import logging
+from collections import deque
+from typing import Any, Callable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+
+
+class RecursiveTextSplitter:
+    """遞迴文本分割器
+
+    分隔符層級、保留分隔符（附加在下一段開頭）、重疊與去除空白的語義
+    皆與 langchain 的 RecursiveCharacterTextSplitter 相同，但不依賴 langchain，
+    並以 str.split 取代正則、以佇列取代串列切片合併，避免重複掃描。
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+        separators: Optional[Sequence[str]] = None,
+        length_function: Callable[[str], int] = len,
+        strip_whitespace: bool = True
+    ):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"chunk_overlap ({chunk_overlap}) 不能大於 chunk_size ({chunk_size})"
+            )
+
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators or DEFAULT_SEPARATORS)
+        self.length_function = length_function
+        self.strip_whitespace = strip_whitespace
+
+    @classmethod
+    def from_tokenizer(
+        cls,
+        tokenizer: Any,
+        chunk_size: int = 256,
+        chunk_overlap: int = 32,
+        **kwargs
+    ) -> "RecursiveTextSplitter":
+        """以 tokenizer 的 token 數作為長度單位（例如嵌入模型的 tokenizer）"""
+
+        def token_length(text: str) -> int:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+
+        return cls(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=token_length,
+            **kwargs
+        )
+
+    def split_text(self, text: str) -> List[str]:
+        """分割文本"""
+        return self._split_text(text, self.separators)
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        """依分隔符層級遞迴分割"""
+        final_chunks: List[str] = []
+
+        # 選擇文本中出現的第一個分隔符
+        separator = separators[-1]
+        new_separators: List[str] = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if candidate in text:
+                separator = candidate
+                new_separators = separators[i + 1:]
+                break
+
+        splits = self._split_keep_separator(text, separator)
+
+        # 分隔符已保留在片段開頭，合併時不再插入
+        good_splits: List[str] = []
+        good_lengths: List[int] = []
+        for piece in splits:
+            length = self.length_function(piece)
+            if length < self.chunk_size:
+                good_splits.append(piece)
+                good_lengths.append(length)
+                continue
+
+            if good_splits:
+                final_chunks.extend(self._merge_splits(good_splits, good_lengths))
+                good_splits = []
+                good_lengths = []
+
+            if not new_separators:
+                final_chunks.append(piece)
+            else:
+                final_chunks.extend(self._split_text(piece, new_separators))
+
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits, good_lengths))
+
+        return final_chunks
+
+    @staticmethod
+    def _split_keep_separator(text: str, separator: str) -> List[str]:
+        """分割並將分隔符保留在下一個片段開頭"""
+        if not separator:
+            return list(text)
+
+        parts = text.split(separator)
+        splits = [parts[0]]
+        splits.extend(separator + part for part in parts[1:])
+        return [piece for piece in splits if piece != ""]
+
+    def _merge_splits(self, splits: List[str], lengths: List[int]) -> List[str]:
+        """將小片段合併為區塊並保留重疊"""
+        docs: List[str] = []
+        current: deque = deque()
+        current_lengths: deque = deque()
+        total = 0
+
+        for piece, length in zip(splits, lengths):
+            if total + length > self.chunk_size:
+                if total > self.chunk_size:
+                    logger.warning(
+                        f"產生的區塊長度 {total} 超過設定的 chunk_size {self.chunk_size}"
+                    )
+                if current:
+                    doc = self._join_docs(current)
+                    if doc is not None:
+                        docs.append(doc)
+                    # 從前方移除片段直到剩餘部分符合重疊長度
+                    while total > self.chunk_overlap or (
+                        total + length > self.chunk_size and total > 0
+                    ):
+                        total -= current_lengths.popleft()
+                        current.popleft()
+
+            current.append(piece)
+            current_lengths.append(length)
+            total += length
+
+        doc = self._join_docs(current)
+        if doc is not None:
+            docs.append(doc)
+
+        return docs
+
+    def _join_docs(self, docs: Sequence[str]) -> Optional[str]:
+        """連接片段"""
+        text = "".join(docs)
+        if self.strip_whitespace:
+            text = text.strip()
+        return text or None
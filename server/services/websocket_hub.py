@@ -0,0 +1,365 @@
+"""
+WebSocket 多工通道
+單一連線上同時承載多個聊天 token 串流、RAG 查詢結果，以及伺服器主動推送的 GPU/系統狀態差異。
+
+協定（JSON 文字訊息）：
+- {"type": "ping"} -> {"type": "pong"}
+- {"type": "subscribe" | "unsubscribe", "channels": [...]}：訂閱狀態通道，訂閱時先送完整快照
+  （"full": true），之後只送 JSON Merge Patch（RFC 7386）差異
+- 請求訊息（例如 {"type": "chat", "id": ...}）交給註冊的處理函式，回應帶相同 id；
+  {"type": "cancel", "id": ...} 取消進行中的請求
+
+背壓：每個連線的待送訊息有上限，串流請求在佇列滿時暫停（生成也隨之暫停），
+超過 send_timeout 仍無法送出的慢速客戶端會被斷線；狀態通道只保留最新快照，
+客戶端來不及接收的中間狀態直接合併；同一請求相鄰的 token 訊息在送出前合併為一則。
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# 慢速客戶端斷線時的關閉代碼（1013: Try Again Later）
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+StatusProvider = Callable[[], Awaitable[Dict[str, Any]]]
+RequestHandler = Callable[["WebSocketConnection", Dict[str, Any]], Awaitable[None]]
+
+
+def merge_patch_diff(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """計算由 old 變為 new 的 JSON Merge Patch（刪除的鍵為 None，串列整個取代）"""
+    patch: Dict[str, Any] = {key: None for key in old.keys() - new.keys()}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested = merge_patch_diff(old[key], value)
+            if nested:
+                patch[key] = nested
+        elif value != old[key]:
+            patch[key] = value
+    return patch
+
+
+def apply_merge_patch(target: Dict[str, Any], patch: Dict[str, Any]) -> Dict[str, Any]:
+    """套用 JSON Merge Patch，回傳新的物件"""
+    result = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = apply_merge_patch(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+class WebSocketConnection:
+    """單一 WebSocket 連線：訂閱狀態、待送訊息佇列與進行中的請求"""
+
+    def __init__(self, hub: "WebSocketHub", websocket: WebSocket):
+        self.hub = hub
+        self.websocket = websocket
+        self.subscriptions: Set[str] = set()
+        self.requests: Dict[str, asyncio.Task] = {}
+        self.closed = False
+
+        self._outbox: Deque[Dict[str, Any]] = deque()
+        self._wake = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._latest: Dict[str, Dict[str, Any]] = {}  # 各狀態通道最新的快照
+        self._sent: Dict[str, Dict[str, Any]] = {}  # 各狀態通道上次送出時的快照
+        self._dirty: Set[str] = set()
+
+    async def send(self, message: Dict[str, Any], block: bool = True):
+        """排入待送訊息
+
+        block=True（串流內容）時在佇列滿時等待，超過 send_timeout 視為慢速客戶端並斷線；
+        控制訊息（pong、錯誤等）使用 block=False，一律排入。
+        """
+        if self.closed:
+            raise ConnectionError("WebSocket 已關閉")
+        while block and len(self._outbox) >= self.hub.max_pending:
+            self._space.clear()
+            self.hub.stats["backpressure_waits"] += 1
+            try:
+                await asyncio.wait_for(self._space.wait(), self.hub.send_timeout)
+            except asyncio.TimeoutError:
+                await self.close_slow_consumer()
+                raise ConnectionError("客戶端接收過慢，已斷線") from None
+            if self.closed:
+                raise ConnectionError("WebSocket 已關閉")
+        self._outbox.append(message)
+        self._wake.set()
+
+    def update_status(self, channel: str, snapshot: Dict[str, Any]):
+        """更新狀態通道的最新快照（尚未送出的舊快照直接被取代）"""
+        if channel in self._dirty:
+            self.hub.stats["status_conflated"] += 1
+        self._latest[channel] = snapshot
+        self._dirty.add(channel)
+        self._wake.set()
+
+    def subscribe(self, channel: str):
+        """訂閱狀態通道，下一次送出完整快照"""
+        self.subscriptions.add(channel)
+        self._sent.pop(channel, None)
+
+    def unsubscribe(self, channel: str):
+        """取消訂閱狀態通道"""
+        self.subscriptions.discard(channel)
+        self._latest.pop(channel, None)
+        self._sent.pop(channel, None)
+        self._dirty.discard(channel)
+
+    async def sender(self):
+        """送出待送訊息與狀態差異，直到連線關閉"""
+        while not self.closed:
+            await self._wake.wait()
+            self._wake.clear()
+
+            while self._outbox and not self.closed:
+                message = self._outbox.popleft()
+                # 同一請求相鄰的 token 訊息合併送出
+                while (
+                    message.get("event") == "token"
+                    and self._outbox
+                    and self._outbox[0].get("event") == "token"
+                    and self._outbox[0].get("id") == message.get("id")
+                    and self._outbox[0].get("type") == message.get("type")
+                ):
+                    message = {**message, "text": message["text"] + self._outbox.popleft()["text"]}
+                    self.hub.stats["tokens_coalesced"] += 1
+                if len(self._outbox) < self.hub.max_pending:
+                    self._space.set()
+                await self._transmit(message)
+
+            for channel in list(self._dirty):
+                self._dirty.discard(channel)
+                if channel not in self.subscriptions or channel not in self._latest:
+                    continue
+                snapshot = self._latest[channel]
+                previous = self._sent.get(channel)
+                if previous is None:
+                    await self._transmit({"type": channel, "full": True, "data": snapshot, "timestamp": time.time()})
+                else:
+                    patch = merge_patch_diff(previous, snapshot)
+                    if not patch:
+                        continue
+                    await self._transmit({"type": channel, "full": False, "data": patch, "timestamp": time.time()})
+                self._sent[channel] = snapshot
+                self.hub.stats["status_updates"] += 1
+
+    async def _transmit(self, message: Dict[str, Any]):
+        """實際送出一則訊息"""
+        try:
+            await asyncio.wait_for(self.websocket.send_json(message), self.hub.send_timeout)
+        except asyncio.TimeoutError:
+            await self.close_slow_consumer()
+            return
+        except Exception:
+            # 客戶端已斷線，由接收端結束連線
+            self.closed = True
+            self._space.set()
+            return
+        self.hub.stats["messages_sent"] += 1
+
+    async def close_slow_consumer(self):
+        """中斷接收過慢的客戶端"""
+        if self.closed:
+            return
+        logger.warning("WebSocket 客戶端接收過慢，中斷連線")
+        self.hub.stats["slow_consumer_disconnects"] += 1
+        self.closed = True
+        self._wake.set()
+        self._space.set()
+        try:
+            await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+
+class WebSocketHub:
+    """WebSocket 連線管理：請求處理函式、狀態通道與推送排程"""
+
+    def __init__(self, max_pending: int = 256, send_timeout: float = 30.0):
+        self.max_pending = max_pending  # 每個連線待送的串流訊息上限
+        self.send_timeout = send_timeout
+        self.connections: Set[WebSocketConnection] = set()
+        self._handlers: Dict[str, RequestHandler] = {}
+        self._channels: Dict[str, Dict[str, Any]] = {}
+        self.stats = {
+            "connections_total": 0,
+            "messages_received": 0,
+            "messages_sent": 0,
+            "requests": 0,
+            "cancelled": 0,
+            "tokens_coalesced": 0,
+            "backpressure_waits": 0,
+            "status_updates": 0,
+            "status_conflated": 0,
+            "slow_consumer_disconnects": 0
+        }
+
+    def register(self, message_type: str, handler: RequestHandler):
+        """註冊請求處理函式（處理函式以 connection.send 回傳帶相同 id 的訊息）"""
+        self._handlers[message_type] = handler
+
+    def add_status_channel(self, channel: str, provider: StatusProvider, interval: float = 2.0):
+        """新增狀態通道：有訂閱者時每 interval 秒取得一次快照並推送差異"""
+        self._channels[channel] = {"provider": provider, "interval": interval, "task": None}
+
+    @property
+    def channels(self) -> List[str]:
+        return list(self._channels)
+
+    async def serve(self, websocket: WebSocket):
+        """處理一個 WebSocket 連線直到斷線"""
+        await websocket.accept()
+        connection = WebSocketConnection(self, websocket)
+        self.connections.add(connection)
+        self.stats["connections_total"] += 1
+        sender = asyncio.ensure_future(connection.sender())
+
+        try:
+            while not connection.closed:
+                message = await websocket.receive_json()
+                self.stats["messages_received"] += 1
+                await self._dispatch(connection, message)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            if not connection.closed:
+                logger.error(f"WebSocket 連線錯誤: {e}")
+        finally:
+            connection.closed = True
+            connection._wake.set()
+            connection._space.set()
+            for task in connection.requests.values():
+                task.cancel()
+            self.connections.discard(connection)
+            sender.cancel()
+            self._update_publishers()
+
+    async def _dispatch(self, connection: WebSocketConnection, message: Any):
+        """處理客戶端訊息"""
+        if not isinstance(message, dict):
+            await connection.send({"type": "error", "message": "訊息必須是 JSON 物件"}, block=False)
+            return
+
+        message_type = message.get("type")
+        if message_type == "ping":
+            await connection.send({"type": "pong", "timestamp": time.time()}, block=False)
+
+        elif message_type in ("subscribe", "unsubscribe"):
+            channels = message.get("channels") or []
+            unknown = [channel for channel in channels if channel not in self._channels]
+            if unknown:
+                await connection.send({
+                    "type": "error",
+                    "message": f"未知的通道: {', '.join(map(str, unknown))}（可用: {', '.join(self._channels)}）"
+                }, block=False)
+                return
+            for channel in channels:
+                if message_type == "subscribe":
+                    connection.subscribe(channel)
+                else:
+                    connection.unsubscribe(channel)
+            await connection.send({"type": f"{message_type}d", "channels": sorted(connection.subscriptions)}, block=False)
+            self._update_publishers(refresh=channels if message_type == "subscribe" else ())
+
+        elif message_type == "cancel":
+            task = connection.requests.get(str(message.get("id")))
+            if task is not None:
+                task.cancel()
+
+        elif message_type in self._handlers:
+            request_id = str(message.get("id") or f"{message_type}-{self.stats['requests']}")
+            if request_id in connection.requests:
+                await connection.send({"type": "error", "id": request_id, "message": "請求 id 重複"}, block=False)
+                return
+            self.stats["requests"] += 1
+            task = asyncio.ensure_future(self._run_request(connection, message_type, {**message, "id": request_id}))
+            connection.requests[request_id] = task
+
+        else:
+            await connection.send({"type": "error", "message": f"未知的訊息類型: {message_type}"}, block=False)
+
+    async def _run_request(self, connection: WebSocketConnection, message_type: str, message: Dict[str, Any]):
+        """執行請求處理函式，錯誤與取消回報給客戶端"""
+        request_id = message["id"]
+        try:
+            await self._handlers[message_type](connection, message)
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            if not connection.closed:
+                await connection.send({"type": "cancelled", "id": request_id}, block=False)
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logger.error(f"WebSocket 請求 {message_type} 失敗: {e}")
+            if not connection.closed:
+                error = {"type": "error", "id": request_id, "message": str(e)}
+                if getattr(e, "retry_after", None) is not None:
+                    # 未准入（伺服器飽和）時附上建議的重試間隔
+                    error["retry_after"] = e.retry_after
+                await connection.send(error, block=False)
+        finally:
+            connection.requests.pop(request_id, None)
+
+    def _update_publishers(self, refresh=()):
+        """有訂閱者的狀態通道啟動推送排程，沒有訂閱者的停止"""
+        for name, channel in self._channels.items():
+            subscribed = any(name in connection.subscriptions for connection in self.connections)
+            task = channel["task"]
+            if subscribed and (task is None or task.done()):
+                channel["task"] = asyncio.ensure_future(self._publish(name))
+            elif subscribed and name in refresh:
+                # 新訂閱者立即取得快照，不必等到下一次排程
+                asyncio.ensure_future(self._publish_once(name))
+            elif not subscribed and task is not None:
+                task.cancel()
+                channel["task"] = None
+
+    async def _publish_once(self, name: str):
+        """取得一次快照並交給訂閱者"""
+        try:
+            snapshot = await self._channels[name]["provider"]()
+        except Exception as e:
+            logger.error(f"狀態通道 {name} 取得快照失敗: {e}")
+            return
+        for connection in list(self.connections):
+            if name in connection.subscriptions:
+                connection.update_status(name, snapshot)
+
+    async def _publish(self, name: str):
+        """狀態通道的推送排程"""
+        while True:
+            await self._publish_once(name)
+            await asyncio.sleep(self._channels[name]["interval"])
+
+    async def close(self):
+        """停止所有推送排程"""
+        for channel in self._channels.values():
+            if channel["task"] is not None:
+                channel["task"].cancel()
+                channel["task"] = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取連線統計"""
+        return {
+            **self.stats,
+            "connections": len(self.connections),
+            "active_requests": sum(len(connection.requests) for connection in self.connections),
+            "subscriptions": {
+                name: sum(1 for connection in self.connections if name in connection.subscriptions)
+                for name in self._channels
+            },
+            "max_pending": self.max_pending
+        }
@@ -4,15 +4,37 @@ MCP Tekla+ 簡化伺服器
 用於快速啟動和測試
 """
 
+import argparse
 import asyncio
+import hashlib
 import logging
 import json
-from typing import Dict, Any, Optional
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-import uvicorn
+import os
+import random
+import re
+import tempfile
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, List, Optional, Tuple
+
+from utils.startup_timer import startup_timer
+
+with startup_timer.phase("import", "simple_server"):
+    from fastapi import FastAPI, HTTPException, Request, WebSocket
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import JSONResponse, Response, StreamingResponse
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+    from pydantic import BaseModel
+    import uvicorn
+
+from services.admission import Admission, AdmissionController, AdmissionRejected, parse_priority
+from services.api_symbol_index import ApiSymbolIndex
+from services.code_stopping import default_stop_options, trim_code_output
+from services.context_compressor import ContextCompressor
+from services.mock_backend import MockBackend, request_delay
+from services.shared_index import MANIFEST, SharedIndex, write_shared_index
+from services.single_flight import SingleFlight, flight_key
+from services.telemetry import GenerationTelemetry, peak_memory_bytes
+from services.websocket_hub import WebSocketHub
 
 # 設置日誌
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +47,63 @@ app = FastAPI(
     version="1.0.0"
 )
 
+class MockDelayHeader:
+    """在回應標頭 X-Mock-Delay 附上本次請求的模擬延遲（秒），負載測試扣除後即為框架開銷
+
+    以 ASGI 中介層實作，不經過 BaseHTTPMiddleware，避免中介層本身增加量測到的開銷。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accumulated = [0.0]
+        token = request_delay.set(accumulated)
+
+        async def send_with_delay(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-mock-delay", f"{accumulated[0]:.6f}".encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_delay)
+        finally:
+            request_delay.reset(token)
+
+app.add_middleware(MockDelayHeader)
+
+# 多工作程序模式：工作程序數（由 main 設定，供各工作程序平分准入限制）與父程序建立的共用索引目錄
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+SHARED_INDEX_DIR = os.environ.get("SHARED_INDEX_DIR") or os.path.join(
+    tempfile.gettempdir(), "mcp-tekla-simple-server", "shared_index"
+)
+
+# 准入控制：各端點的並行上限與優先順序佇列，飽和時回傳 429（限制為整個伺服器的總量）
+admission = AdmissionController(os.environ.get("ADMISSION_LIMITS", ""), workers=SERVER_WORKERS)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    """未准入的請求回傳 429 與建議的重試間隔"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "limiter": exc.limiter, "reason": exc.reason, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+def request_priority(request: Request, default: str) -> str:
+    """請求的優先順序（X-Priority 標頭：interactive / normal / batch）"""
+    try:
+        return parse_priority(request.headers.get("x-priority"), default)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # CORS 設置
 app.add_middleware(
     CORSMiddleware,
@@ -34,6 +113,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def on_startup():
+    """開啟共用索引（多工作程序模式下只開啟父程序建立的索引），啟動完成後輸出啟動時間報告"""
+    global shared_index
+    with startup_timer.phase("index_open", "simple_server"):
+        shared_index = open_shared_index(SHARED_INDEX_DIR, build=SERVER_WORKERS == 1)
+    startup_timer.mark_ready()
+    startup_timer.log_report()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """停止 WebSocket 狀態推送"""
+    await ws_hub.close()
+
 # 請求模型
 class ChatRequest(BaseModel):
     message: str
@@ -41,16 +134,73 @@ class ChatRequest(BaseModel):
     use_rag: bool = True
     temperature: float = 0.7
     max_tokens: int = 2048
+    include_metrics: bool = False  # 回應中附上本次請求的遙測資料
+    session_id: Optional[str] = None  # 多輪對話的工作階段，同一工作階段延續先前的對話
 
 class RAGQueryRequest(BaseModel):
     query: str
     top_k: int = 5
     threshold: float = 0.7
+    compress: bool = False  # 回傳壓縮後的結果（只保留與查詢相關的句子）與壓縮報告
 
 class TeklaCommandRequest(BaseModel):
     command: str
     parameters: Optional[Dict] = None
     context: Optional[str] = None
+    include_metrics: bool = False
+    code_only: bool = False  # 只回傳代碼區塊內容
+
+class RAGBatchRequest(BaseModel):
+    queries: List[RAGQueryRequest]
+
+class TeklaCommandBatchRequest(BaseModel):
+    commands: List[TeklaCommandRequest]
+
+class MockBackendRequest(BaseModel):
+    backend: str = "default"  # 預設名稱（default / zero / gpu）或「端點=分布」設定
+    error_rate: float = 0.0
+    seed: Optional[int] = None
+
+class ModelSwapRequest(BaseModel):
+    model_name: str
+    load_in_8bit: bool = False
+    load_in_4bit: bool = False
+    cpu_int8: bool = False
+
+# 模擬的模型狀態（hot_swap 與 AIService.get_model_info()["hot_swap"] 格式相同）
+mock_model: Dict[str, Any] = {
+    "model_name": "mock-deepseek-coder",
+    "hot_swap": {"state": "idle", "swaps": 0}
+}
+
+async def mock_hot_swap(request: ModelSwapRequest):
+    """模擬背景載入、預熱、切換與排空舊模型"""
+    status = mock_model["hot_swap"]
+    await asyncio.sleep(2.0)
+    status.update(state="draining", load_seconds=2.0, switched_at=time.time())
+    mock_model["model_name"] = request.model_name
+    await asyncio.sleep(0.5)
+    status.update(state="completed", swaps=status["swaps"] + 1, drain_seconds=0.5, completed_at=time.time())
+    logger.info(f"模擬模型熱切換完成: {request.model_name}")
+
+# 模擬的工作階段（工作階段 ID -> 已完成輪數）
+chat_sessions: Dict[str, int] = {}
+
+# 模擬推論後端（延遲分布可由環境變數或 /api/mock/backend 設定）
+mock_backend = MockBackend(
+    os.environ.get("MOCK_BACKEND", "default"),
+    float(os.environ.get("MOCK_ERROR_RATE", "0"))
+)
+
+# 模擬伺服器沒有嵌入模型，以詞彙重疊評分
+context_compressor = ContextCompressor()
+
+def next_turn(session_id: Optional[str]) -> Optional[int]:
+    """記錄工作階段的新一輪並回傳輪次"""
+    if session_id is None:
+        return None
+    chat_sessions[session_id] = chat_sessions.get(session_id, 0) + 1
+    return chat_sessions[session_id]
 
 # 模擬的 AI 回應
 def generate_mock_response(message: str, context: Optional[str] = None) -> str:
@@ -102,6 +252,143 @@ if (result)
     else:
         return f"我理解您的需求：{message}。這是一個模擬回應，實際的 AI 模型將提供更詳細的 Tekla API 代碼和說明。"
 
+async def stream_mock_response(text: str) -> AsyncIterator[str]:
+    """模擬逐 token 串流輸出（間隔依模擬後端的 token 分布）"""
+    for piece in re.findall(r"\s*\S+|\s+$", text):
+        await mock_backend.delay("token")
+        yield piece
+
+def mock_tokens(text: str) -> int:
+    """模擬的 token 數（以串流片段計）"""
+    return len(re.findall(r"\s*\S+|\s+$", text))
+
+async def stream_with_telemetry(
+    chunks: AsyncIterator[str],
+    telemetry: GenerationTelemetry,
+    done: Dict[str, Any],
+    include_metrics: bool
+) -> AsyncIterator[str]:
+    """記錄串流的首 token 與解碼時間，完整結束時寫入指標（並附在 done 事件中）"""
+    telemetry.start()
+    count = 0
+    try:
+        async for chunk in chunks:
+            telemetry.first_token()
+            count += 1
+            yield chunk
+    finally:
+        await chunks.aclose()
+    telemetry.finish(count, peak_memory_bytes())
+    telemetry.observe("mock")
+    if include_metrics:
+        done["metrics"] = telemetry.to_dict()
+
+# 合併進行中的相同請求（與 AIService 相同：只合併低溫度、不屬於工作階段的請求）
+COALESCE_MAX_TEMPERATURE = float(os.environ.get("COALESCE_MAX_TEMPERATURE", "0.3"))
+single_flight = SingleFlight("mock")
+
+def coalesce_key(endpoint: str, request: BaseModel, stream: bool = False) -> Optional[str]:
+    """可合併請求的鍵，不可合併時回傳 None（Tekla 命令固定以低溫度生成）"""
+    data = request.model_dump()
+    if data.get("session_id") is not None or data.get("temperature", 0.0) > COALESCE_MAX_TEMPERATURE:
+        return None
+    if stream:
+        # 串流只共用生成的文字，指標由各請求自行記錄
+        data.pop("include_metrics", None)
+    return flight_key(endpoint, mock_model["model_name"], data)
+
+async def run_admitted(
+    endpoint: str,
+    request: BaseModel,
+    run: Callable[[Any], Awaitable[Dict[str, Any]]],
+    priority: str
+) -> Dict[str, Any]:
+    """准入後執行 run(request)；相同的進行中請求共用結果，只有實際執行的請求佔用名額"""
+    async def admitted() -> Dict[str, Any]:
+        async with await admission.acquire(endpoint, priority):
+            return await run(request)
+
+    key = coalesce_key(endpoint, request)
+    if key is None:
+        return await admitted()
+    return await single_flight.do(key, admitted)
+
+STREAM_ADMITTED = object()  # 共用來源取得准入名額後送出的第一個片段
+
+async def admitted_stream(
+    endpoint: str,
+    request: BaseModel,
+    text: str,
+    priority: str
+) -> Tuple[AsyncIterator[str], Optional[Admission]]:
+    """准入後開始模擬生成串流；相同的進行中串流共用同一個來源，只有實際生成的串流佔用名額
+
+    不可合併的串流回傳取得的名額，由呼叫端在串流結束後歸還；
+    可合併的串流由共用來源在生成期間佔用名額，加入的請求等到來源准入後才開始回應。
+    """
+    key = coalesce_key(endpoint, request, stream=True)
+    if key is None:
+        admitted = await admission.acquire(endpoint, priority)
+        return stream_mock_response(text), admitted
+
+    async def source() -> AsyncIterator[Any]:
+        async with await admission.acquire(endpoint, priority):
+            yield STREAM_ADMITTED
+            async for chunk in stream_mock_response(text):
+                yield chunk
+
+    chunks = single_flight.stream(key, source)
+    try:
+        # 來源未准入時在回應開始前拋出 AdmissionRejected（429，所有加入的請求相同）
+        await chunks.__anext__()
+    except BaseException:
+        await chunks.aclose()
+        raise
+    return chunks, None
+
+def sse_event(data: Dict[str, Any]) -> str:
+    """格式化 Server-Sent Events 事件"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def sse_stream(
+    request: Request,
+    chunks: AsyncIterator[str],
+    done: Dict[str, Any]
+) -> AsyncIterator[str]:
+    """將文字串流轉為 SSE 事件，客戶端斷線時停止生成"""
+    try:
+        async for chunk in chunks:
+            if await request.is_disconnected():
+                logger.info("客戶端已斷線，停止生成")
+                break
+            yield sse_event({"type": "token", "text": chunk})
+        else:
+            yield sse_event({"type": "done", **done})
+    except Exception as e:
+        logger.error(f"串流生成錯誤: {e}")
+        yield sse_event({"type": "error", "message": str(e)})
+    finally:
+        # 關閉生成器以取消背景生成
+        await chunks.aclose()
+
+def sse_response(events: AsyncIterator[str], admitted: Optional[Admission] = None) -> StreamingResponse:
+    """建立 SSE 回應；傳入准入名額時於串流結束（含客戶端斷線）後歸還"""
+    if admitted is not None:
+        events = release_on_close(events, admitted)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def release_on_close(events: AsyncIterator[str], admitted: Admission) -> AsyncIterator[str]:
+    """串流結束時歸還准入名額"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        admitted.release()
+
 # 健康檢查端點
 @app.get("/health")
 async def health_check():
@@ -119,137 +406,620 @@ async def health_check():
     }
 
 # AI 聊天端點
+async def run_chat(request: ChatRequest) -> Dict[str, Any]:
+    """模擬聊天回應"""
+    telemetry = GenerationTelemetry(mock_tokens(request.message))
+    telemetry.start()
+    
+    # 模擬處理時間
+    await mock_backend.delay("chat")
+    
+    # 生成回應
+    response = generate_mock_response(request.message, request.context)
+    telemetry.finish(mock_tokens(response), peak_memory_bytes())
+    telemetry.observe("mock")
+    
+    result = {
+        "response": response,
+        "context_used": bool(request.context),
+        "rag_enabled": request.use_rag,
+        "model": mock_model["model_name"],
+        "session_id": request.session_id,
+        "turn": next_turn(request.session_id),
+        "timestamp": asyncio.get_event_loop().time()
+    }
+    if request.include_metrics:
+        result["metrics"] = telemetry.to_dict()
+    return result
+
 @app.post("/api/chat")
-async def chat(request: ChatRequest):
-    """AI 聊天端點"""
+async def chat(request: ChatRequest, http_request: Request):
+    """AI 聊天端點（低溫度的相同請求合併處理，預設為互動優先）"""
+    priority = request_priority(http_request, "interactive")
     try:
         logger.info(f"收到聊天請求: {request.message}")
+        return await run_admitted("chat", request, run_chat, priority)
         
-        # 模擬處理時間
-        await asyncio.sleep(0.5)
-        
-        # 生成回應
-        response = generate_mock_response(request.message, request.context)
-        
-        return {
-            "response": response,
-            "context_used": bool(request.context),
-            "rag_enabled": request.use_rag,
-            "model": "mock-deepseek-coder",
-            "timestamp": asyncio.get_event_loop().time()
-        }
-        
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"聊天處理錯誤: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# AI 聊天串流端點 (SSE)
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """AI 聊天串流端點（實際生成的串流在生成期間佔用准入名額）"""
+    logger.info(f"收到聊天串流請求: {request.message}")
+    priority = request_priority(http_request, "interactive")
+    
+    response = generate_mock_response(request.message, request.context)
+    stream, admitted = await admitted_stream("chat", request, response, priority)
+    done = {
+        "context_used": bool(request.context),
+        "rag_enabled": request.use_rag,
+        "model": mock_model["model_name"],
+        "session_id": request.session_id,
+        "turn": next_turn(request.session_id)
+    }
+    chunks = stream_with_telemetry(
+        stream,
+        GenerationTelemetry(mock_tokens(request.message)),
+        done,
+        request.include_metrics
+    )
+    return sse_response(sse_stream(http_request, chunks, done), admitted)
+
+# 結束聊天工作階段
+@app.delete("/api/chat/sessions/{session_id}")
+async def end_chat_session(session_id: str):
+    """結束工作階段並釋放其對話快取"""
+    if chat_sessions.pop(session_id, None) is None:
+        raise HTTPException(status_code=404, detail=f"工作階段不存在: {session_id}")
+    return {"session_id": session_id, "ended": True}
+
+# 模擬的 Tekla API 文檔（結構與 TeklaKnowledgeBase 的 tekla_api_docs.json 相同）
+MOCK_API_DOCS = {
+    "Tekla.Structures.Model": {
+        "description": "Tekla Structures 3D 模型操作核心 API",
+        "classes": {
+            "Model": {
+                "description": "表示 Tekla Structures 模型的主要類別",
+                "methods": {
+                    "GetConnectionHandler": "獲取連接處理器",
+                    "CommitChanges": "提交模型變更",
+                    "GetModelInfo": "獲取模型資訊"
+                }
+            },
+            "Beam": {
+                "description": "表示樑構件",
+                "properties": {
+                    "StartPoint": "起點座標",
+                    "EndPoint": "終點座標",
+                    "Profile": "斷面規格"
+                },
+                "methods": {
+                    "Insert": "插入到模型",
+                    "Modify": "修改構件"
+                }
+            }
+        }
+    },
+    "Tekla.Structures.Drawing": {
+        "description": "Tekla Structures 圖紙操作 API",
+        "classes": {
+            "DrawingHandler": {
+                "description": "圖紙處理器",
+                "methods": {
+                    "GetDrawings": "獲取圖紙清單",
+                    "SaveActiveDrawing": "儲存目前圖紙"
+                }
+            }
+        }
+    }
+}
+
+def mock_api_documents(api_docs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """將 API 文檔轉為知識庫文檔（命名空間與類別各一份）"""
+    documents = []
+    for namespace, namespace_data in api_docs.items():
+        documents.append({
+            "id": f"namespace_{namespace}",
+            "type": "namespace",
+            "namespace": namespace,
+            "title": namespace,
+            "content": namespace_data.get("description", ""),
+            "metadata": {"source": "api_docs"}
+        })
+        for class_name, class_data in namespace_data.get("classes", {}).items():
+            lines = [class_data.get("description", "")]
+            for section, key in (("屬性", "properties"), ("方法", "methods")):
+                if key in class_data:
+                    lines.append(f"{section}:")
+                    lines.extend(f"- {name}: {desc}" for name, desc in class_data[key].items())
+            documents.append({
+                "id": f"class_{namespace}_{class_name}",
+                "type": "class",
+                "namespace": namespace,
+                "class_name": class_name,
+                "title": f"{namespace}.{class_name}",
+                "content": "\n".join(lines),
+                "metadata": {"source": "api_docs"}
+            })
+    return documents
+
+def shared_index_contents() -> Dict[str, Any]:
+    """共用索引的內容（模擬文檔、中繼資料與 API 符號）及其雜湊"""
+    documents = mock_api_documents(MOCK_API_DOCS)
+    metadatas = [
+        {key: doc[key] for key in ("type", "title", "namespace", "class_name") if key in doc}
+        for doc in documents
+    ]
+    symbols = ApiSymbolIndex.from_api_docs(MOCK_API_DOCS).symbols
+    payload = json.dumps([documents, metadatas, symbols], sort_keys=True, ensure_ascii=False, default=str)
+    return {
+        "documents": documents,
+        "metadatas": metadatas,
+        "symbols": symbols,
+        "source_hash": hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    }
+
+def open_shared_index(directory: str, build: bool = True) -> Optional[SharedIndex]:
+    """以記憶體映射開啟共用索引
+
+    索引不存在、版本或內容雜湊與目前的模擬文檔不符時，build 為 True 則重建，
+    否則（多工作程序模式的工作程序）不開啟，RAG 查詢只使用模擬結果。
+    """
+    contents = shared_index_contents()
+    try:
+        if os.path.exists(os.path.join(directory, MANIFEST)):
+            try:
+                index = SharedIndex(directory)
+            except RuntimeError:
+                index = None
+            if index is not None and index.manifest.get("source_hash") == contents["source_hash"]:
+                return index
+        if not build:
+            logger.warning(f"共用索引不存在或已過期，RAG 查詢只使用模擬結果: {directory}")
+            return None
+        write_shared_index(directory, **contents)
+        return SharedIndex(directory)
+    except (OSError, RuntimeError, ValueError) as e:
+        logger.warning(f"無法開啟共用索引，RAG 查詢只使用模擬結果: {e}")
+        return None
+
+shared_index: Optional[SharedIndex] = None
+
+def symbol_results(query: str, top_k: int) -> List[Dict[str, Any]]:
+    """以共用索引的 API 符號解析查詢（與 RAGService 的符號快速路徑相同）"""
+    if shared_index is None:
+        return []
+    exact_match = True
+    symbols = shared_index.lookup_symbol(query)
+    if not symbols:
+        exact_match = False
+        symbols = shared_index.resolve_symbols(query)
+    
+    results = []
+    seen_docs = set()
+    for symbol in symbols:
+        doc = shared_index.get_document(symbol["doc_id"])
+        if doc is None or doc["id"] in seen_docs:
+            continue
+        seen_docs.add(doc["id"])
+        results.append({
+            "content": doc["content"],
+            "score": 1.0,
+            "source": doc["metadata"]["source"],
+            "type": doc["type"],
+            "title": doc["title"],
+            "metadata": {"symbol": symbol["name"], "symbol_kind": symbol["kind"], "exact_match": exact_match}
+        })
+        if len(results) >= top_k:
+            break
+    return results
+
+def run_rag_query(request: RAGQueryRequest) -> Dict[str, Any]:
+    """模擬 RAG 查詢（HTTP 與 WebSocket 共用），引用 API 符號時先回傳共用索引中的文檔"""
+    mock_results = [
+        {
+            "content": f"Tekla Structures API 文檔：關於 {request.query} 的說明...",
+            "score": 0.95,
+            "source": "tekla_api_docs",
+            "type": "documentation"
+        },
+        {
+            "content": f"範例代碼：如何使用 {request.query} 功能...",
+            "score": 0.87,
+            "source": "code_examples",
+            "type": "example"
+        }
+    ]
+    
+    results = (symbol_results(request.query, request.top_k) + mock_results)[:request.top_k]
+    response = {"query": request.query}
+    if request.compress:
+        results, response["compression"] = context_compressor.compress(request.query, results)
+    
+    response.update({"results": results, "count": len(results)})
+    return response
+
 # RAG 查詢端點
 @app.post("/api/rag/query")
-async def rag_query(request: RAGQueryRequest):
+async def rag_query(request: RAGQueryRequest, http_request: Request):
     """RAG 知識查詢端點"""
+    priority = request_priority(http_request, "normal")
     try:
         logger.info(f"收到 RAG 查詢: {request.query}")
+        async with await admission.acquire("rag", priority):
+            await mock_backend.delay("rag")
+            return run_rag_query(request)
         
-        # 模擬 RAG 結果
-        mock_results = [
-            {
-                "content": f"Tekla Structures API 文檔：關於 {request.query} 的說明...",
-                "score": 0.95,
-                "source": "tekla_api_docs",
-                "type": "documentation"
-            },
-            {
-                "content": f"範例代碼：如何使用 {request.query} 功能...",
-                "score": 0.87,
-                "source": "code_examples",
-                "type": "example"
-            }
-        ]
-        
-        return {
-            "query": request.query,
-            "results": mock_results[:request.top_k],
-            "count": len(mock_results[:request.top_k])
-        }
-        
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"RAG 查詢錯誤: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Tekla 命令端點
+async def run_tekla_command(request: TeklaCommandRequest) -> Dict[str, Any]:
+    """模擬 Tekla 命令處理（單一請求與批次共用）"""
+    telemetry = GenerationTelemetry(mock_tokens(request.command))
+    telemetry.start()
+    
+    # 模擬處理時間
+    await mock_backend.delay("tekla")
+    
+    # 生成 Tekla 代碼
+    generated_code = trim_code_output(
+        generate_mock_response(request.command, request.context),
+        **default_stop_options(code_only=request.code_only)
+    )
+    telemetry.finish(mock_tokens(generated_code), peak_memory_bytes())
+    telemetry.observe("mock")
+    
+    result = {
+        "command": request.command,
+        "parameters": request.parameters,
+        "generated_code": generated_code,
+        "context_used": bool(request.context),
+        "model": mock_model["model_name"],
+        "timestamp": asyncio.get_event_loop().time()
+    }
+    if request.include_metrics:
+        result["metrics"] = telemetry.to_dict()
+    return result
+
 @app.post("/api/tekla/command")
-async def tekla_command(request: TeklaCommandRequest):
-    """Tekla 命令處理端點"""
+async def tekla_command(request: TeklaCommandRequest, http_request: Request):
+    """Tekla 命令處理端點（相同的進行中命令合併處理）"""
+    priority = request_priority(http_request, "normal")
     try:
         logger.info(f"收到 Tekla 命令: {request.command}")
+        return await run_admitted("tekla", request, run_tekla_command, priority)
         
-        # 模擬處理時間
-        await asyncio.sleep(1.0)
-        
-        # 生成 Tekla 代碼
-        generated_code = generate_mock_response(request.command, request.context)
-        
-        return {
-            "command": request.command,
-            "parameters": request.parameters,
-            "generated_code": generated_code,
-            "context_used": bool(request.context),
-            "model": "mock-deepseek-coder",
-            "timestamp": asyncio.get_event_loop().time()
-        }
-        
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Tekla 命令處理錯誤: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Tekla 命令串流端點 (SSE)
+@app.post("/api/tekla/command/stream")
+async def tekla_command_stream(request: TeklaCommandRequest, http_request: Request):
+    """Tekla 命令串流端點（實際生成的串流在生成期間佔用准入名額）"""
+    logger.info(f"收到 Tekla 命令串流請求: {request.command}")
+    priority = request_priority(http_request, "normal")
+    
+    generated_code = trim_code_output(
+        generate_mock_response(request.command, request.context),
+        **default_stop_options(code_only=request.code_only)
+    )
+    stream, admitted = await admitted_stream("tekla", request, generated_code, priority)
+    done = {
+        "command": request.command,
+        "parameters": request.parameters,
+        "context_used": bool(request.context),
+        "model": mock_model["model_name"]
+    }
+    chunks = stream_with_telemetry(
+        stream,
+        GenerationTelemetry(mock_tokens(request.command)),
+        done,
+        request.include_metrics
+    )
+    return sse_response(sse_stream(http_request, chunks, done), admitted)
+
+# 批次端點：結果依完成順序以 NDJSON 逐行回傳
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", "1000"))
+RAG_BATCH_SIZE = 32  # 每批查詢一次編碼與搜尋（與 RAGService.iter_query_batch 相同）
+GENERATION_BATCH_SIZE = 8  # 同時生成的命令數（對應 AIService 的批次排程器大小）
+
+def ndjson_line(data: Dict[str, Any]) -> str:
+    """格式化 NDJSON 的一行"""
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+async def ndjson_stream(
+    request: Request,
+    items: AsyncIterator[Dict[str, Any]],
+    count: int
+) -> AsyncIterator[str]:
+    """逐項輸出批次結果，最後一行為摘要；客戶端斷線時停止處理"""
+    started = time.perf_counter()
+    errors = 0
+    try:
+        async for item in items:
+            if await request.is_disconnected():
+                logger.info("客戶端已斷線，停止批次處理")
+                break
+            errors += item["status"] == "error"
+            yield ndjson_line(item)
+        else:
+            yield ndjson_line({
+                "done": True,
+                "count": count,
+                "errors": errors,
+                "elapsed_seconds": round(time.perf_counter() - started, 4)
+            })
+    finally:
+        await items.aclose()
+
+def check_batch_size(count: int):
+    """批次數量上限"""
+    if count > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"批次最多 {MAX_BATCH_ITEMS} 項，收到 {count} 項")
+
+async def rag_batch_items(queries: List[RAGQueryRequest]) -> AsyncIterator[Dict[str, Any]]:
+    """模擬批次查詢：每批一次編碼與搜尋，完成一批即輸出該批結果"""
+    for start in range(0, len(queries), RAG_BATCH_SIZE):
+        batch = queries[start:start + RAG_BATCH_SIZE]
+        try:
+            async with await admission.acquire("rag", "batch"):
+                await mock_backend.delay("rag")
+        except Exception as e:
+            for offset in range(len(batch)):
+                yield {"index": start + offset, "status": "error", "error": str(e)}
+            continue
+        for offset, query in enumerate(batch):
+            yield {"index": start + offset, "status": "ok", "result": run_rag_query(query)}
+
+async def tekla_batch_items(commands: List[TeklaCommandRequest]) -> AsyncIterator[Dict[str, Any]]:
+    """模擬批次生成：同時處理 GENERATION_BATCH_SIZE 個命令，依完成順序輸出"""
+    semaphore = asyncio.Semaphore(GENERATION_BATCH_SIZE)
+
+    async def run(index: int, command: TeklaCommandRequest) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                return {"index": index, "status": "ok", "result": await run_admitted("tekla", command, run_tekla_command, "batch")}
+            except Exception as e:
+                return {"index": index, "status": "error", "error": str(e)}
+
+    tasks = [asyncio.ensure_future(run(index, command)) for index, command in enumerate(commands)]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.post("/api/rag/query/batch")
+async def rag_query_batch(request: RAGBatchRequest, http_request: Request):
+    """批次 RAG 查詢（NDJSON：每行 {"index", "status", "result"}，最後一行為摘要）"""
+    check_batch_size(len(request.queries))
+    logger.info(f"收到批次 RAG 查詢: {len(request.queries)} 項")
+    return StreamingResponse(
+        ndjson_stream(http_request, rag_batch_items(request.queries), len(request.queries)),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/api/tekla/command/batch")
+async def tekla_command_batch(request: TeklaCommandBatchRequest, http_request: Request):
+    """批次 Tekla 命令（NDJSON，依完成順序回傳，每行帶原始索引）"""
+    check_batch_size(len(request.commands))
+    logger.info(f"收到批次 Tekla 命令: {len(request.commands)} 項")
+    return StreamingResponse(
+        ndjson_stream(http_request, tekla_batch_items(request.commands), len(request.commands)),
+        media_type="application/x-ndjson"
+    )
+
+def mock_gpu_status() -> Dict[str, Any]:
+    """模擬的 GPU 與系統資源狀態（使用率隨機波動）"""
+    return {
+        "available": True,
+        "count": 4,
+        "gpus": [
+            {
+                "id": i,
+                "name": f"RTX 5090 #{i+1}",
+                "memory_total": 34359738368,  # 32GB
+                "memory_used": 8589934592,   # 8GB
+                "memory_free": 25769803776,  # 24GB
+                "memory_util_percent": 25,
+                "gpu_util_percent": 45 + i * 10 + random.randint(-5, 5),
+                "temperature": 65 + i * 2
+            }
+            for i in range(4)
+        ],
+        "cpu": {
+            "usage_percent": round(35.5 + random.uniform(-5, 5), 1),
+            "count": 32
+        },
+        "memory": {
+            "total": 137438953472,  # 128GB
+            "used": 68719476736,   # 64GB
+            "available": 68719476736,  # 64GB
+            "percent": 50.0
+        }
+    }
+
 # GPU 狀態端點
 @app.get("/api/gpu/status")
 async def gpu_status():
     """GPU 狀態查詢端點"""
     try:
-        # 模擬 GPU 狀態
-        mock_gpu_status = {
-            "available": True,
-            "count": 4,
-            "gpus": [
-                {
-                    "id": i,
-                    "name": f"RTX 5090 #{i+1}",
-                    "memory_total": 34359738368,  # 32GB
-                    "memory_used": 8589934592,   # 8GB
-                    "memory_free": 25769803776,  # 24GB
-                    "memory_util_percent": 25,
-                    "gpu_util_percent": 45 + i * 10,
-                    "temperature": 65 + i * 2
-                }
-                for i in range(4)
-            ],
-            "cpu": {
-                "usage_percent": 35.5,
-                "count": 32
-            },
-            "memory": {
-                "total": 137438953472,  # 128GB
-                "used": 68719476736,   # 64GB
-                "available": 68719476736,  # 64GB
-                "percent": 50.0
-            }
-        }
-        
-        return mock_gpu_status
+        return mock_gpu_status()
         
     except Exception as e:
         logger.error(f"GPU 狀態查詢錯誤: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# WebSocket 端點 (簡化版)
+# 准入控制統計端點
+@app.get("/api/admission")
+async def admission_stats():
+    """准入控制的並行數、佇列深度與排隊時間"""
+    return admission.get_stats()
+
+@app.get("/api/workers")
+async def worker_info():
+    """目前工作程序與共用索引資訊（工作階段、合併與准入狀態為每個工作程序各自保存）"""
+    return {
+        "pid": os.getpid(),
+        "workers": SERVER_WORKERS,
+        "shared_index": shared_index.get_stats() if shared_index is not None else None
+    }
+
+@app.get("/api/coalescing")
+async def coalescing_stats():
+    """進行中請求合併的統計"""
+    return {"max_temperature": COALESCE_MAX_TEMPERATURE, **single_flight.get_stats()}
+
+# 模型資訊端點
+@app.get("/api/model/info")
+async def model_info():
+    """模型資訊與熱切換進度"""
+    return {**mock_model, "status": "ready"}
+
+# 模型熱切換端點
+@app.post("/api/model/swap", status_code=202)
+async def model_swap(request: ModelSwapRequest):
+    """在背景載入新模型，完成後不中斷服務地切換"""
+    if mock_model["hot_swap"]["state"] in ("loading", "draining"):
+        raise HTTPException(status_code=409, detail="已有模型切換正在進行")
+
+    mock_model["hot_swap"] = {
+        "state": "loading",
+        "swaps": mock_model["hot_swap"]["swaps"],
+        "from_model": mock_model["model_name"],
+        "to_model": request.model_name,
+        "overrides": request.model_dump(exclude={"model_name"}),
+        "started_at": time.time(),
+        "load_seconds": None,
+        "drain_seconds": None,
+        "error": None
+    }
+    asyncio.create_task(mock_hot_swap(request))
+    return mock_model["hot_swap"]
+
+# 啟動時間報告端點
+@app.get("/api/startup")
+async def startup_report():
+    """啟動階段耗時報告"""
+    return startup_timer.report()
+
+# Prometheus 指標端點
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指標（生成延遲、token 數與記憶體直方圖）"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# 模擬後端設定
+@app.get("/api/mock/backend")
+async def get_mock_backend():
+    """目前的模擬後端設定與各端點的模擬延遲統計"""
+    return {**mock_backend.get_config(), "stats": mock_backend.get_stats()}
+
+@app.put("/api/mock/backend")
+async def set_mock_backend(request: MockBackendRequest):
+    """切換模擬後端（例如負載測試前改為 zero 以量測框架開銷）"""
+    global mock_backend
+    try:
+        mock_backend = MockBackend(request.backend, request.error_rate, request.seed)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"模擬後端已切換: {request.backend}")
+    return mock_backend.get_config()
+
+# WebSocket：聊天串流、RAG 查詢與狀態推送共用一條連線
+ws_hub = WebSocketHub(
+    max_pending=int(os.environ.get("WS_MAX_PENDING", "256")),
+    send_timeout=float(os.environ.get("WS_SEND_TIMEOUT", "30"))
+)
+server_started_at = time.time()
+
+async def ws_chat(connection, message: Dict[str, Any]):
+    """WebSocket 聊天：逐 token 推送 chat_response（event=token），完成時推送 event=done（預設為互動優先）"""
+    request = ChatRequest.model_validate(message)
+    priority = parse_priority(message.get("priority"), "interactive")
+    response = generate_mock_response(request.message, request.context)
+    stream, admitted = await admitted_stream("chat", request, response, priority)
+    done = {
+        "context_used": bool(request.context),
+        "rag_enabled": request.use_rag,
+        "model": mock_model["model_name"],
+        "session_id": request.session_id,
+        "turn": next_turn(request.session_id)
+    }
+    chunks = stream_with_telemetry(
+        stream,
+        GenerationTelemetry(mock_tokens(request.message)),
+        done,
+        request.include_metrics
+    )
+    try:
+        async for chunk in chunks:
+            await connection.send({"type": "chat_response", "id": message["id"], "event": "token", "text": chunk})
+    finally:
+        await chunks.aclose()
+        if admitted is not None:
+            admitted.release()
+    await connection.send({"type": "chat_response", "id": message["id"], "event": "done", "response": response, **done})
+
+async def ws_rag_query(connection, message: Dict[str, Any]):
+    """WebSocket RAG 查詢：推送 rag_results"""
+    request = RAGQueryRequest.model_validate(message)
+    async with await admission.acquire("rag", parse_priority(message.get("priority"), "interactive")):
+        await mock_backend.delay("rag")
+        result = run_rag_query(request)
+    await connection.send({"type": "rag_results", "id": message["id"], **result})
+
+async def gpu_status_snapshot() -> Dict[str, Any]:
+    """GPU 狀態快照"""
+    return mock_gpu_status()
+
+async def system_status_snapshot() -> Dict[str, Any]:
+    """系統狀態（模型、熱切換、工作階段與連線數）"""
+    return {
+        "status": "running",
+        "uptime_seconds": int(time.time() - server_started_at),
+        "model": mock_model["model_name"],
+        "hot_swap": mock_model["hot_swap"]["state"],
+        "mock_backend": mock_backend.name,
+        "chat_sessions": len(chat_sessions),
+        "websocket_connections": len(ws_hub.connections)
+    }
+
+ws_hub.register("chat", ws_chat)
+ws_hub.register("rag_query", ws_rag_query)
+status_interval = float(os.environ.get("WS_STATUS_INTERVAL", "2"))
+ws_hub.add_status_channel("gpu_status", gpu_status_snapshot, status_interval)
+ws_hub.add_status_channel("system_status", system_status_snapshot, status_interval)
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """WebSocket 多工端點"""
+    await ws_hub.serve(websocket)
+
+# WebSocket 資訊端點
 @app.get("/ws")
 async def websocket_info():
-    """WebSocket 資訊端點"""
+    """WebSocket 協定說明與連線統計"""
     return {
         "message": "WebSocket 端點可用",
         "url": "ws://localhost:8000/ws",
-        "status": "available"
+        "status": "available",
+        "requests": ["ping", "subscribe", "unsubscribe", "chat", "rag_query", "cancel"],
+        "channels": ws_hub.channels,
+        "stats": ws_hub.get_stats()
     }
 
 # 根端點
@@ -263,19 +1033,52 @@ async def root():
         "endpoints": {
             "health": "/health",
             "chat": "/api/chat",
+            "chat_stream": "/api/chat/stream",
+            "chat_sessions": "/api/chat/sessions/{session_id}",
             "rag": "/api/rag/query",
+            "rag_batch": "/api/rag/query/batch",
             "tekla": "/api/tekla/command",
-            "gpu": "/api/gpu/status"
+            "tekla_stream": "/api/tekla/command/stream",
+            "tekla_batch": "/api/tekla/command/batch",
+            "gpu": "/api/gpu/status",
+            "startup": "/api/startup",
+            "admission": "/api/admission",
+            "coalescing": "/api/coalescing",
+            "workers": "/api/workers",
+            "model_info": "/api/model/info",
+            "model_swap": "/api/model/swap",
+            "mock_backend": "/api/mock/backend",
+            "metrics": "/metrics"
         }
     }
 
-if __name__ == "__main__":
-    logger.info("🚀 啟動 MCP Tekla+ 簡化伺服器...")
+def main():
+    """啟動伺服器
+
+    --workers 大於 1 時為預先分叉的多工作程序模式：父程序先建立（或確認）一次共用索引，
+    各工作程序以記憶體映射開啟（不各自建立文檔與符號索引），准入限制依工作程序數平分。
+    """
+    parser = argparse.ArgumentParser(description="MCP Tekla+ 簡化伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="工作程序數")
+    args = parser.parse_args()
+    
+    logger.info(f"🚀 啟動 MCP Tekla+ 簡化伺服器（{args.workers} 個工作程序）...")
+    
+    # 工作程序以 spawn 啟動並繼承環境變數
+    os.environ["SERVER_WORKERS"] = str(args.workers)
+    os.environ["SHARED_INDEX_DIR"] = SHARED_INDEX_DIR
+    open_shared_index(SHARED_INDEX_DIR)
     
     uvicorn.run(
         "simple_server:app",
-        host="127.0.0.1",
-        port=8001,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
         reload=False,
         log_level="info"
     )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+"""
+測試設定：以 server 目錄為匯入根目錄（與 simple_server.py 相同）
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
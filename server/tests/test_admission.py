@@ -0,0 +1,123 @@
+"""
+准入控制測試
+"""
+
+import asyncio
+
+import pytest
+
+from services.admission import AdmissionController, AdmissionLimiter, AdmissionRejected
+
+
+async def _settle():
+    """讓排隊中的 task 執行到等待點"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_queue_full_rejects_same_priority():
+    async def scenario():
+        limiter = AdmissionLimiter("test-full", 1, 1, 5)
+        await limiter.acquire("normal")
+        queued = asyncio.ensure_future(limiter.acquire("normal"))
+        await _settle()
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire("normal")
+        assert rejected.value.reason == "queue_full"
+        assert limiter.stats["rejected_full"] == 1
+
+        limiter.release()
+        await queued
+        assert limiter.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_higher_priority_sheds_lowest_waiter():
+    async def scenario():
+        limiter = AdmissionLimiter("test-shed", 1, 1, 5)
+        await limiter.acquire("interactive")
+        batch = asyncio.ensure_future(limiter.acquire("batch"))
+        await _settle()
+
+        interactive = asyncio.ensure_future(limiter.acquire("interactive"))
+        await _settle()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await batch
+        assert rejected.value.reason == "shed"
+        assert limiter.stats["shed"] == 1
+
+        limiter.release()
+        await interactive
+        assert limiter.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_estimate_rejection_does_not_shed_waiter():
+    async def scenario():
+        limiter = AdmissionLimiter("test-estimate", 1, 1, 5)
+        await limiter.acquire("normal")
+        batch = asyncio.ensure_future(limiter.acquire("batch"))
+        await _settle()
+        # 等待者加入後處理時間估計才變長
+        limiter.service_seconds = 6.0
+
+        # 新請求排在最前面仍預估等待 6 秒，超過期限；原本的等待者必須保留
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire("normal")
+        assert rejected.value.reason == "estimated_wait"
+        assert limiter.stats["shed"] == 0
+        assert not batch.done()
+
+        limiter.release()
+        await batch
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_follows_service_time():
+    async def scenario():
+        limiter = AdmissionLimiter("test-retry", 1, 4, 30)
+        assert limiter.retry_after() == 1
+
+        await limiter.acquire("normal")
+        limiter.release(2.5)
+        await limiter.acquire("normal")
+        waiters = [asyncio.ensure_future(limiter.acquire("normal")) for _ in range(4)]
+        await _settle()
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire("normal")
+        # 佇列 4 個請求、每個 2.5 秒：預估 (4 // 1 + 1) * 2.5 = 12.5 秒
+        assert rejected.value.retry_after == 13
+
+        for _ in waiters:
+            limiter.release()
+        await asyncio.gather(*waiters)
+
+    asyncio.run(scenario())
+
+
+def test_controller_releases_earlier_limiters_on_rejection():
+    async def scenario():
+        controller = AdmissionController("t_chat=2:0:5,t_gen=1:0:5", routes={"chat": ("t_chat", "t_gen")})
+        admitted = await controller.acquire("chat")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("chat")
+        assert rejected.value.limiter == "t_gen"
+        assert controller.limiters["t_chat"].active == 1
+
+        admitted.release()
+        admitted.release()
+        assert controller.limiters["t_chat"].active == 0
+        assert controller.limiters["t_gen"].active == 0
+
+    asyncio.run(scenario())
+
+
+def test_limits_split_across_workers():
+    controller = AdmissionController("t_split=8:64:30", routes={}, workers=3)
+    limiter = controller.limiters["t_split"]
+    assert (limiter.max_concurrency, limiter.max_queue) == (3, 22)
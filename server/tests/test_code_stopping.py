@@ -0,0 +1,42 @@
+"""
+代碼停止條件測試
+"""
+
+import pytest
+
+from services.code_stopping import CodeStopScanner
+
+CASES = [
+    ("\n###", {"stop_sequences": ["\n###"]}),
+    ("說明\n###\n多餘", {"stop_sequences": ["\n###"]}),
+    ("以下是代碼：\n```csharp\nvar m = new Model();\nm.CommitChanges();\n```\n說明文字\n", {"code_only": True}),
+    ("```csharp\nclass A\n{\n    void F() { }\n}\n這是說明\n", {"code_only": True}),
+    ("```csharp\nclass A\n{\n}\n\n\n", {"code_only": True}),
+    ("public void Run()\n{\n    Insert();\n}\n接下來說明\n", {}),
+    ("var x = 1;   \n\n  ", {"stop_sequences": ["<|EOT|>", "\n\n\n"]}),
+]
+
+
+@pytest.mark.parametrize("text, options", CASES)
+def test_streamed_output_is_prefix_of_final(text, options):
+    scanner = CodeStopScanner(**options)
+    outputs = []
+    for char in text:
+        scanner.feed(char)
+        outputs.append(scanner.output())
+    scanner.finish()
+    final = scanner.output(final=True)
+
+    for previous, current in zip(outputs, outputs[1:]):
+        assert current.startswith(previous)
+    for output in outputs:
+        assert final.startswith(output)
+
+
+def test_stop_sequence_prefix_is_not_emitted():
+    scanner = CodeStopScanner(stop_sequences=["\n###"])
+    for char in "\n###":
+        scanner.feed(char)
+        assert "#" not in scanner.output()
+    assert scanner.stopped
+    assert scanner.output(final=True) == ""
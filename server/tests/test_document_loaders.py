@@ -0,0 +1,47 @@
+"""
+文檔載入器測試
+"""
+
+import pytest
+
+from services.document_loaders import _extract_docx_pages
+
+docx = pytest.importorskip("docx")
+
+
+def _rendered_page_break(paragraph):
+    """加入 Word 記錄的自然分頁位置"""
+    from docx.oxml import OxmlElement
+
+    paragraph.add_run()._r.append(OxmlElement("w:lastRenderedPageBreak"))
+
+
+def test_docx_pages_split_at_break_and_keep_numbers(tmp_path):
+    from docx.enum.text import WD_BREAK
+
+    document = docx.Document()
+    document.add_paragraph("第一頁內容")
+    paragraph = document.add_paragraph()
+    paragraph.add_run("分頁前文字")
+    paragraph.add_run().add_break(WD_BREAK.PAGE)
+    paragraph.add_run("分頁後文字")
+    document.add_page_break()
+    document.add_page_break()  # 第 3 頁為空白頁
+    document.add_paragraph("第四頁")
+    paragraph = document.add_paragraph()
+    _rendered_page_break(paragraph)
+    paragraph.add_run("第五頁")
+    document.add_page_break()
+    paragraph = document.add_paragraph()
+    _rendered_page_break(paragraph)  # 手動分頁後的記錄，不重複計算
+    paragraph.add_run("第六頁")
+    path = tmp_path / "pages.docx"
+    document.save(path)
+
+    assert _extract_docx_pages(str(path)) == [
+        (1, "第一頁內容\n分頁前文字"),
+        (2, "分頁後文字"),
+        (4, "第四頁"),
+        (5, "第五頁"),
+        (6, "第六頁"),
+    ]
@@ -0,0 +1,49 @@
+"""
+共用索引開啟與重建測試
+"""
+
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+import simple_server
+from services.shared_index import MANIFEST
+
+
+def _stale(directory):
+    """把索引標記為由其他內容建立"""
+    manifest_path = directory / MANIFEST
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    manifest["source_hash"] = "stale"
+    manifest_path.write_text(json.dumps(manifest), encoding="utf-8")
+
+
+def test_reuses_current_index(tmp_path):
+    directory = tmp_path / "shared_index"
+    first = simple_server.open_shared_index(str(directory))
+    second = simple_server.open_shared_index(str(directory))
+
+    assert first is not None and second is not None
+    assert second.manifest["created_at"] == first.manifest["created_at"]
+    assert second.lookup_symbol("Beam")
+
+
+def test_rebuilds_stale_index(tmp_path):
+    directory = tmp_path / "shared_index"
+    simple_server.open_shared_index(str(directory))
+    _stale(directory)
+
+    index = simple_server.open_shared_index(str(directory))
+    assert index.manifest["source_hash"] == simple_server.shared_index_contents()["source_hash"]
+
+
+def test_worker_does_not_build_missing_or_stale_index(tmp_path):
+    directory = tmp_path / "shared_index"
+    assert simple_server.open_shared_index(str(directory), build=False) is None
+    assert not directory.exists()
+
+    simple_server.open_shared_index(str(directory))
+    _stale(directory)
+    assert simple_server.open_shared_index(str(directory), build=False) is None
@@ -0,0 +1,170 @@
+"""
+進行中請求合併測試
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+from services.single_flight import SingleFlight, flight_key
+
+
+async def _settle():
+    """讓等待中的 task 執行到等待點"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight = SingleFlight("test-share")
+        release = asyncio.Event()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "結果"
+
+        callers = [asyncio.ensure_future(flight.do("key", compute)) for _ in range(3)]
+        await _settle()
+        release.set()
+
+        assert await asyncio.gather(*callers) == ["結果"] * 3
+        assert calls == 1
+        assert flight.stats["coalesced"] == 2
+        assert flight.get_stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_caller():
+    async def scenario():
+        flight = SingleFlight("test-error")
+        release = asyncio.Event()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            raise ValueError("生成失敗")
+
+        callers = [asyncio.ensure_future(flight.do("key", compute)) for _ in range(2)]
+        await _settle()
+        release.set()
+
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert calls == 1
+        assert all(isinstance(result, ValueError) for result in results)
+        assert results[0] is results[1]
+        assert flight.stats["errors"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_keeps_shared_call_running():
+    async def scenario():
+        flight = SingleFlight("test-cancel")
+        release = asyncio.Event()
+        call_cancelled = False
+
+        async def compute():
+            nonlocal call_cancelled
+            try:
+                await release.wait()
+            except asyncio.CancelledError:
+                call_cancelled = True
+                raise
+            return "結果"
+
+        first = asyncio.ensure_future(flight.do("key", compute))
+        second = asyncio.ensure_future(flight.do("key", compute))
+        await _settle()
+
+        first.cancel()
+        await _settle()
+        assert first.cancelled()
+        assert not call_cancelled
+        assert flight.stats["cancelled"] == 0
+
+        release.set()
+        assert await second == "結果"
+
+    asyncio.run(scenario())
+
+
+def test_last_waiter_leaving_cancels_call():
+    async def scenario():
+        flight = SingleFlight("test-abandon")
+        started = asyncio.Event()
+        call_cancelled = False
+
+        async def compute():
+            nonlocal call_cancelled
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                call_cancelled = True
+                raise
+
+        callers = [asyncio.ensure_future(flight.do("key", compute)) for _ in range(2)]
+        await started.wait()
+        for caller in callers:
+            caller.cancel()
+        await _settle()
+
+        assert call_cancelled
+        assert flight.stats["cancelled"] == 1
+        assert flight.get_stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_late_stream_subscriber_replays_chunks():
+    async def scenario():
+        flight = SingleFlight("test-stream")
+        step = asyncio.Event()
+        calls = 0
+
+        async def source():
+            nonlocal calls
+            calls += 1
+            for chunk in ("甲", "乙", "丙"):
+                await step.wait()
+                step.clear()
+                yield chunk
+
+        async def collect(received):
+            async for chunk in flight.stream("key", source):
+                received.append(chunk)
+
+        early, late = [], []
+        early_task = asyncio.ensure_future(collect(early))
+        await _settle()
+        step.set()
+        await _settle()
+        step.set()
+        await _settle()
+        assert early == ["甲", "乙"]
+
+        late_task = asyncio.ensure_future(collect(late))
+        await _settle()
+        assert late == ["甲", "乙"]
+
+        step.set()
+        await asyncio.gather(early_task, late_task)
+        assert early == late == ["甲", "乙", "丙"]
+        assert calls == 1
+        assert flight.stats["stream_coalesced"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_flight_key_normalizes_text_and_dict_order():
+    assert flight_key("問題  內容", {"a": 1, "b": 2}) == flight_key("問題 內容", {"b": 2, "a": 1})
+    assert flight_key("問題", {"temperature": 0.1}) != flight_key("問題", {"temperature": 0.2})
@@ -0,0 +1,82 @@
+"""
+串流准入測試
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+import simple_server
+from services.admission import AdmissionController, AdmissionRejected
+from services.mock_backend import MockBackend
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """聊天只有一個名額且不排隊的簡化伺服器"""
+    monkeypatch.setattr(simple_server, "admission", AdmissionController("chat=1:0:5,generation=1:0:5"))
+    monkeypatch.setattr(simple_server, "mock_backend", MockBackend("chat=zero,token=const:0.01"))
+    return simple_server
+
+
+async def _collect(stream):
+    return "".join([chunk async for chunk in stream])
+
+
+def test_coalesced_subscribers_share_one_slot(server):
+    async def scenario():
+        request = server.ChatRequest(message="建立一根梁", temperature=0.0)
+        text = server.generate_mock_response(request.message)
+        limiter = server.admission.limiters["chat"]
+
+        first, first_admitted = await server.admitted_stream("chat", request, text, "interactive")
+        second, second_admitted = await server.admitted_stream("chat", request, text, "interactive")
+        assert first_admitted is None and second_admitted is None
+        assert limiter.active == 1
+
+        # 不可合併的請求沒有名額可用
+        with pytest.raises(AdmissionRejected) as rejected:
+            await server.admitted_stream("chat", server.ChatRequest(message="其他", temperature=0.9), text, "interactive")
+        assert rejected.value.reason == "queue_full"
+
+        assert await asyncio.gather(_collect(first), _collect(second)) == [text, text]
+        await asyncio.sleep(0)
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_rejected_source_rejects_every_subscriber(server):
+    async def scenario():
+        limiter = server.admission.limiters["chat"]
+        held = await server.admission.acquire("chat", "interactive")
+        request = server.ChatRequest(message="建立一根梁", temperature=0.0)
+
+        results = await asyncio.gather(
+            server.admitted_stream("chat", request, "文字", "interactive"),
+            server.admitted_stream("chat", request, "文字", "interactive"),
+            return_exceptions=True
+        )
+        assert all(isinstance(result, AdmissionRejected) for result in results)
+        assert limiter.stats["rejected_full"] == 1
+
+        held.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_uncoalesced_stream_returns_slot(server):
+    async def scenario():
+        request = server.ChatRequest(message="建立一根梁", temperature=0.9)
+        limiter = server.admission.limiters["chat"]
+
+        stream, admitted = await server.admitted_stream("chat", request, "a b c", "interactive")
+        assert admitted is not None and limiter.active == 1
+        events = server.sse_response(stream, admitted).body_iterator
+        assert await _collect(events) == "a b c"
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,86 @@
+"""
+文本分割器測試
+預期輸出取自 langchain RecursiveCharacterTextSplitter（相同參數與 DEFAULT_SEPARATORS）
+"""
+
+import pytest
+
+from services.text_splitter import DEFAULT_SEPARATORS, RecursiveTextSplitter
+
+CASES = [
+    (
+        "Beam beam = new Beam();\nbeam.StartPoint = new Point(0, 0, 0);\nbeam.Insert();\n\n"
+        "Model model = new Model();\nmodel.CommitChanges();",
+        40, 10,
+        [
+            "Beam beam = new Beam();",
+            "beam.StartPoint = new Point(0, 0, 0);",
+            "beam.Insert();",
+            "Model model = new Model();",
+            "model.CommitChanges();",
+        ],
+    ),
+    (
+        "Tekla Structures 2025 Open API. The Model class represents the current model! "
+        "Does the profile exist? Use CatalogHandler, then check the name.",
+        30, 8,
+        [
+            "Tekla Structures 2025 Open API",
+            ". The Model class represents",
+            "the current model",
+            "! Does the profile exist",
+            "? Use CatalogHandler",
+            ", then check the name",
+            ".",
+        ],
+    ),
+    (
+        "beam column plate bolt weld profile grid part assembly",
+        20, 10,
+        [
+            "beam column plate",
+            "plate bolt weld",
+            "bolt weld profile",
+            "profile grid part",
+            "grid part assembly",
+        ],
+    ),
+    (
+        "第一段：鋼梁與柱的接合。\n\n第二段：螺栓與焊接的設定, 以及板件的輪廓。\n\n" + "x" * 25,
+        12, 4,
+        [
+            "第一段：鋼梁與柱的接合。",
+            "第二段：螺栓與焊接的設",
+            "焊接的設定",
+            ", 以及板件的輪廓。",
+            "xxxxxxxxxxx",
+            "xxxxxxxxxxxx",
+            "xxxxxxxxxx",
+        ],
+    ),
+    ("   \n\n   ", 10, 0, []),
+    ("", 10, 0, []),
+]
+
+
+@pytest.mark.parametrize("text,chunk_size,chunk_overlap,expected", CASES)
+def test_matches_langchain_output(text, chunk_size, chunk_overlap, expected):
+    splitter = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    assert splitter.split_text(text) == expected
+
+
+@pytest.mark.parametrize("text,chunk_size,chunk_overlap,expected", CASES)
+def test_matches_installed_langchain(text, chunk_size, chunk_overlap, expected):
+    splitters = pytest.importorskip("langchain_text_splitters")
+    reference = splitters.RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=DEFAULT_SEPARATORS
+    )
+    splitter = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    assert splitter.split_text(text) == reference.split_text(text)
+
+
+def test_overlap_larger_than_chunk_size_rejected():
+    with pytest.raises(ValueError):
+        RecursiveTextSplitter(chunk_size=10, chunk_overlap=20)
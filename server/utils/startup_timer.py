@@ -0,0 +1,103 @@
+"""
+啟動時間追蹤工具
+記錄各組件的啟動階段（匯入、模型載入、索引開啟、預熱）耗時
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STARTUP_PHASES = ("import", "model_load", "index_open", "warmup")
+
+
+class StartupTimer:
+    """啟動階段計時器"""
+
+    def __init__(self, budget_seconds: Optional[float] = None):
+        self.budget_seconds = budget_seconds
+        self.started_at = time.perf_counter()
+        self.ready_at: Optional[float] = None
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, phase: str, component: str) -> Iterator[None]:
+        """計時一個啟動階段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, component, time.perf_counter() - start)
+
+    def record(self, phase: str, component: str, seconds: float):
+        """記錄階段耗時"""
+        with self._lock:
+            self.records.append({
+                "phase": phase,
+                "component": component,
+                "seconds": round(seconds, 4)
+            })
+        logger.debug(f"啟動階段 {component}.{phase}: {seconds:.3f}s")
+
+    def mark_ready(self):
+        """標記啟動完成"""
+        self.ready_at = time.perf_counter()
+
+    def report(self) -> Dict[str, Any]:
+        """產生啟動時間報告"""
+        with self._lock:
+            records = list(self.records)
+
+        phases = {name: 0.0 for name in STARTUP_PHASES}
+        for record in records:
+            phases[record["phase"]] = round(phases.get(record["phase"], 0.0) + record["seconds"], 4)
+
+        end = self.ready_at if self.ready_at is not None else time.perf_counter()
+        total = round(end - self.started_at, 4)
+
+        report = {
+            "ready": self.ready_at is not None,
+            "total_seconds": total,
+            "phases": phases,
+            "components": records,
+            "budget_seconds": self.budget_seconds
+        }
+        if self.budget_seconds is not None:
+            report["within_budget"] = total <= self.budget_seconds
+
+        return report
+
+    def log_report(self):
+        """輸出啟動時間報告到日誌"""
+        report = self.report()
+        phases = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in report["phases"].items())
+        logger.info(f"啟動時間 {report['total_seconds']:.3f}s ({phases})")
+
+        for record in report["components"]:
+            logger.info(f"  {record['component']}.{record['phase']}: {record['seconds']:.3f}s")
+
+        if report.get("within_budget") is False:
+            logger.warning(
+                f"⚠️ 啟動時間 {report['total_seconds']:.3f}s 超過預算 {self.budget_seconds:.3f}s"
+            )
+
+
+def _budget_from_env() -> Optional[float]:
+    """從環境變數讀取啟動預算"""
+    value = os.getenv("MCP_STARTUP_BUDGET_SECONDS")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"無效的 MCP_STARTUP_BUDGET_SECONDS: {value}")
+        return None
+
+
+# 全域計時器，各服務共用
+startup_timer = StartupTimer(budget_seconds=_budget_from_env())
@@ -67,6 +67,23 @@ export interface ApiResponse<T> {
   timestamp?: string;
 }
 
+/**
+ * 套用 JSON Merge Patch（RFC 7386）
+ */
+function mergePatch(target: any, patch: any): any {
+  const result = { ...target };
+  for (const [key, value] of Object.entries(patch)) {
+    if (value === null) {
+      delete result[key];
+    } else if (typeof value === 'object' && !Array.isArray(value) && typeof result[key] === 'object' && result[key] !== null && !Array.isArray(result[key])) {
+      result[key] = mergePatch(result[key], value);
+    } else {
+      result[key] = value;
+    }
+  }
+  return result;
+}
+
 class MCPClientService {
   private baseUrl: string;
   private websocket: WebSocket | null = null;
@@ -75,6 +92,8 @@ class MCPClientService {
   private maxReconnectAttempts = 5;
   private reconnectDelay = 1000;
   private eventListeners: Map<string, Function[]> = new Map();
+  private statusSnapshots: Map<string, any> = new Map();
+  private requestCounter = 0;
 
   constructor() {
     this.baseUrl = import.meta.env.VITE_MCP_SERVER_URL || 'http://localhost:8000';
@@ -99,6 +118,8 @@ class MCPClientService {
         };
         this.reconnectAttempts = 0;
         this.emit('connectionStatusChanged', this.connectionStatus);
+        // 以伺服器推送取代定時輪詢 /api/gpu/status
+        this.sendWebSocketMessage({ type: 'subscribe', channels: ['gpu_status', 'system_status'] });
       };
 
       this.websocket.onmessage = (event) => {
@@ -140,19 +161,44 @@ class MCPClientService {
         this.connectionStatus.lastPing = new Date();
         break;
       case 'chat_response':
+        // event 為 token（串流片段）或 done（完整回應）
         this.emit('chatResponse', data);
         break;
+      case 'rag_results':
+        this.emit('ragResults', data);
+        break;
       case 'gpu_status':
-        this.emit('gpuStatus', data.data);
+        this.emit('gpuStatus', this.applyStatusUpdate('gpu_status', data));
         break;
       case 'system_status':
-        this.emit('systemStatus', data.data);
+        this.emit('systemStatus', this.applyStatusUpdate('system_status', data));
+        break;
+      case 'subscribed':
+      case 'unsubscribed':
+        break;
+      case 'cancelled':
+        this.emit('requestCancelled', data);
+        break;
+      case 'error':
+        console.error('WebSocket 伺服器錯誤:', data.message);
+        this.emit('requestError', data);
         break;
       default:
         console.log('未知的 WebSocket 訊息類型:', data.type);
     }
   }
 
+  /**
+   * 套用狀態推送：full 為完整快照，否則為 JSON Merge Patch 差異
+   */
+  private applyStatusUpdate(channel: string, update: { full: boolean; data: any }) {
+    const snapshot = update.full
+      ? update.data
+      : mergePatch(this.statusSnapshots.get(channel) ?? {}, update.data);
+    this.statusSnapshots.set(channel, snapshot);
+    return snapshot;
+  }
+
   /**
    * 排程重新連接
    */
@@ -321,6 +367,31 @@ class MCPClientService {
     return this.request('/api/gpu/status');
   }
 
+  /**
+   * 透過 WebSocket 串流聊天，回傳請求 id（回應以 chatResponse 事件送達）
+   */
+  streamChat(request: ChatRequest & { sessionId?: string }): string {
+    const id = `chat-${++this.requestCounter}`;
+    this.sendWebSocketMessage({
+      type: 'chat',
+      id,
+      message: request.message,
+      context: request.context,
+      use_rag: request.useRAG ?? true,
+      temperature: request.temperature ?? 0.7,
+      max_tokens: request.maxTokens ?? 2048,
+      session_id: request.sessionId
+    });
+    return id;
+  }
+
+  /**
+   * 取消進行中的 WebSocket 請求
+   */
+  cancelRequest(id: string) {
+    this.sendWebSocketMessage({ type: 'cancel', id });
+  }
+
   /**
    * 發送 ping
    */